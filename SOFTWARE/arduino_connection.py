@@ -1,10 +1,16 @@
 import serial
 import time
-import glob
-import sys
 import traceback
-import re
+import threading
+import itertools
+import queue
+from collections import deque
 from thread import Thread
+from port_discovery import PortDiscovery
+from serial_messages import (MessageFramer, PositionMessage, AckMessage, SequenceAckMessage, ProtocolMessage,
+                             QueueStatusMessage, QueueFullMessage, BannerMessage, DebugMessage)
+from serial_commands import (format_command, format_number, move_commands, format_speed_update, wave_commands,
+                             format_wave_start, AcknowledgementException, PendingCommand, PositionSubscription)
 
 
 class CannotConnectException(Exception):
@@ -22,16 +28,113 @@ class Arduino:
         self.main = main
         self.serial = None
         self.connected = False
+        self.global_listener_thread = None
+        self.global_writer_thread = None
+
+        # Set by the ready banner the board prints after booting, times in s of the last connect
+        self.board_ready = threading.Event()
+        self.connect_metrics = {}
 
         # total number of steps per revolution
         self.steps_per_revolution = 200
         self.mm_per_revolution = 2
         self.motors_enabled = False
         self.motors_changed_callback = None
+
+        # Acceleration of every channel in steps/s^2, the firmware starts with X_ACCEL
+        self.default_acceleration = 5000.0
+        self.channel_accelerations = [self.default_acceleration] * 3
         self.position_update_callback = None
 
+        # The firmware reads commands byte by byte out of the 64 byte hardware serial buffer.
+        # Only as many bytes as fit into that buffer may be in flight (written but not yet
+        # acknowledged by the <mode: ...> echo) at any time, otherwise the board drops bytes.
+        self.rx_buffer_size = 64
+        self.ack_timeout = 2.0
+        self.pending_acks = deque()
+        self.bytes_in_flight = 0
+        self.ack_condition = threading.Condition()
+        self.ack_latencies = deque(maxlen=1000)
+
+        # All commands go through a single writer thread draining this queue
+        self.command_queue = queue.PriorityQueue()
+        self.command_sequence = itertools.count()
+
+        # Binary protocol, only used once the firmware confirmed it
+        self.binary_mode = False
+        self.binary_sequence = itertools.count()
+        self.binary_confirmed = threading.Event()
+
+        # Position telemetry, the board reports every telemetry_interval ms
+        self.default_telemetry_interval = 200
+        self.telemetry_interval = self.default_telemetry_interval
+        self.telemetry_on_change = False
+        self.position_subscriptions = []
+        self.last_position = None
+
+        # Commanded target per channel, the event is set once the telemetry shows the channel
+        # arrived there (or the movement was stopped, which marks it as aborted)
+        self.target_lock = threading.Lock()
+        self.channel_targets = [None, None, None]
+        self.channel_aborted = [False, False, False]
+        self.channel_idle = [threading.Event(), threading.Event(), threading.Event()]
+        for event in self.channel_idle:
+            event.set()
+
+        # Target the host last commanded per channel, None once it is unknown (after STOP, ZERO or a waveform).
+        # Jogs add up against it instead of the last reported position. While the previous jog of a channel
+        # is in flight or still moving, further jogs are held in jog_moves and sent as one move once the
+        # channel arrived, no jog came for jog_window s or the oldest one was held for jog_max_hold s.
+        self.jog_lock = threading.RLock()
+        self.commanded_targets = [None, None, None]
+        self.jog_moves = {}
+        self.jog_futures = [None, None, None]
+        self.jog_window = 0.25
+        self.jog_max_hold = 0.5
+        self.jog_held_since = [None, None, None]
+        self.jog_due = [False, False, False]
+        self.jog_timers = [None, None, None]
+
+        # On-board move queue of QUEUE_LENGTH moves per channel. Queued moves are counted per channel when
+        # sent, acknowledged and started, the telemetry reports how many are still waiting on the board.
+        # The generation changes whenever the board drops its queues (STOP, CLEAR).
+        self.queue_length = 8
+        self.queue_condition = threading.Condition()
+        self.queue_sent = [0, 0, 0]
+        self.queue_acked = [0, 0, 0]
+        self.queue_started = [0, 0, 0]
+        self.queue_generation = 0
+        self.queue_segment = itertools.count()
+
+        # Handlers for the messages parsed by the serial listener
+        self.message_handlers = {
+            PositionMessage: self.handle_position,
+            AckMessage: self.acknowledge,
+            SequenceAckMessage: self.acknowledge_sequence,
+            ProtocolMessage: self.handle_protocol,
+            QueueStatusMessage: self.handle_queue_status,
+            QueueFullMessage: self.handle_queue_full,
+            BannerMessage: self.handle_banner,
+            DebugMessage: self.handle_debug,
+        }
+
     # Connect to the Arduino Board
     def connect(self):
+        """ Opens the connection, returns as soon as the board is ready and acknowledged ENABLE
+
+        Opening the port resets the board, it prints its ready banner once it booted. Boards which
+        do not reset print no banner, ENABLE is sent anyway once connect-timeout passed without one.
+        Blocks for up to twice the connect-timeout, call it off the GUI thread.
+
+        raises CannotConnectException
+            If the port cannot be opened or the board does not acknowledge ENABLE in time
+        """
+        timeout = float(self.config['connection'].get('connect-timeout', 5))
+        started = time.perf_counter()
+        self.board_ready.clear()
+        # The board resets when the port is opened
+        self.channel_accelerations = [self.default_acceleration] * 3
+        self.forget_targets()
         try:
             self.serial = serial.Serial()
             self.serial.port = self.config['connection']['com-port']
@@ -41,6 +144,7 @@ class Arduino:
             self.serial.bytesize = serial.EIGHTBITS
             self.serial.timeout = 1
             self.serial.open()
+            opened = time.perf_counter()
 
             print(f"Arduino> Connect to port: {self.config['connection']['com-port']}")
 
@@ -49,116 +153,404 @@ class Arduino:
             self.global_listener_thread.finished.connect(lambda: self.thread_finished_helper(self.global_listener_thread))
             self.global_listener_thread.start()
 
+            # This thread writes all queued commands to the Arduino, one after another
+            self.global_writer_thread = Thread(self.serial_writer)
+            self.global_writer_thread.finished.connect(lambda: self.thread_finished_helper(self.global_writer_thread))
+            self.global_writer_thread.start()
+
+            if not self.board_ready.wait(timeout):
+                print(f"Arduino> No ready banner within {timeout}s, the board might not reset on connect")
+            ready = time.perf_counter()
 
-            # TODO: figure out if 3s is necessary
-            # TODO: move to thread and update UI when received success message
-            time.sleep(2)
-            self.enable_motors()
-            time.sleep(1)
+            self.enable_motors().result(timeout)
+            enabled = time.perf_counter()
+
+            # The board starts with its default telemetry after a reset, always send the current setting
+            self.update_telemetry(force=True)
+
+            if self.config['connection'].get('binary-protocol') in (True, 'True'):
+                self.enable_binary_protocol()
 
             self.connected = True
-        except Exception as exc:
+        except Exception:
             self.connected = False
-            traceback.print_exc(exc)
+            traceback.print_exc()
+            self.close_connection()
             raise CannotConnectException
 
+        self.connect_metrics = {
+            'open': opened - started,
+            'banner': ready - opened,
+            'enable-ack': enabled - ready,
+            'total': time.perf_counter() - started,
+        }
+        print(f"Arduino> Connected in {self.connect_metrics['total'] * 1000:.0f}ms "
+              f"(open {self.connect_metrics['open'] * 1000:.0f}ms, "
+              f"banner {self.connect_metrics['banner'] * 1000:.0f}ms, "
+              f"enable ack {self.connect_metrics['enable-ack'] * 1000:.0f}ms)")
+
     # Disconnect from the Arduino board
-    # TODO: figure out how to handle error.. (which error?)
     def disconnect(self):
         print("Arduino> Disconnecting from board..")
-        self.disable_motors()
-        time.sleep(2)
-        self.global_listener_thread.stop()
-        self.serial.close()
+        try:
+            self.disable_motors().result(self.ack_timeout)
+        except Exception:
+            print("Arduino> Board did not acknowledge disabling the motors")
+        self.close_connection()
         self.connected = False
         print("Arduino> Board has been disconnected")
 
+    def close_connection(self):
+        """ Stops the listener and writer threads and closes the port """
+        for thread in (self.global_listener_thread, self.global_writer_thread):
+            if thread is not None:
+                thread.stop()
+
+        if self.serial is not None and self.serial.is_open:
+            # Wake the listener up from its blocking read, the port must not be closed underneath it
+            self.serial.cancel_read()
+        for thread in (self.global_listener_thread, self.global_writer_thread):
+            if thread is not None:
+                thread.wait(2000)
+
+        self.cancel_queued_commands()
+        if self.serial is not None:
+            self.serial.close()
+
+    # Shared by all connections, so probe results are cached across refreshes
+    port_discovery = PortDiscovery()
+
     @staticmethod
-    def discover_ports():
+    def discover_ports(refresh=False, handshake=False, exclude=()):
         """
+            Lists the serial ports by their USB metadata, known Arduino boards first. Only ports without
+            known metadata are opened to check them, in parallel. See PortDiscovery.
+
+            refresh
+                Drop the cached probe results
+            handshake
+                Only return ports which print the <Arduino Board is ready> banner, resets the boards
+            exclude
+                Ports which must not be opened, e.g. the one currently connected
             raises EnvironmentError
-                On unsupported or unknown platforms
+                If no suitable port was found
             returns
-                A list of the serial ports available on the system
-        """
-        if sys.platform.startswith('win'):
-            # For speed reason capped to range(50). Increase to 256 if needed.
-            ports = ['COM%s' % (i + 1) for i in range(256)]
-        elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-            # this excludes your current terminal "/dev/tty"
-            ports = glob.glob('/dev/tty[A-Za-z]*')
-        elif sys.platform.startswith('darwin'):
-            ports = glob.glob('/dev/tty.*')
-        else:
-            raise EnvironmentError('Unsupported platform')
-
-        result = []
-        for port in ports:
-            try:
-                s = serial.Serial(port)
-                s.close()
-                result.append(port)
-            except (OSError, serial.SerialException):
-                pass
+                A list of the serial ports available on the system, best candidates first
+        """
+        if refresh:
+            Arduino.port_discovery.invalidate()
+        ports = [candidate.device for candidate in Arduino.port_discovery.discover(handshake, exclude=exclude)]
 
-        if len(result) > 0:
-            return result
+        if len(ports) > 0:
+            return ports
         else:
             raise EnvironmentError('No suitable ports found')
 
-    def send_commands(self, commands):
-        thread = Thread(self.send_commands_helper, commands)
-        thread.finished.connect(lambda: self.thread_finished_helper(thread))
-        thread.start()
+    def send_commands(self, commands, priority=None):
+        """ Queues commands for the writer thread
+
+        STOP and PAUSE are queued as urgent and are written before any queued moves. A STOP
+        additionally cancels all commands which are still waiting in the queue.
 
-    def send_commands_helper(self, commands):
+        Parameters
+        ----------
+        commands : list of str
+            The commands to send, in order
+        priority : int
+            PRIORITY_URGENT or PRIORITY_NORMAL. Derived from the command mode if not given.
+
+        Returns
+        -------
+        list of Future
+            One future per command, resolving with its PendingCommand once acknowledged
+        """
+        futures = []
         for command in commands:
-            # Send the command via the serial connection
-            self.serial.write(command.encode())
-            self.serial.flushInput()
-            print("Arduino> Send Command: " + command)
+            pending = PendingCommand(command, priority)
+            if pending.mode == 'STOP':
+                self.cancel_queued_commands()
+            self.command_queue.put((pending.priority, next(self.command_sequence), pending))
+            futures.append(pending.future)
+        return futures
+
+    def cancel_queued_commands(self):
+        """ Cancels all commands which have not been written yet """
+        while True:
+            try:
+                _, _, pending = self.command_queue.get_nowait()
+            except queue.Empty:
+                break
+            pending.future.cancel()
+
+    def serial_writer(self):
+        while self.global_writer_thread.runs:
+            try:
+                _, _, pending = self.command_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
 
-            # Short sleep time for serial connection to reset
-            time.sleep(0.1)
+            # Skip commands which have been cancelled while queued
+            if pending.future.set_running_or_notify_cancel():
+                self.write_command(pending)
 
-        print("Arduino> Send complete\n\n")
+    def write_command(self, pending):
+        """ Writes a single command as soon as the firmware input buffer has room for it
+
+        Commands are pipelined: instead of sleeping after every write, the number of
+        unacknowledged bytes is tracked and kept below the size of the firmware input buffer.
+        A command larger than the buffer is only sent when nothing else is in flight.
+        """
+        if self.binary_mode:
+            try:
+                pending.encode_binary(next(self.binary_sequence))
+            except ValueError:
+                # Commands without binary equivalent are still understood in ASCII
+                pass
+
+        with self.ack_condition:
+            while self.bytes_in_flight > 0 and self.bytes_in_flight + pending.size > self.rx_buffer_size:
+                if not self.ack_condition.wait(self.ack_timeout):
+                    self.expire_pending_acks()
+
+            pending.sent_at = time.perf_counter()
+            self.pending_acks.append(pending)
+            self.bytes_in_flight += pending.size
+
+            # Send the command via the serial connection
+            self.serial.write(pending.data)
+
+        print("Arduino> Send Command: " + pending.command)
+
+    def acknowledge(self, message):
+        """ Matches a <mode: ... ,setting: ... > echo from the firmware to the oldest pending command """
+        with self.ack_condition:
+            for index, pending in enumerate(self.pending_acks):
+                if pending.matches(message.mode, message.setting):
+                    break
+            else:
+                print(f"Arduino> Unexpected acknowledgement: {message.mode},{message.setting}")
+                return
+
+            # Everything sent before the acknowledged command has been read by the firmware as well
+            for _ in range(index):
+                lost = self.pending_acks.popleft()
+                self.bytes_in_flight -= lost.size
+                print(f"Arduino> No acknowledgement for: {lost.command}")
+                lost.future.set_exception(AcknowledgementException(f"No acknowledgement for: {lost.command}"))
+
+            pending = self.pending_acks.popleft()
+            self.bytes_in_flight -= pending.size
+            pending.acked_at = time.perf_counter()
+            self.ack_latencies.append(pending.latency())
+            pending.future.set_result(pending)
+
+            self.ack_condition.notify_all()
+
+    def acknowledge_sequence(self, message):
+        """ Matches a #<sequence> acknowledgement or ?<sequence> rejection of a binary frame """
+        with self.ack_condition:
+            for pending in self.pending_acks:
+                if pending.sequence == message.sequence:
+                    break
+            else:
+                print(f"Arduino> Unexpected acknowledgement: #{message.sequence}")
+                return
+
+            self.pending_acks.remove(pending)
+            self.bytes_in_flight -= pending.size
+            pending.acked_at = time.perf_counter()
+
+            if message.accepted:
+                self.ack_latencies.append(pending.latency())
+                pending.future.set_result(pending)
+            else:
+                print(f"Arduino> Frame rejected by board: {pending.command}")
+                pending.future.set_exception(AcknowledgementException(f"Frame rejected by board: {pending.command}"))
+
+            self.ack_condition.notify_all()
+
+    def enable_binary_protocol(self, timeout=1.0):
+        """ Switches to binary frames if the firmware supports them. Returns whether binary mode is used """
+        self.binary_confirmed.clear()
+        self.send_manual_arduino_command('BINARY', 'ON', 0, 1, 'F', [0.0, 0.0, 0.0])
+        self.binary_mode = self.binary_confirmed.wait(timeout)
+        print(f"Arduino> Binary protocol {'enabled' if self.binary_mode else 'not supported, using ASCII'}")
+        return self.binary_mode
+
+    def disable_binary_protocol(self):
+        future = self.send_manual_arduino_command('BINARY', 'OFF', 0, 0, 'F', [0.0, 0.0, 0.0])
+        self.binary_mode = False
+        return future
+
+    def expire_pending_acks(self):
+        """ Gives up on commands whose acknowledgement did not arrive in time. Needs ack_condition to be held """
+        now = time.perf_counter()
+        while self.pending_acks and now - self.pending_acks[0].sent_at > self.ack_timeout:
+            lost = self.pending_acks.popleft()
+            self.bytes_in_flight -= lost.size
+            print(f"Arduino> Acknowledgement timed out for: {lost.command}")
+            lost.future.set_exception(AcknowledgementException(f"Acknowledgement timed out for: {lost.command}"))
+        self.ack_condition.notify_all()
+
+    def wait_for_acks(self, timeout=None):
+        """ Blocks until every command written so far has been acknowledged. Returns False on timeout """
+        with self.ack_condition:
+            return self.ack_condition.wait_for(lambda: not self.pending_acks, timeout)
 
     def thread_finished_helper(self, thread):
         thread.stop()
         print(f"Arduino> Thread finished")
 
     def send_manual_arduino_command(self, operation, operation_type, motors, value, direction, steps):
-        command = f"<{operation},{operation_type},{motors},{value},{direction},{steps[0]},{steps[1]},{steps[2]}>"
+        command = format_command(operation, operation_type, motors, value, direction, steps)
         print(f"Arduino> Executing: {command}")
-        self.send_commands([command])
+        return self.send_commands([command])[0]
 
-    def return_manual_arduino_command(self, operation, operation_type, motors, value, direction, steps):
-        command = f"<{operation},{operation_type},{motors},{value},{direction},{steps[0]},{steps[1]},{steps[2]}>"
-        return command
+    @staticmethod
+    def return_manual_arduino_command(operation, operation_type, motors, value, direction, steps):
+        return format_command(operation, operation_type, motors, value, direction, steps)
 
     def serial_listener(self):
+        framer = MessageFramer()
         while self.global_listener_thread.runs:
-            line = self.serial.readline()
-            if len(line) > 0:
-                # Decode and trim
-                line = line.decode('ascii').replace('\r\n', '')
+            for message in framer.read_from(self.serial):
+                self.message_handlers[type(message)](message)
+
+    def handle_position(self, message):
+        self.last_position = message
+        if message.queued is not None:
+            self.update_queue_depths(message.queued)
+        # Held jogs go out before an arrival marks the channel as idle
+        for index in list(self.jog_moves):
+            self.release_jog(index)
+        self.check_targets(message)
+
+        if self.position_update_callback is not None:
+            self.position_update_callback(message)
+        for subscription in self.position_subscriptions:
+            subscription.offer(message)
+
+    def check_targets(self, message):
+        with self.target_lock:
+            for index, target in enumerate(self.channel_targets):
+                if target is not None and message.positions[index] == target and message.remaining[index] == 0 \
+                        and self.queue_pending(index) == 0:
+                    self.channel_targets[index] = None
+                    self.channel_idle[index].set()
+
+    def expect_target(self, motor_channel, position_in_steps):
+        """ Marks the channel as moving until the telemetry reports it at the given position """
+        index = motor_channel - 1
+        with self.target_lock:
+            self.channel_targets[index] = position_in_steps
+            self.commanded_targets[index] = position_in_steps
+            self.channel_aborted[index] = False
+            self.channel_idle[index].clear()
+
+        # Already there, no further report might show up if only changes are reported
+        if self.last_position is not None:
+            self.check_targets(self.last_position)
+
+    def abort_targets(self, motor_channels=(1, 2, 3)):
+        with self.target_lock:
+            for index, target in enumerate(self.channel_targets):
+                if target is not None and index + 1 in motor_channels:
+                    self.channel_targets[index] = None
+                    self.channel_aborted[index] = True
+                    self.channel_idle[index].set()
+        # Stopped channels stand somewhere short of their target
+        self.forget_targets(motor_channels)
+
+    def forget_targets(self, motor_channels=(1, 2, 3)):
+        """ Drops the commanded targets and waiting jogs, the next jog starts at the reported position """
+        with self.jog_lock:
+            for motor_channel in motor_channels:
+                self.commanded_targets[motor_channel - 1] = None
+                self.jog_moves.pop(motor_channel - 1, None)
+                self.jog_held_since[motor_channel - 1] = None
+                self.jog_due[motor_channel - 1] = False
+
+    def commanded_target(self, motor_channel):
+        """ Position in steps the channel ends up at with the moves commanded so far """
+        target = self.commanded_targets[motor_channel - 1]
+        if target is None:
+            return self.last_position.positions[motor_channel - 1] if self.last_position is not None else 0
+        return target
+
+    def wait_for_channel(self, motor_channel, timeout=None):
+        """ Blocks until the channel reached its commanded target
+
+        Returns
+        -------
+        bool
+            True if the target was reached, False on timeout or if the movement was stopped
+        """
+        index = motor_channel - 1
+        return self.channel_idle[index].wait(timeout) and not self.channel_aborted[index]
 
-                # Printout (move to log)
-                # print(f"Serial> {line}")
+    def subscribe_positions(self, rate, callback, on_change=False):
+        """ Subscribes a callback to position telemetry
 
-                # Split line at spaces
-                line_split = re.split(' |:', line)
+        Parameters
+        ----------
+        rate : float
+            Reports per second the callback wants to receive
+        callback : function
+            Called with a PositionMessage from the serial listener thread
+        on_change : bool
+            Only deliver reports which differ from the previous one
+
+        Returns
+        -------
+        PositionSubscription
+            Cancel it to unsubscribe
+        """
+        subscription = PositionSubscription(self, rate, callback, on_change)
+        self.position_subscriptions.append(subscription)
+        self.update_telemetry()
+        return subscription
+
+    def unsubscribe_positions(self, subscription):
+        if subscription in self.position_subscriptions:
+            self.position_subscriptions.remove(subscription)
+            self.update_telemetry()
+
+    def update_telemetry(self, force=False):
+        """ Sets the board telemetry to the fastest subscribed rate. Only reports changes if all subscribers do so """
+        if self.position_subscriptions:
+            interval = min(subscription.interval for subscription in self.position_subscriptions)
+            on_change = all(subscription.on_change for subscription in self.position_subscriptions)
+        else:
+            interval = self.default_telemetry_interval
+            on_change = False
 
-                # POS feedback
-                if line_split[0] == 'POS':
-                    pos1 = int(line_split[2])
-                    rem1 = int(line_split[4])
-                    pos2 = int(line_split[6])
-                    rem2 = int(line_split[8])
-                    pos3 = int(line_split[10])
-                    rem3 = int(line_split[12])
-                    self.position_update_callback(pos1, rem1, pos2, rem2, pos3, rem3)
+        if not force and (interval, on_change) == (self.telemetry_interval, self.telemetry_on_change):
+            return
+        self.telemetry_interval = interval
+        self.telemetry_on_change = on_change
 
+        if self.serial is not None and self.serial.is_open:
+            self.send_manual_arduino_command('TELEMETRY', 'RATE', 0, interval, 'F', [int(on_change), 0, 0])
+
+    def handle_protocol(self, message):
+        if message.name == 'BINARY' and message.enabled:
+            self.binary_confirmed.set()
+
+    def handle_queue_status(self, message):
+        self.update_queue_depths(message.queued)
+
+    def handle_queue_full(self, message):
+        print(f"Arduino> Queue of channel {message.channel} is full, move dropped")
+        self.abort_targets([message.channel])
+
+    def handle_banner(self, message):
+        print("Arduino> Board is ready")
+        self.board_ready.set()
+
+    def handle_debug(self, message):
+        # Printout (move to log)
+        # print(f"Serial> {message.text}")
+        pass
 
     # #########################################################
     # Hardware Abstraction Functions
@@ -166,57 +558,382 @@ class Arduino:
     # Expose motor functionality to software on API level
     # #########################################################
 
-    # asd
-    def jog(self, motor_channel, position_in_steps, speed_in_steps_per_s):
-        """ Jogs the given channel in a given direction and distance
+    def jog(self, motor_channel, position_in_steps, speed_in_steps_per_s, acceleration_in_steps_per_s2=None):
+        """ Moves the given channel to an absolute position
 
         Parameters
         ----------
         motor_channel : int
             The channel which should be manipulated (1..3)
-        direction : string
-            The direction in which the motor should be moved. 1 for FORWARD, 0 for BACKWARD.
-        distance_in_mm : float
-            The distance by which the motor should be moved, given in mm.
+        position_in_steps : float
+            The absolute target position in steps
+        speed_in_steps_per_s : float
+            The maximum speed of the move
+        acceleration_in_steps_per_s2 : float
+            The acceleration of the move, the channel keeps its current one if not given
         """
+        accelerations = None
+        if acceleration_in_steps_per_s2 is not None:
+            accelerations = {motor_channel: acceleration_in_steps_per_s2}
+        return self.run_channels({motor_channel: position_in_steps}, {motor_channel: speed_in_steps_per_s},
+                                 accelerations)
 
-        distances = [0.0, 0.0, 0.0]
-        distances[motor_channel - 1] = position_in_steps
+    def jog_by(self, motor_channel, distance_in_steps, speed_in_steps_per_s, acceleration_in_steps_per_s2=None):
+        """ Moves the given channel by a distance from its commanded target
 
-        # TODO: Add speed setting change and waiter? thread?
-        speed_command = self.return_manual_arduino_command('SETTING', 'SPEED', motor_channel, speed_in_steps_per_s, 'F', [0,0,0])
-        jog_command = self.return_manual_arduino_command('RUN', 'DIST', motor_channel, 1, 'F', distances)
-        self.send_commands([speed_command, jog_command])
+        Rapid jogs add up: every jog continues from the target of the previous one, not from the last
+        reported position. A jog of an idle channel is sent right away. While it is in flight or moving,
+        further jogs are merged into a single move, the latest speed wins. That move is sent once the
+        telemetry shows the channel arrived, no jog came for jog_window s or the first merged jog waited
+        jog_max_hold s, so a burst of clicks costs two moves instead of one per click.
+
+        Parameters
+        ----------
+        motor_channel : int
+            The channel which should be manipulated (1..3)
+        distance_in_steps : float
+            Distance to move, negative to withdraw
+        speed_in_steps_per_s : float
+            The maximum speed of the move, has to be positive
+        acceleration_in_steps_per_s2 : float
+            The acceleration of the move, the channel keeps its current one if not given
+
+        Returns
+        -------
+        Future
+            Resolves once the board acknowledged the move, None if the jog was merged into the next move
+        """
+        if not speed_in_steps_per_s > 0:
+            raise ValueError('The speed of a jog has to be positive')
+        index = motor_channel - 1
+        with self.jog_lock:
+            target = int(round(self.commanded_target(motor_channel) + distance_in_steps))
+            self.jog_moves[index] = (target, speed_in_steps_per_s, acceleration_in_steps_per_s2)
+            self.commanded_targets[index] = target
+            if not self.jog_busy(index):
+                return self.send_jog(index)
+
+            now = time.perf_counter()
+            if self.jog_held_since[index] is None:
+                self.jog_held_since[index] = now
+            delay = min(self.jog_window, self.jog_held_since[index] + self.jog_max_hold - now)
+            if self.jog_timers[index] is not None:
+                self.jog_timers[index].cancel()
+            self.jog_timers[index] = threading.Timer(max(0.0, delay), self.release_jog, (index, True))
+            self.jog_timers[index].daemon = True
+            self.jog_timers[index].start()
+            return None
+
+    def jog_busy(self, index):
+        """ Whether the last jog of the channel waits for its acknowledgement or the channel is still moving """
+        future = self.jog_futures[index]
+        if future is not None and not future.done():
+            return True
+        target = self.channel_targets[index]
+        message = self.last_position
+        return target is not None and \
+            (message is None or message.positions[index] != target or message.remaining[index] != 0)
+
+    def release_jog(self, index, due=False):
+        """ Sends the held jog of the channel once it is due or the channel is no longer busy """
+        with self.jog_lock:
+            self.jog_due[index] = self.jog_due[index] or due
+            if index not in self.jog_moves:
+                return None
+            future = self.jog_futures[index]
+            if future is not None and not future.done():
+                # Sent once the board acknowledged the previous jog
+                return None
+            if not self.jog_due[index] and self.jog_busy(index):
+                return None
+            return self.send_jog(index)
+
+    def send_jog(self, index):
+        """ Sends the held jog of the channel """
+        with self.jog_lock:
+            if index not in self.jog_moves:
+                return None
+            if self.jog_timers[index] is not None:
+                self.jog_timers[index].cancel()
+                self.jog_timers[index] = None
+            self.jog_held_since[index] = None
+            self.jog_due[index] = False
+
+            target, speed, acceleration = self.jog_moves.pop(index)
+            future = self.jog(index + 1, target, speed, acceleration)[-1]
+            self.jog_futures[index] = future
+        future.add_done_callback(lambda _: self.release_jog(index))
+        return future
+
+    def run_channels(self, targets, speeds, accelerations=None, locked=False):
+        """ Moves several channels at once with a single MOVE command
+
+        Parameters
+        ----------
+        targets : dict
+            Absolute target position in steps per channel (1..3)
+        speeds : dict
+            Speed in steps/s per channel
+        accelerations : dict
+            Acceleration in steps/s^2 per channel, only sent if it differs from the one the channel has
+        locked : bool
+            Slave the channels to the one with the longest move so the ratios of their volumes hold
+            throughout, see ratio_locked_profile() for matching speeds and accelerations
+        """
+        # The firmware can only move by whole steps, round here so the target can be recognized in the telemetry
+        targets = {motor_channel: int(round(position)) for motor_channel, position in targets.items()}
+        changed = {motor_channel: acceleration for motor_channel, acceleration in (accelerations or {}).items()
+                   if acceleration != self.channel_accelerations[motor_channel - 1]}
+        # Raises ValueError for invalid speeds, before any channel is marked as moving
+        commands = move_commands(targets, speeds, changed, self.rx_buffer_size, locked)
+
+        for motor_channel, acceleration in changed.items():
+            self.channel_accelerations[motor_channel - 1] = acceleration
+        for motor_channel, position_in_steps in targets.items():
+            self.expect_target(motor_channel, position_in_steps)
+        return self.send_commands(commands)
+
+    def set_accelerations(self, accelerations):
+        """ Sets the acceleration of channels for the moves that follow, queued moves included
+
+        Parameters
+        ----------
+        accelerations : dict
+            Acceleration in steps/s^2 per channel, only sent if it differs from the one the channel has
+
+        Returns
+        -------
+        list of Future
+            One future per SETTING command sent
+        """
+        commands = []
+        for motor_channel, acceleration in sorted(accelerations.items()):
+            if acceleration != self.channel_accelerations[motor_channel - 1]:
+                self.channel_accelerations[motor_channel - 1] = acceleration
+                commands.append(format_command('SETTING', 'ACCEL', motor_channel, format_number(acceleration), 'F',
+                                               [0, 0, 0]))
+        return self.send_commands(commands)
+
+    def update_speed(self, motor_channel, speed_in_steps_per_s):
+        """ Changes the speed of a channel in place, a running move keeps its target and does not stop
+
+        The channel accelerates or decelerates to the new speed once the board read the command, which
+        replaces stop_movement() followed by a new move.
+
+        Parameters
+        ----------
+        motor_channel : int
+            The channel which should be manipulated (1..3)
+        speed_in_steps_per_s : float
+            The new maximum speed, has to be positive
+
+        Returns
+        -------
+        Future
+            Resolves once the board acknowledged the new speed
+        """
+        if speed_in_steps_per_s <= 0:
+            raise ValueError('The speed has to be positive, use stop_movement() to stop a channel')
+        return self.send_commands([format_speed_update({motor_channel: speed_in_steps_per_s})])[0]
 
     def enable_motors(self):
         """ Enables all motors """
-        self.send_manual_arduino_command('SETTING', 'ENABLE', 1, 1, "F", [0.0, 0.0, 0.0])
+        future = self.send_manual_arduino_command('SETTING', 'ENABLE', 1, 1, "F", [0.0, 0.0, 0.0])
         self.motors_enabled = True
-        self.motors_changed_callback()
+        if self.motors_changed_callback is not None:
+            self.motors_changed_callback()
+        return future
 
     def disable_motors(self):
         """ Disables all motors """
-        self.send_manual_arduino_command('SETTING', 'ENABLE', 1, 0, "F", [0.0, 0.0, 0.0])
+        future = self.send_manual_arduino_command('SETTING', 'ENABLE', 1, 0, "F", [0.0, 0.0, 0.0])
         self.motors_enabled = False
-        self.motors_changed_callback()
+        if self.motors_changed_callback is not None:
+            self.motors_changed_callback()
+        return future
 
     def toggle_motors(self):
         """ Toggles all motors """
         if self.motors_enabled:
-            self.disable_motors()
+            return self.disable_motors()
         else:
-            self.enable_motors()
-        self.motors_changed_callback()
+            return self.enable_motors()
 
     def stop_movement(self):
-        self.send_manual_arduino_command("STOP", "0", "0", "0", "F", [0, 0, 0])
+        # The board also drops all queued moves
+        self.abort_targets()
+        self.invalidate_queue()
+        return self.send_manual_arduino_command("STOP", "0", "0", "0", "F", [0, 0, 0])
 
     def pause_movement(self):
-        self.send_manual_arduino_command("PAUSE", "0", "0", "0", "F", [0, 0, 0])
+        return self.send_manual_arduino_command("PAUSE", "0", "0", "0", "F", [0, 0, 0])
 
     def resume_movement(self):
-        self.send_manual_arduino_command("RESUME", "0", "0", "0", "F", [0, 0, 0])
+        return self.send_manual_arduino_command("RESUME", "0", "0", "0", "F", [0, 0, 0])
 
     def zero(self):
         # TODO: add possibility zero only single channel
-        self.send_manual_arduino_command("ZERO", "0", "0", "0", "F", [0, 0, 0])
\ No newline at end of file
+        self.forget_targets()
+        return self.send_manual_arduino_command("ZERO", "0", "0", "0", "F", [0, 0, 0])
+
+    # #########################################################
+    # On-board Move Queue
+    #
+    # Queued moves run back-to-back on the board without a round trip to the PC in between
+    # #########################################################
+
+    @property
+    def queue_supported(self):
+        """ Whether the firmware has the move queue, known once its telemetry reported the queue depths """
+        return self.last_position is not None and self.last_position.queued is not None
+
+    def queue_pending(self, index):
+        """ Moves of the channel (index 0..2) which were sent but did not start yet """
+        return self.queue_sent[index] - self.queue_started[index]
+
+    def queue_free(self, motor_channel):
+        return self.queue_length - self.queue_pending(motor_channel - 1)
+
+    def update_queue_depths(self, queued):
+        # Lines arrive in order: every acknowledgement received so far was parsed by the board before this report
+        with self.queue_condition:
+            for index, depth in enumerate(queued):
+                self.queue_started[index] = self.queue_acked[index] - depth
+            self.queue_condition.notify_all()
+
+    def queue_command_done(self, index, future):
+        with self.queue_condition:
+            if future.cancelled() or future.exception() is not None:
+                self.queue_sent[index] -= 1
+            else:
+                self.queue_acked[index] += 1
+            self.queue_condition.notify_all()
+
+    def invalidate_queue(self):
+        with self.queue_condition:
+            self.queue_generation += 1
+            self.queue_condition.notify_all()
+
+    def enqueue_move(self, targets, speeds, segment=None):
+        """ Queues a move of one or more channels on the board
+
+        The channels of a move start together, as soon as no channel is busy with an earlier move anymore.
+        The caller has to make sure the queues have room, see wait_for_queue().
+
+        Parameters
+        ----------
+        targets : dict
+            Absolute target position in steps per channel (1..3)
+        speeds : dict
+            Speed in steps/s per channel
+        segment : int
+            Position of the move in the sequence, the next one if not given
+
+        Returns
+        -------
+        list of Future
+            One future per channel
+        """
+        if segment is None:
+            segment = next(self.queue_segment)
+
+        futures = []
+        for motor_channel in sorted(targets):
+            index = motor_channel - 1
+            position_in_steps = int(round(targets[motor_channel]))
+            distances = [0, 0, 0]
+            distances[index] = position_in_steps
+
+            with self.queue_condition:
+                self.queue_sent[index] += 1
+            self.expect_target(motor_channel, position_in_steps)
+
+            command = self.return_manual_arduino_command('QUEUE', segment & 0xFF, motor_channel, speeds[motor_channel],
+                                                         'F', distances)
+            future = self.send_commands([command])[0]
+            future.add_done_callback(lambda future, index=index: self.queue_command_done(index, future))
+            futures.append(future)
+        return futures
+
+    def enqueue_moves(self, moves):
+        """ Queues a batch of moves which run back-to-back on the board
+
+        Blocks while the queue of a channel is full until the board started enough moves. Stops early if the
+        queues are dropped meanwhile by stop_movement() or clear_queue().
+
+        Parameters
+        ----------
+        moves : list of (dict, dict)
+            Absolute targets in steps and speeds in steps/s per channel (1..3) of every move, in order
+
+        Returns
+        -------
+        list of Future
+            The futures of all queued commands
+        """
+        generation = self.queue_generation
+        futures = []
+        for targets, speeds in moves:
+            if not self.wait_for_queue(targets, generation):
+                break
+            futures.extend(self.enqueue_move(targets, speeds))
+        return futures
+
+    def wait_for_queue(self, motor_channels, generation=None, timeout=None):
+        """ Blocks until the queues of all given channels have room for another move
+
+        Returns
+        -------
+        bool
+            False on timeout or if the queues were dropped since the given generation
+        """
+        if generation is None:
+            generation = self.queue_generation
+        with self.queue_condition:
+            self.queue_condition.wait_for(
+                lambda: self.queue_generation != generation or
+                all(self.queue_free(motor_channel) > 0 for motor_channel in motor_channels),
+                timeout)
+            return self.queue_generation == generation and \
+                all(self.queue_free(motor_channel) > 0 for motor_channel in motor_channels)
+
+    def clear_queue(self, motor_channels=(1, 2, 3)):
+        """ Drops the queued moves of the channels which did not start yet, running moves continue """
+        self.abort_targets(motor_channels)
+        self.invalidate_queue()
+        motors = ''.join(str(motor_channel) for motor_channel in sorted(motor_channels))
+        return self.send_manual_arduino_command('CLEAR', 'QUEUE', motors, 0, 'F', [0, 0, 0])
+
+    def request_queue_status(self):
+        """ Asks the board for its queue depths, they are reported between the telemetry as well """
+        return self.send_manual_arduino_command('STATUS', 'QUEUE', 0, 0, 'F', [0, 0, 0])
+
+    # #########################################################
+    # Periodic Waveforms
+    #
+    # One period of a waveform is uploaded once and replayed by the board without the PC
+    # #########################################################
+
+    def upload_waveform(self, motor_channel, slot_ms, steps):
+        """ Uploads the waveform table of a channel, a running waveform of the channel continues with it
+
+        Parameters
+        ----------
+        motor_channel : int
+            The channel (1..3)
+        slot_ms : int
+            Duration of every slot in ms
+        steps : list of int
+            Steps to move in each slot of one period, at most WAVE_LENGTH of the firmware
+
+        Returns
+        -------
+        list of Future
+        """
+        return self.send_commands(wave_commands(motor_channel, slot_ms, [int(step) for step in steps],
+                                                self.rx_buffer_size))
+
+    def start_waveforms(self, motor_channels, cycles=0):
+        """ Starts the uploaded waveforms of the channels together, 0 cycles repeat them until stop_movement() """
+        self.forget_targets(motor_channels)
+        return self.send_commands([format_wave_start(motor_channels, cycles)])[0]
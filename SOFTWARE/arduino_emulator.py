@@ -0,0 +1,847 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Emulator of the arduino_serialCOM_v0.1 firmware behind a pseudo-terminal.
+
+    The emulator opens a pty pair and exposes the slave side as `port`, which can be opened with
+    `serial.Serial` (or entered as com-port in the GUI) exactly like a plugged in board. It models
+    the parts of the board which matter for the host side performance:
+
+     - the reset when the port is opened, the ready banner is printed boot_delay seconds later
+     - the serial link: baudrate limit in both directions, fixed latency and randomly dropped bytes
+     - the 64 byte hardware receive buffer, overflowing bytes are lost like on a real UART
+     - the 64 byte transmit buffer, Serial.print() stalls the loop (and the steppers) once it is full
+     - the <...> command protocol including all debug output and the <mode: ...> acknowledgement
+     - the negotiated binary frame protocol with CRC check and #<sequence> acknowledgement
+     - three AccelStepper steppers with trapezoidal acceleration profiles
+     - POS telemetry lines with timestamp and queue depths at a configurable interval, optionally only on change
+     - the on-board move queue with QUEUE, CLEAR and STATUS, started in order of segments
+     - periodic waveform tables uploaded and started with WAVE, replayed at constant speed per slot
+     - ratio-locked MOVE commands whose followers are slaved to the progress of the lead channel
+
+    STOP decelerates to a halt, PAUSE freezes the steppers until RESUME continues them at the speed they had.
+
+    Usage:
+        python arduino_emulator.py [--baudrate BAUDRATE] [--latency SECONDS] [--drop-rate RATE]
+"""
+import argparse
+import math
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+from serial_commands import (BINARY_SYNC, BINARY_HEADER, OP_RUN, OP_SETTING, OP_STOP, OP_PAUSE, OP_RESUME,
+                             OP_ZERO, OP_ENABLE, OP_ASCII, OP_TELEMETRY, binary_frame_size, decode_binary_frame)
+
+# Defaults of the firmware
+X_SPEED = 1000.0
+X_ACCEL = 5000.0
+BUFFER_SIZE = 64
+QUEUE_LENGTH = 8
+WAVE_LENGTH = 32
+
+
+class EmulatedStepper:
+    """ Trapezoidal motion of a single stepper the way AccelStepper::run() moves it """
+
+    def __init__(self, max_speed=X_SPEED, acceleration=X_ACCEL):
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+
+        self.position = 0.0
+        self.target = 0
+        self.speed = 0.0
+
+    def current_position(self):
+        return int(round(self.position))
+
+    def distance_to_go(self):
+        return self.target - self.current_position()
+
+    def is_running(self):
+        return self.speed != 0.0 or self.distance_to_go() != 0
+
+    def move_to(self, absolute):
+        self.target = int(absolute)
+
+    def move(self, relative):
+        self.move_to(self.current_position() + relative)
+
+    def set_current_position(self, position):
+        self.position = float(position)
+        self.target = int(position)
+        self.speed = 0.0
+
+    def set_max_speed(self, speed):
+        self.max_speed = abs(speed)
+
+    def set_acceleration(self, acceleration):
+        if acceleration > 0:
+            self.acceleration = acceleration
+
+    def set_speed(self, speed):
+        """ setSpeed(), the constant speed of run_speed_to_position(), limited by the max speed """
+        self.speed = max(-self.max_speed, min(self.max_speed, speed))
+
+    def steps_to_stop(self):
+        return self.speed * self.speed / (2.0 * self.acceleration)
+
+    def stop(self):
+        """ Sets a new target so the stepper comes to a halt as quickly as its acceleration allows """
+        if self.speed != 0.0:
+            self.move(math.copysign(math.ceil(self.steps_to_stop()), self.speed))
+
+    def run(self, dt):
+        """ Advances the stepper by dt seconds """
+        distance = self.target - self.position
+        if abs(distance) < 0.5 and abs(self.speed) * dt < 1.0:
+            self.position = float(self.target)
+            self.speed = 0.0
+            return
+
+        direction = 1.0 if distance > 0 else -1.0
+        speed = abs(self.speed)
+        delta_v = self.acceleration * dt
+
+        if self.speed * direction < 0:
+            # Moving away from the target, turn around
+            speed = -(speed - delta_v) if speed > delta_v else delta_v
+        elif self.steps_to_stop() >= abs(distance) or speed > self.max_speed:
+            speed = max(speed - delta_v, 0.0)
+        else:
+            speed = min(speed + delta_v, self.max_speed)
+
+        # AccelStepper never steps slower than its first step interval allows
+        minimum_speed = min(math.sqrt(self.acceleration / 2.0) * 1.478, self.max_speed)
+        if 0 <= speed < minimum_speed:
+            speed = minimum_speed
+
+        self.speed = direction * speed
+        step = self.speed * dt
+
+        if step * direction >= abs(distance):
+            self.position = float(self.target)
+            self.speed = 0.0
+        else:
+            self.position += step
+
+    def run_speed_to_position(self, dt):
+        """ Advances the stepper by dt seconds at its constant speed like AccelStepper::runSpeedToPosition() """
+        distance = self.target - self.position
+        step = math.copysign(abs(self.speed) * dt, distance)
+        if abs(step) >= abs(distance):
+            self.position = float(self.target)
+        else:
+            self.position += step
+
+
+class ArduinoEmulator:
+    """ Emulates an Arduino running arduino_serialCOM_v0.1 behind a pseudo-terminal
+
+    Parameters
+    ----------
+    baudrate : int
+        Baudrate of the emulated link, limits the bytes per second in both directions
+    latency : float
+        One way latency of the link in seconds (USB frames, driver buffering)
+    drop_rate : float
+        Probability for every byte sent to the board to be lost
+    telemetry_interval : float
+        Seconds between two POS lines until the host sets it with the TELEMETRY command
+    boot_delay : float
+        Seconds after start() / reset() until the ready banner is printed
+    loop_rate : float
+        loop() iterations per second, the firmware reads one byte per iteration
+    """
+
+    def __init__(self, baudrate=230400, latency=0.0, drop_rate=0.0, telemetry_interval=0.2,
+                 boot_delay=1.0, loop_rate=20000, tick=0.001, seed=None):
+        self.bytes_per_second = baudrate / 10.0
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.telemetry_interval = telemetry_interval
+        self.boot_delay = boot_delay
+        self.loop_rate = loop_rate
+        self.tick = tick
+        self.random = random.Random(seed)
+
+        self.master = None
+        self.port = None
+        self.port_open = False
+        self.thread = None
+        self.runs = False
+        self.lock = threading.RLock()
+
+        # Dispatch table of executeThisFunction()
+        self.functions = {
+            'STOP': self.stop_all,
+            'SETTING': self.update_settings,
+            'RUN': self.run_few,
+            'PAUSE': self.pause_run,
+            'RESUME': self.resume_run,
+            'ZERO': self.zero,
+            'BINARY': self.binary,
+            'TELEMETRY': self.set_telemetry,
+            'QUEUE': self.enqueue_move,
+            'CLEAR': self.clear_queues,
+            'STATUS': self.send_queue_status,
+        }
+
+        self.reset()
+
+    # ==========================
+    # LIFECYCLE : pty and thread
+    # ==========================
+    def start(self):
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(slave)
+        # Only the host keeps the slave side open, so opening and closing the port can be told apart
+        os.close(slave)
+        self.port_open = False
+
+        self.reset()
+        self.runs = True
+        self.thread = threading.Thread(target=self.emulator_loop, name='ArduinoEmulator', daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.runs = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset(self):
+        """ Emulates a reset of the board, e.g. triggered by DTR when the host opens the port """
+        with self.lock:
+            now = time.monotonic()
+            self.steppers = [EmulatedStepper(), EmulatedStepper(), EmulatedStepper()]
+            self.motors_enabled = False
+            self.paused = False
+
+            # Move queue: (target, speed, segment) per channel
+            self.queues = [deque(), deque(), deque()]
+            self.queue_running = [False, False, False]
+            self.running_segment = [0, 0, 0]
+
+            # Periodic waveforms: steps per slot, slot duration in s, start of the current slot
+            self.wave_steps = [[0] * WAVE_LENGTH for _ in range(3)]
+            self.wave_count = [0, 0, 0]
+            self.wave_slot = [0.0, 0.0, 0.0]
+            self.wave_active = [False, False, False]
+            self.wave_index = [0, 0, 0]
+            self.wave_slot_start = [now, now, now]
+            self.wave_cycles = [0, 0, 0]
+            self.wave_target = [0, 0, 0]
+
+            # Ratio lock: lead channel, followers, start positions and distances of the locked MOVE
+            self.lock_lead = None
+            self.lock_follower = [False, False, False]
+            self.lock_start = [0, 0, 0]
+            self.lock_distance = [0, 0, 0]
+            self.lock_max_speed = [0.0, 0.0, 0.0]
+
+            # Link state
+            self.rx_line = deque()
+            self.rx_buffer = deque()
+            self.rx_free_at = now
+            self.tx_line = deque()
+            self.tx_free_at = now
+            self.busy_until = now
+
+            # Firmware state
+            self.input_buffer = bytearray()
+            self.read_in_progress = False
+            self.binary_mode = False
+            self.binary_frame = None
+            self.booted_at = now + self.boot_delay
+            self.booted = False
+            self.started_at = now
+            self.last_run = now
+            self.next_telemetry = self.booted_at
+            self.current_telemetry_interval = self.telemetry_interval
+            self.telemetry_on_change = False
+            self.reported_telemetry = None
+
+            # Statistics
+            self.bytes_received = 0
+            self.bytes_dropped = 0
+            self.bytes_overrun = 0
+            self.bytes_sent = 0
+            self.commands_parsed = 0
+            self.time_stalled = 0.0
+
+    def emulator_loop(self):
+        while self.runs:
+            if self.port_open:
+                select.select([self.master], [], [], self.tick)
+            else:
+                # The closed port always selects as readable
+                time.sleep(self.tick)
+            with self.lock:
+                self.step(time.monotonic())
+
+    def step(self, now):
+        """ Advances the emulation to now """
+        self.receive(now)
+        self.transmit(now)
+
+        if now < self.booted_at:
+            return
+        if not self.booted:
+            self.booted = True
+            self.print_line("EN Pin to HIGH")
+            self.print_line("<Arduino Board is ready>")
+
+        # The steppers are stalled as long as loop() is blocked in Serial.print()
+        if now > self.busy_until:
+            dt = now - max(self.last_run, self.busy_until)
+            # Like AccelStepper the positions keep counting when the drivers are disabled
+            if not self.paused:
+                self.service_queues()
+                self.service_waves(now)
+                self.service_lock()
+                for stepper, wave_active, lock_follower in zip(self.steppers, self.wave_active, self.lock_follower):
+                    if wave_active or lock_follower:
+                        stepper.run_speed_to_position(dt)
+                    else:
+                        stepper.run(dt)
+            self.time_stalled += max(0.0, min(self.busy_until, now) - self.last_run)
+            self.last_run = now
+
+        # loop() reads a single byte per iteration
+        budget = max(1, int(self.loop_rate * self.tick))
+        while self.rx_buffer and budget > 0 and now >= self.busy_until:
+            self.read_byte(self.rx_buffer.popleft())
+            budget -= 1
+
+        if self.current_telemetry_interval > 0 and now >= self.next_telemetry and now >= self.busy_until:
+            self.next_telemetry = max(self.next_telemetry + self.current_telemetry_interval, now)
+            self.send_telemetry(now)
+
+    # ================
+    # LINK : emulation
+    # ================
+    def receive(self, now):
+        # Bytes written by the host arrive one by one at the baudrate, after the link latency
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            data = b''
+        except OSError:
+            # EIO, the port is not open
+            self.port_open = False
+            return
+
+        if not self.port_open:
+            # Opening the port toggles DTR, which resets the board
+            self.port_open = True
+            self.reset()
+
+        for byte in data:
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.bytes_dropped += 1
+                continue
+            self.rx_free_at = max(self.rx_free_at, now + self.latency) + 1.0 / self.bytes_per_second
+            self.rx_line.append((self.rx_free_at, byte))
+
+        # Bytes arriving at a full hardware buffer are lost
+        while self.rx_line and self.rx_line[0][0] <= now:
+            _, byte = self.rx_line.popleft()
+            self.bytes_received += 1
+            if len(self.rx_buffer) < BUFFER_SIZE:
+                self.rx_buffer.append(byte)
+            else:
+                self.bytes_overrun += 1
+
+    def transmit(self, now):
+        while self.tx_line and self.tx_line[0][0] <= now:
+            _, data = self.tx_line.popleft()
+            try:
+                os.write(self.master, data)
+                self.bytes_sent += len(data)
+            except (BlockingIOError, OSError):
+                # Nobody reads from the port, the output is lost
+                pass
+
+    def print_line(self, text):
+        """ Serial.println(): queues the bytes for transmission, stalls the loop while the TX buffer is full """
+        now = time.monotonic()
+        data = (text + '\r\n').encode('ascii')
+        self.tx_free_at = max(self.tx_free_at, now) + len(data) / self.bytes_per_second
+        self.tx_line.append((self.tx_free_at + self.latency, data))
+        self.busy_until = max(self.busy_until, self.tx_free_at - BUFFER_SIZE / self.bytes_per_second)
+
+    # ===================
+    # FIRMWARE : protocol
+    # ===================
+    def read_byte(self, byte):
+        """ getDataFromPC() """
+        if self.binary_frame is not None:
+            self.binary_frame.append(byte)
+            if len(self.binary_frame) < BINARY_HEADER.size:
+                return
+            size = binary_frame_size(self.binary_frame)
+            if size is None:
+                # Corrupted length, wait for the next sync byte
+                self.binary_frame = None
+            elif len(self.binary_frame) == size:
+                frame, self.binary_frame = bytes(self.binary_frame), None
+                self.parse_binary_frame(frame)
+            return
+
+        if self.binary_mode and not self.read_in_progress and byte == BINARY_SYNC:
+            self.binary_frame = bytearray([byte])
+            return
+
+        if byte == ord('>'):
+            self.read_in_progress = False
+            self.parse_data(self.input_buffer.decode('ascii', 'replace'))
+            return
+
+        if self.read_in_progress:
+            if len(self.input_buffer) < BUFFER_SIZE - 1:
+                self.input_buffer.append(byte)
+            else:
+                self.input_buffer[-1] = byte
+
+        if byte == ord('<'):
+            self.input_buffer = bytearray()
+            self.read_in_progress = True
+
+    def parse_data(self, message):
+        """ parseData() including its debug output and the replyToPC() acknowledgement """
+        if message.startswith('MOVE,'):
+            _, motor_string, specs = (message.split(',', 2) + ['', ''])[:3]
+            self.parse_move(specs)
+            self.print_line(f"<mode: MOVE ,setting: {motor_string} >")
+            self.commands_parsed += 1
+            return
+        if message.startswith('WAVE,'):
+            _, motor_string, specs = (message.split(',', 2) + ['', ''])[:3]
+            self.parse_wave(motor_string, specs)
+            self.print_line(f"<mode: WAVE ,setting: {motor_string} >")
+            self.commands_parsed += 1
+            return
+
+        # strtok() skips empty fields
+        fields = [field for field in message.split(',') if field] + [''] * 8
+        mode, setting, motor_string, value, direction = fields[:5]
+        value = float_or_zero(value)
+        optionals = [float_or_zero(field) for field in fields[5:8]]
+
+        motors = [str(i + 1) in motor_string for i in range(3)]
+        motor_id = int_or_zero(motor_string)
+
+        self.print_line("string")
+        self.print_line(motor_string)
+        self.print_line("Status")
+        for motor in motors:
+            self.print_line(str(int(motor)))
+
+        distances = list(optionals)
+        if setting == 'RUN':
+            distances = [999999.0] * 3
+
+        self.print_line("Status Distances")
+        for distance in distances:
+            self.print_line(f"{distance:.2f}")
+
+        milliseconds = int((time.monotonic() - self.started_at) * 1000)
+        self.print_line(f"<mode: {mode} ,setting: {setting} ,motorID: {motor_id} ,value: {value:.2f} "
+                        f",direction: {direction} ,p1 optional: {optionals[0]:.2f} "
+                        f",p2 optional: {optionals[1]:.2f} ,p3 optional: {optionals[2]:.2f} "
+                        f",Time {milliseconds >> 9}>")
+        self.commands_parsed += 1
+
+        function = self.functions.get(mode)
+        if function is not None:
+            function(setting, motors, motor_id, value, direction, distances)
+
+    def parse_move(self, specs):
+        """ parseMove() """
+        targets = {}
+        channel = None
+        locked = False
+        self.release_lock()
+        for token in specs.split():
+            if token[0] == 'l':
+                locked = True
+                continue
+            if token[0] == 'c':
+                channel = int_or_zero(token[1:]) - 1
+                if not 0 <= channel <= 2:
+                    channel = None
+                    continue
+                targets[channel] = self.steppers[channel].target
+                continue
+            if channel is None:
+                continue
+
+            stepper = self.steppers[channel]
+            number = float_or_zero(token[1:])
+            if token[0] == 'p':
+                targets[channel] = int(number)
+            elif token[0] == 'd':
+                targets[channel] = stepper.current_position() + int(number)
+            elif token[0] == 's' and number > 0:
+                stepper.set_max_speed(number)
+            elif token[0] == 'a' and number > 0:
+                stepper.set_acceleration(number)
+
+        for channel, target in targets.items():
+            self.steppers[channel].move_to(target)
+        if locked:
+            self.start_lock(targets)
+
+    def start_lock(self, moving):
+        """ startLock() """
+        lead = None
+        for i in sorted(moving):
+            self.lock_start[i] = self.steppers[i].current_position()
+            self.lock_distance[i] = self.steppers[i].target - self.lock_start[i]
+            if lead is None or abs(self.lock_distance[i]) > abs(self.lock_distance[lead]):
+                lead = i
+        if lead is None or self.lock_distance[lead] == 0:
+            return
+
+        self.lock_lead = lead
+        for i in moving:
+            if i != lead:
+                stepper = self.steppers[i]
+                self.lock_follower[i] = True
+                self.lock_max_speed[i] = stepper.max_speed
+                stepper.set_max_speed(2 * self.steppers[lead].max_speed)
+                stepper.move_to(self.lock_start[i])
+
+    def release_lock(self):
+        """ releaseLock() """
+        for i in range(3):
+            if self.lock_follower[i]:
+                self.lock_follower[i] = False
+                self.steppers[i].set_max_speed(self.lock_max_speed[i])
+        self.lock_lead = None
+
+    def service_lock(self):
+        """ serviceLock(): moves the followers to the share of the distance the lead covered so far """
+        if self.lock_lead is None:
+            return
+        lead = self.steppers[self.lock_lead]
+        progress = (lead.current_position() - self.lock_start[self.lock_lead]) / self.lock_distance[self.lock_lead]
+        settled = not lead.is_running()
+        for i, stepper in enumerate(self.steppers):
+            if not self.lock_follower[i]:
+                continue
+            target = self.lock_start[i] + int(round(progress * self.lock_distance[i]))
+            if target != stepper.target:
+                stepper.move_to(target)
+                stepper.set_speed(stepper.max_speed)
+            settled = settled and stepper.distance_to_go() == 0
+        if settled:
+            for i, stepper in enumerate(self.steppers):
+                if self.lock_follower[i]:
+                    stepper.set_current_position(stepper.current_position())
+            self.release_lock()
+
+    def parse_wave(self, motor_string, specs):
+        """ parseWave() """
+        selected = [str(i + 1) in motor_string for i in range(3)]
+        index = 0
+        for token in specs.split():
+            if token[0] == '-' or token[0].isdigit():
+                for i in range(3):
+                    if selected[i] and index < WAVE_LENGTH:
+                        self.wave_steps[i][index] = int_or_zero(token)
+                index += 1
+                continue
+
+            number = int_or_zero(token[1:])
+            if token[0] == 'i':
+                index = number
+            for i in range(3):
+                if not selected[i]:
+                    continue
+                if token[0] == 't':
+                    self.wave_slot[i] = number / 1000.0
+                elif token[0] == 'n':
+                    self.wave_count[i] = min(number, WAVE_LENGTH)
+                elif token[0] == 'r':
+                    self.start_wave(i, number)
+
+        now = time.monotonic()
+        for i in range(3):
+            if selected[i] and self.wave_active[i]:
+                self.wave_slot_start[i] = now
+
+    def start_wave(self, channel, cycles):
+        """ startWave() """
+        if self.wave_count[channel] == 0 or self.wave_slot[channel] == 0:
+            return
+        fastest = max(abs(steps) for steps in self.wave_steps[channel][:self.wave_count[channel]])
+        stepper = self.steppers[channel]
+        stepper.set_max_speed(max(1.0, fastest / self.wave_slot[channel]))
+
+        self.queues[channel].clear()
+        self.release_lock()
+        self.wave_cycles[channel] = cycles
+        self.wave_index[channel] = 0
+        self.wave_target[channel] = stepper.current_position()
+        self.wave_active[channel] = True
+        self.start_wave_slot(channel)
+
+    def start_wave_slot(self, channel):
+        """ startWaveSlot() """
+        steps = self.wave_steps[channel][self.wave_index[channel]]
+        self.wave_target[channel] += steps
+        self.steppers[channel].move_to(self.wave_target[channel])
+        self.steppers[channel].set_speed(steps / self.wave_slot[channel])
+
+    def service_waves(self, now):
+        """ serviceWaves(): advances every active waveform to its next slot once the current one is over """
+        for i in range(3):
+            if not self.wave_active[i] or now - self.wave_slot_start[i] < self.wave_slot[i]:
+                continue
+            self.wave_slot_start[i] += self.wave_slot[i]
+            self.wave_index[i] += 1
+            if self.wave_index[i] == self.wave_count[i]:
+                self.wave_index[i] = 0
+                if self.wave_cycles[i] > 0:
+                    self.wave_cycles[i] -= 1
+                    if self.wave_cycles[i] == 0:
+                        self.wave_active[i] = False
+                        continue
+            self.start_wave_slot(i)
+
+    def resume_waves(self):
+        """ resumeWaves() """
+        self.wave_slot_start = [time.monotonic()] * 3
+
+    def parse_binary_frame(self, frame):
+        """ parseBinaryFrame() """
+        try:
+            opcode, sequence, mask, steps, speeds, accelerations = decode_binary_frame(frame)
+        except ValueError:
+            self.print_line(f"?{frame[2]}")
+            return
+        self.commands_parsed += 1
+
+        if opcode == OP_ENABLE:
+            self.motors_enabled = bool(steps[0])
+        elif opcode == OP_PAUSE:
+            self.pause_run(None, None, None, None, None, None)
+        elif opcode == OP_RESUME:
+            self.paused = False
+            self.resume_waves()
+        elif opcode == OP_ASCII:
+            self.binary_mode = False
+        elif opcode == OP_TELEMETRY:
+            self.set_telemetry(None, None, None, steps[0], None, [steps[1], 0, 0])
+
+        for i, stepper in enumerate(self.steppers):
+            if not mask & (1 << i):
+                continue
+            if opcode in (OP_RUN, OP_SETTING):
+                if speeds[i]:
+                    stepper.set_max_speed(speeds[i])
+                if accelerations[i]:
+                    stepper.set_acceleration(accelerations[i])
+                if opcode == OP_RUN:
+                    stepper.move_to(steps[i])
+            elif opcode == OP_STOP:
+                self.queues[i].clear()
+                self.wave_active[i] = False
+                stepper.stop()
+            elif opcode == OP_ZERO:
+                stepper.set_current_position(0)
+
+        self.print_line(f"#{sequence}")
+
+    def send_telemetry(self, now):
+        """ sendTelemetry() """
+        telemetry = [value for stepper in self.steppers for value in (stepper.current_position(), stepper.distance_to_go())]
+        telemetry += [len(queue) for queue in self.queues]
+        if self.telemetry_on_change and telemetry == self.reported_telemetry:
+            return
+        self.reported_telemetry = telemetry
+
+        milliseconds = int((now - self.started_at) * 1000)
+        self.print_line("POS p1:{} r1:{} p2:{} r2:{} p3:{} r3:{}".format(*telemetry[:6]) + f" t:{milliseconds} "
+                        "q1:{} q2:{} q3:{}".format(*telemetry[6:]))
+
+    # ====================
+    # FIRMWARE : functions
+    # ====================
+    def stop_all(self, setting, motors, motor_id, value, direction, distances):
+        for i, (stepper, queue) in enumerate(zip(self.steppers, self.queues)):
+            queue.clear()
+            self.wave_active[i] = False
+            stepper.stop()
+
+    def update_settings(self, setting, motors, motor_id, value, direction, distances):
+        if setting == 'ENABLE':
+            self.motors_enabled = bool(value)
+        elif 1 <= motor_id <= 3:
+            stepper = self.steppers[motor_id - 1]
+            if setting == 'SPEED':
+                stepper.set_max_speed(value)
+            elif setting == 'ACCEL':
+                stepper.set_acceleration(value)
+
+    def run_few(self, setting, motors, motor_id, value, direction, distances):
+        sign = -1 if direction == 'B' else 1
+        self.print_line(f"Direction{sign}")
+        self.print_line("Status Distances")
+        for distance in distances:
+            self.print_line(f"{distance:.2f}")
+
+        for stepper, motor, distance in zip(self.steppers, motors, distances):
+            if motor:
+                self.print_line(f"Sending stepper.moveTo command: {sign * distance:.2f}")
+                stepper.move_to(sign * distance)
+
+    def pause_run(self, setting, motors, motor_id, value, direction, distances):
+        """ pauseRun(), loop() skips stepping, the steppers keep their speed """
+        self.paused = True
+
+    def resume_run(self, setting, motors, motor_id, value, direction, distances):
+        self.paused = False
+        self.resume_waves()
+
+    def binary(self, setting, motors, motor_id, value, direction, distances):
+        self.binary_mode = bool(value)
+        self.print_line(f"PROTOCOL BINARY {int(self.binary_mode)}")
+
+    def set_telemetry(self, setting, motors, motor_id, value, direction, distances):
+        self.current_telemetry_interval = value / 1000.0
+        self.telemetry_on_change = distances[0] != 0
+        self.reported_telemetry = None
+        self.next_telemetry = time.monotonic()
+
+    def enqueue_move(self, setting, motors, motor_id, value, direction, distances):
+        for channel, (motor, queue) in enumerate(zip(motors, self.queues)):
+            if not motor:
+                continue
+            if len(queue) == QUEUE_LENGTH:
+                self.print_line(f"QUEUE FULL {channel + 1}")
+                continue
+            queue.append((int(distances[channel]), value, int_or_zero(setting) & 0xFF))
+
+    def clear_queues(self, setting, motors, motor_id, value, direction, distances):
+        for motor, queue in zip(motors, self.queues):
+            if motor:
+                queue.clear()
+
+    def send_queue_status(self, setting, motors, motor_id, value, direction, distances):
+        self.print_line("QUEUE q1:{} q2:{} q3:{}".format(*[len(queue) for queue in self.queues]))
+
+    def service_queues(self):
+        """ serviceQueues(): starts the next move of idle channels unless an earlier segment is not done """
+        for i, stepper in enumerate(self.steppers):
+            if self.queue_running[i] and not stepper.is_running():
+                self.queue_running[i] = False
+
+        for i, (stepper, queue) in enumerate(zip(self.steppers, self.queues)):
+            if not queue or stepper.is_running() or self.wave_active[i] or self.lock_follower[i]:
+                continue
+            target, speed, segment = queue[0]
+
+            blocked = False
+            for j in range(3):
+                if j == i:
+                    continue
+                if self.queue_running[j] and segment_before(self.running_segment[j], segment):
+                    blocked = True
+                if self.queues[j] and segment_before(self.queues[j][0][2], segment):
+                    blocked = True
+            if blocked:
+                continue
+
+            queue.popleft()
+            stepper.set_max_speed(speed)
+            stepper.move_to(target)
+            self.queue_running[i] = True
+            self.running_segment[i] = segment
+
+    def zero(self, setting, motors, motor_id, value, direction, distances):
+        for stepper, motor in zip(self.steppers, motors):
+            if motor:
+                stepper.set_current_position(0)
+
+    # ==========
+    # INSPECTION
+    # ==========
+    def positions(self):
+        with self.lock:
+            return [stepper.current_position() for stepper in self.steppers]
+
+    def statistics(self):
+        with self.lock:
+            return {
+                'bytes-received': self.bytes_received,
+                'bytes-dropped': self.bytes_dropped,
+                'bytes-overrun': self.bytes_overrun,
+                'bytes-sent': self.bytes_sent,
+                'commands-parsed': self.commands_parsed,
+                'time-stalled': self.time_stalled,
+            }
+
+
+def segment_before(a, b):
+    """ Segment numbers wrap around at 256, a is earlier than b if it is less than half the range behind """
+    return (a - b) & 0xFF >= 0x80
+
+
+def float_or_zero(text):
+    """ atof(): leading number of the text or 0.0 """
+    try:
+        return float(text)
+    except ValueError:
+        return 0.0
+
+
+def int_or_zero(text):
+    """ atoi(): leading digits of the text or 0 """
+    digits = ''
+    for character in text.strip():
+        if not character.isdigit():
+            break
+        digits += character
+    return int(digits) if digits else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulated Poseidon Arduino board on a pseudo-terminal')
+    parser.add_argument('--baudrate', type=int, default=230400)
+    parser.add_argument('--latency', type=float, default=0.0, help='One way link latency in seconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Probability of a byte to be lost')
+    parser.add_argument('--telemetry-interval', type=float, default=0.2)
+    args = parser.parse_args()
+
+    emulator = ArduinoEmulator(args.baudrate, args.latency, args.drop_rate, args.telemetry_interval)
+    port = emulator.start()
+    print(f"Emulator> Listening on {port}")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"Emulator> {emulator.statistics()}")
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -91,6 +91,30 @@
 
 #define BAUD_RATE 230400  // the rate at which data is read
 
+// Binary protocol, see serial_commands.py for the frame layout
+#define BINARY_SYNC 0xA5
+#define BINARY_HEADER_SIZE 5
+#define BINARY_CHANNEL_SIZE 10
+#define BINARY_MAX_PAYLOAD 30
+#define BINARY_FRAME_SIZE (BINARY_HEADER_SIZE + BINARY_MAX_PAYLOAD + 2)
+#define BINARY_SPEED_SCALE 65536.0
+
+#define OP_RUN      0x01
+#define OP_SETTING  0x02
+#define OP_STOP     0x03
+#define OP_PAUSE    0x04
+#define OP_RESUME   0x05
+#define OP_ZERO     0x06
+#define OP_ENABLE   0x07
+#define OP_TELEMETRY 0x08
+#define OP_ASCII    0x7F
+
+// Moves which can wait on the board per channel, see serviceQueues()
+#define QUEUE_LENGTH 8
+
+// Slots of the periodic waveform table per channel, see serviceWaves()
+#define WAVE_LENGTH 32
+
 // AccelStepper is the class we use to run all of the motors in a parallel fashion
 // Documentation can be found here: http://www.airspayce.com/mikem/arduino/AccelStepper/classAccelStepper.html
 AccelStepper stepper1(AccelStepper::DRIVER, X_STP, X_DIR);
@@ -112,6 +136,13 @@ byte bytesRecvd = 0;
 boolean readInProgress = false;
 boolean newDataFromPC = false;
 
+// Binary frames are only accepted after the PC switched to binary mode with <BINARY,ON,0,1,F,0.0,0.0,0.0>
+boolean binaryMode = false;
+boolean binaryInProgress = false;
+byte binaryFrame[BINARY_FRAME_SIZE];
+byte binaryBytesRecvd = 0;
+boolean paused = false;
+
 // WRITE COMMAND: <RUN,DIST,123,F,0.0,0.0,0.0>
 // The following is data we will read from the PC. Since the USB reads one byte at a time, we have to store a
 // string of bytes in an array called messageFromPC. Then we can grab the relevant information from it.
@@ -129,7 +160,6 @@ char messageFromPC[buffSize] = {0};
 char mode[buffSize] = {0};
 int motorID = 0;
 int motors[3] = {0,0,0};
-AccelStepper steppers[3] = {stepper1, stepper2, stepper3};
 char setting[buffSize] = {0};
 float value = 0.0;
 char dir[buffSize] = {0};
@@ -164,15 +194,49 @@ signed long p3_distance_to_go;
 signed long p3_target_position;
 signed long p3_distance_left;
 
-signed long distances_to_go[3];
-signed long targets_position[3];
-signed long distances_left[3];
-
 unsigned long curMillis;
 unsigned long prevReplyToPCmillis = 0;
 unsigned long replyToPCinterval = 1000;
 
-int feedbackCounter = 10000;
+// POS telemetry is sent every telemetryInterval ms (0 = never). With telemetryOnChange only if a value changed.
+unsigned long telemetryInterval = 200;
+boolean telemetryOnChange = false;
+unsigned long prevTelemetryMillis = 0;
+long reportedTelemetry[9];
+
+// On-board move queue: a ring buffer of moves per channel which are started back-to-back without
+// waiting for the PC. Every move belongs to a segment, moves of the same segment start together and
+// a move only starts once no channel is still busy with (or waiting for) an earlier segment.
+struct QueuedMove {
+  long target;
+  float speed;
+  byte segment;
+};
+
+QueuedMove moveQueue[3][QUEUE_LENGTH];
+byte queueHead[3] = {0, 0, 0};
+byte queueCount[3] = {0, 0, 0};
+boolean queueRunning[3] = {false, false, false};
+byte runningSegment[3] = {0, 0, 0};
+
+// Periodic flow: one period of a waveform as steps per slot, uploaded once with WAVE commands and
+// replayed at constant speed without the PC. Targets are accumulated, so rounding never drifts.
+int waveSteps[3][WAVE_LENGTH];
+byte waveCount[3] = {0, 0, 0};
+unsigned int waveSlotMillis[3] = {0, 0, 0};
+boolean waveActive[3] = {false, false, false};
+byte waveIndex[3] = {0, 0, 0};
+unsigned long waveSlotStart[3] = {0, 0, 0};
+unsigned long waveCycles[3] = {0, 0, 0};
+long waveTarget[3] = {0, 0, 0};
+
+// Ratio-locked moves: the followers of a locked MOVE are slaved to the progress of its lead channel,
+// the one with the longest move, so the ratios of their distances hold through acceleration and stops
+int lockLead = -1;
+boolean lockFollower[3] = {false, false, false};
+long lockStart[3] = {0, 0, 0};
+long lockDistance[3] = {0, 0, 0};
+float lockMaxSpeed[3] = {0.0, 0.0, 0.0};
 
 //=============
 // Setup is only called once. When we start up the GUI the Arduino initalizes with a BAUD Rate of _________
@@ -213,30 +277,75 @@ void setup() {
 // The loop function is what is always running and refreshes BAUD_RATE times per second
 void loop() {
   curMillis = millis();
-  stepper1.run();
-  stepper2.run();
-  stepper3.run();
+  if (!paused) {
+    AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+    serviceQueues();
+    serviceWaves();
+    serviceLock();
+    for (int i = 0; i < 3; i += 1) {
+      // waveform slots and lock followers run at constant speed, everything else with acceleration
+      if (waveActive[i] || lockFollower[i]) {
+        steppers[i]->runSpeedToPosition();
+      } else {
+        steppers[i]->run();
+      }
+    }
+  }
   getDataFromPC();
 
-  if (feedbackCounter > 9999){
-    Serial.print("POS p1:");
-    Serial.print(stepper1.currentPosition());
-    Serial.print(" r1:");
-    Serial.print(stepper1.distanceToGo());
-    Serial.print(" p2:");
-    Serial.print(stepper2.currentPosition());
-    Serial.print(" r2:");
-    Serial.print(stepper2.distanceToGo());
-    Serial.print(" p3:");
-    Serial.print(stepper3.currentPosition());
-    Serial.print(" r3:");
-    Serial.println(stepper3.distanceToGo());
-    feedbackCounter = 0;
-  } else {
-    feedbackCounter++;
+  if (telemetryInterval > 0 && curMillis - prevTelemetryMillis >= telemetryInterval) {
+    prevTelemetryMillis = curMillis;
+    sendTelemetry();
   }
 }
 
+//=============
+// Reports position and distance to go of all steppers, together with the millis() timestamp of the report
+// and the number of queued moves which did not start yet:
+// POS p1:<pos> r1:<togo> p2:<pos> r2:<togo> p3:<pos> r3:<togo> t:<millis> q1:<queued> q2:<queued> q3:<queued>
+void sendTelemetry() {
+  long telemetry[9] = {
+    stepper1.currentPosition(), stepper1.distanceToGo(),
+    stepper2.currentPosition(), stepper2.distanceToGo(),
+    stepper3.currentPosition(), stepper3.distanceToGo(),
+    queueCount[0], queueCount[1], queueCount[2]
+  };
+
+  if (telemetryOnChange && memcmp(telemetry, reportedTelemetry, sizeof(telemetry)) == 0) {
+    return;
+  }
+  memcpy(reportedTelemetry, telemetry, sizeof(telemetry));
+
+  Serial.print("POS p1:");
+  Serial.print(telemetry[0]);
+  Serial.print(" r1:");
+  Serial.print(telemetry[1]);
+  Serial.print(" p2:");
+  Serial.print(telemetry[2]);
+  Serial.print(" r2:");
+  Serial.print(telemetry[3]);
+  Serial.print(" p3:");
+  Serial.print(telemetry[4]);
+  Serial.print(" r3:");
+  Serial.print(telemetry[5]);
+  Serial.print(" t:");
+  Serial.print(curMillis);
+  Serial.print(" q1:");
+  Serial.print(telemetry[6]);
+  Serial.print(" q2:");
+  Serial.print(telemetry[7]);
+  Serial.print(" q3:");
+  Serial.println(telemetry[8]);
+}
+
+// Sets the telemetry interval in ms and whether only changed positions are reported
+void setTelemetry(unsigned long interval, boolean onChange) {
+  telemetryInterval = interval;
+  telemetryOnChange = onChange;
+  // make sure the next report goes out even if nothing changed
+  reportedTelemetry[0] = stepper1.currentPosition() + 1;
+}
+
 //=============
 // Here we get data from the serial port, read it one byte at a time, store each subsequent byte in the buffer (list)
 // then read it and declare the values to variables in this code
@@ -249,6 +358,31 @@ void getDataFromPC() {
     // read the a single character
     char x = Serial.read();
 
+    // binary frames announce their payload length in the header, collect them without looking at the rest
+    if (binaryInProgress) {
+      binaryFrame[binaryBytesRecvd] = x;
+      binaryBytesRecvd ++;
+      if (binaryBytesRecvd < BINARY_HEADER_SIZE) {
+        return;
+      }
+      if (binaryFrame[4] > BINARY_MAX_PAYLOAD) {
+        // corrupted length, wait for the next sync byte
+        binaryInProgress = false;
+      }
+      else if (binaryBytesRecvd == BINARY_HEADER_SIZE + binaryFrame[4] + 2) {
+        binaryInProgress = false;
+        parseBinaryFrame();
+      }
+      return;
+    }
+
+    if (binaryMode && !readInProgress && (byte) x == BINARY_SYNC) {
+      binaryFrame[0] = x;
+      binaryBytesRecvd = 1;
+      binaryInProgress = true;
+      return;
+    }
+
     // the order of these IF clauses is significant
     if (x == endMarker) {
       readInProgress = false;
@@ -303,6 +437,26 @@ void parseData() {
   strtokIndx = strtok(NULL, ",");            // get the second part - the setting string
   strcpy(setting, strtokIndx);               // copy it to messageFromPC
 
+  // <MOVE,<motors>,c<channel> p<target> s<speed> a<accel> ...> carries everything in one command and
+  // is acknowledged without the debug output
+  if (strcmp(mode, "MOVE") == 0) {
+    parseMove(strtok(NULL, ""));
+    Serial.print("<mode: MOVE ,setting: ");
+    Serial.print(setting);
+    Serial.println(" >");
+    return;
+  }
+
+  // <WAVE,<motors>,t<slot ms> n<slots> i<index> <steps> <steps> ... r<cycles>> uploads and starts waveforms,
+  // acknowledged like MOVE
+  if (strcmp(mode, "WAVE") == 0) {
+    parseWave(setting, strtok(NULL, ""));
+    Serial.print("<mode: WAVE ,setting: ");
+    Serial.print(setting);
+    Serial.println(" >");
+    return;
+  }
+
 
   strtokIndx = strtok(NULL, ",");            // get the third part - the motor ID int
   String motorstr(strtokIndx);
@@ -364,6 +518,150 @@ void parseData() {
   return executeThisFunction();
   }
 
+// Reads the channel specs of a MOVE command. p is an absolute target, d a distance from the current
+// position, s the max speed and a the acceleration. Speed and acceleration are kept if not given.
+// A single l token locks the channels of the command to the ratio of their distances.
+void parseMove(char * specs) {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+  long targets[3];
+  boolean moving[3] = {false, false, false};
+  boolean locked = false;
+  int channel = -1;
+
+  if (specs == NULL) {
+    return;
+  }
+
+  // Every MOVE ends the previous lock
+  releaseLock();
+
+  for (char * token = strtok(specs, " "); token != NULL; token = strtok(NULL, " ")) {
+    if (token[0] == 'l') {
+      locked = true;
+      continue;
+    }
+    if (token[0] == 'c') {
+      channel = atoi(token + 1) - 1;
+      if (channel < 0 || channel > 2) {
+        channel = -1;
+        continue;
+      }
+      moving[channel] = true;
+      targets[channel] = steppers[channel]->targetPosition();
+      continue;
+    }
+    if (channel < 0) {
+      continue;
+    }
+
+    float number = atof(token + 1);
+    switch (token[0]) {
+      case 'p':
+        targets[channel] = atol(token + 1);
+        break;
+      case 'd':
+        targets[channel] = steppers[channel]->currentPosition() + atol(token + 1);
+        break;
+      case 's':
+        if (number > 0) {
+          steppers[channel]->setMaxSpeed(number);
+        }
+        break;
+      case 'a':
+        if (number > 0) {
+          steppers[channel]->setAcceleration(number);
+        }
+        break;
+    }
+  }
+
+  // The targets are set once the whole command was read, so all channels start in the same loop()
+  for (int i = 0; i < 3; i += 1) {
+    if (moving[i]) {
+      steppers[i]->moveTo(targets[i]);
+    }
+  }
+
+  if (locked) {
+    startLock(moving);
+  }
+}
+
+// Slaves the moving channels to the one with the longest move
+void startLock(boolean * moving) {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+  int lead = -1;
+  for (int i = 0; i < 3; i += 1) {
+    if (!moving[i]) {
+      continue;
+    }
+    lockStart[i] = steppers[i]->currentPosition();
+    lockDistance[i] = steppers[i]->targetPosition() - lockStart[i];
+    if (lead < 0 || labs(lockDistance[i]) > labs(lockDistance[lead])) {
+      lead = i;
+    }
+  }
+  if (lead < 0 || lockDistance[lead] == 0) {
+    return;
+  }
+
+  lockLead = lead;
+  for (int i = 0; i < 3; i += 1) {
+    if (moving[i] && i != lead) {
+      // Followers never need to be faster than the lead, the margin keeps them within a step
+      lockFollower[i] = true;
+      lockMaxSpeed[i] = steppers[i]->maxSpeed();
+      steppers[i]->setMaxSpeed(2 * steppers[lead]->maxSpeed());
+      steppers[i]->moveTo(lockStart[i]);
+    }
+  }
+}
+
+void releaseLock() {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+  for (int i = 0; i < 3; i += 1) {
+    if (lockFollower[i]) {
+      lockFollower[i] = false;
+      steppers[i]->setMaxSpeed(lockMaxSpeed[i]);
+    }
+  }
+  lockLead = -1;
+}
+
+// Moves the followers of a locked MOVE to the share of the distance the lead covered so far
+void serviceLock() {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+  if (lockLead < 0) {
+    return;
+  }
+
+  float progress = (float) (steppers[lockLead]->currentPosition() - lockStart[lockLead]) / lockDistance[lockLead];
+  boolean settled = !steppers[lockLead]->isRunning();
+  for (int i = 0; i < 3; i += 1) {
+    if (!lockFollower[i]) {
+      continue;
+    }
+    long target = lockStart[i] + lround(progress * lockDistance[i]);
+    if (target != steppers[i]->targetPosition()) {
+      steppers[i]->moveTo(target);
+      // moveTo() recalculates the speed, follow at the full follower speed afterwards
+      steppers[i]->setSpeed(steppers[i]->maxSpeed());
+    }
+    settled = settled && steppers[i]->distanceToGo() == 0;
+  }
+
+  // The lead arrived or was stopped and all followers caught up. Reset the constant follower
+  // speed, run() would carry it past the target otherwise
+  if (settled) {
+    for (int i = 0; i < 3; i += 1) {
+      if (lockFollower[i]) {
+        steppers[i]->setCurrentPosition(steppers[i]->currentPosition());
+      }
+    }
+    releaseLock();
+  }
+}
+
 void clearVariables() {
   char messageFromPC[buffSize] = {0};
   char mode[buffSize] = {0};
@@ -400,12 +698,346 @@ void executeThisFunction() {
   }
 
   else if (strcmp(mode, "RESUME") == 0) {
-    return runFew();
+    return resumeRun();
   }
 
   else if (strcmp(mode, "ZERO") == 0) {
     return zero();
   }
+
+  else if (strcmp(mode, "TELEMETRY") == 0) {
+    return setTelemetry(value, p1_optional != 0);
+  }
+
+  else if (strcmp(mode, "QUEUE") == 0) {
+    // <QUEUE,<segment>,<motors>,<speed>,F,<target1>,<target2>,<target3>>
+    for (int i = 0; i < 3; i += 1) {
+      if (motors[i] == 1) {
+        enqueueMove(i, distances[i], value, atoi(setting));
+      }
+    }
+  }
+
+  else if (strcmp(mode, "CLEAR") == 0) {
+    for (int i = 0; i < 3; i += 1) {
+      if (motors[i] == 1) {
+        clearQueue(i);
+      }
+    }
+  }
+
+  else if (strcmp(mode, "STATUS") == 0) {
+    return sendQueueStatus();
+  }
+
+  else if (strcmp(mode, "BINARY") == 0) {
+    binaryMode = (value != 0);
+    Serial.print("PROTOCOL BINARY ");
+    Serial.println(binaryMode);
+  }
+}
+
+//=============
+// CRC-16/CCITT-FALSE, the same checksum the PC calculates with binascii.crc_hqx(data, 0xFFFF)
+uint16_t crc16(byte * data, byte len) {
+  uint16_t crc = 0xFFFF;
+  for (byte i = 0; i < len; i++) {
+    crc ^= (uint16_t) data[i] << 8;
+    for (byte bit = 0; bit < 8; bit++) {
+      if (crc & 0x8000) {
+        crc = (crc << 1) ^ 0x1021;
+      } else {
+        crc <<= 1;
+      }
+    }
+  }
+  return crc;
+}
+
+//=============
+// Executes a complete binary frame. Unlike parseData() this prints nothing but the short acknowledgement
+// "#<sequence>", or "?<sequence>" if the frame was corrupted on the way.
+void parseBinaryFrame() {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+
+  byte opcode = binaryFrame[1];
+  byte sequence = binaryFrame[2];
+  byte mask = binaryFrame[3];
+  byte length = binaryFrame[4];
+
+  boolean channelRecords = opcode == OP_RUN || opcode == OP_SETTING;
+  byte channels = ((mask >> 0) & 1) + ((mask >> 1) & 1) + ((mask >> 2) & 1);
+
+  uint16_t crc;
+  memcpy(&crc, &binaryFrame[BINARY_HEADER_SIZE + length], 2);
+  if (crc16(binaryFrame, BINARY_HEADER_SIZE + length) != crc
+      || (channelRecords && length != channels * BINARY_CHANNEL_SIZE)) {
+    Serial.print('?');
+    Serial.println(sequence);
+    return;
+  }
+
+  // AVR is little endian like the frame, so the fields can be copied directly
+  long steps[3] = {0, 0, 0};
+  uint32_t speeds[3] = {0, 0, 0};
+  uint16_t accels[3] = {0, 0, 0};
+  byte *payload = &binaryFrame[BINARY_HEADER_SIZE];
+  if (channelRecords) {
+    // a record per channel of the mask
+    for (int i = 0; i < 3; i += 1) {
+      if (mask & (1 << i)) {
+        memcpy(&steps[i], payload, 4);
+        memcpy(&speeds[i], payload + 4, 4);
+        memcpy(&accels[i], payload + 8, 2);
+        payload += BINARY_CHANNEL_SIZE;
+      }
+    }
+  }
+  else {
+    memcpy(steps, payload, min(length, (byte) 12));
+  }
+
+  switch (opcode) {
+    case OP_ENABLE:
+      digitalWrite(ENPin, !steps[0]);
+      break;
+    case OP_PAUSE:
+      paused = true;
+      break;
+    case OP_RESUME:
+      paused = false;
+      resumeWaves();
+      break;
+    case OP_ASCII:
+      binaryMode = false;
+      break;
+    case OP_TELEMETRY:
+      setTelemetry(steps[0], steps[1] != 0);
+      break;
+  }
+
+  for (int i = 0; i < 3; i += 1) {
+    if (!(mask & (1 << i))) {
+      continue;
+    }
+    switch (opcode) {
+      case OP_RUN:
+      case OP_SETTING:
+        if (speeds[i] != 0) {
+          steppers[i]->setMaxSpeed(speeds[i] / BINARY_SPEED_SCALE);
+        }
+        if (accels[i] != 0) {
+          steppers[i]->setAcceleration(accels[i]);
+        }
+        if (opcode == OP_RUN) {
+          steppers[i]->moveTo(steps[i]);
+        }
+        break;
+      case OP_STOP:
+        clearQueue(i);
+        waveActive[i] = false;
+        steppers[i]->stop();
+        break;
+      case OP_ZERO:
+        steppers[i]->setCurrentPosition(0);
+        break;
+    }
+  }
+
+  Serial.print('#');
+  Serial.println(sequence);
+}
+
+//=============
+// Adds a move to the queue of a channel (0..2). Full queues drop the move and report "QUEUE FULL <channel>",
+// the PC keeps track of the free slots from the telemetry so this should not happen.
+void enqueueMove(int channel, long target, float speed, byte segment) {
+  if (queueCount[channel] == QUEUE_LENGTH) {
+    Serial.print("QUEUE FULL ");
+    Serial.println(channel + 1);
+    return;
+  }
+  QueuedMove *move = &moveQueue[channel][(queueHead[channel] + queueCount[channel]) % QUEUE_LENGTH];
+  move->target = target;
+  move->speed = speed;
+  move->segment = segment;
+  queueCount[channel] ++;
+}
+
+// Drops the moves of a channel which did not start yet, a running move is not affected
+void clearQueue(int channel) {
+  queueHead[channel] = 0;
+  queueCount[channel] = 0;
+}
+
+// Segment numbers wrap around at 256, a is earlier than b if it is less than half the range behind
+boolean segmentBefore(byte a, byte b) {
+  return (int8_t) (a - b) < 0;
+}
+
+// Starts the next queued move of every idle channel, unless another channel still has to run an earlier segment
+void serviceQueues() {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+
+  for (int i = 0; i < 3; i += 1) {
+    if (queueRunning[i] && !steppers[i]->isRunning()) {
+      queueRunning[i] = false;
+    }
+  }
+
+  for (int i = 0; i < 3; i += 1) {
+    if (queueCount[i] == 0 || steppers[i]->isRunning() || waveActive[i] || lockFollower[i]) {
+      continue;
+    }
+    QueuedMove *move = &moveQueue[i][queueHead[i]];
+
+    boolean blocked = false;
+    for (int j = 0; j < 3; j += 1) {
+      if (j == i) {
+        continue;
+      }
+      if (queueRunning[j] && segmentBefore(runningSegment[j], move->segment)) {
+        blocked = true;
+      }
+      if (queueCount[j] > 0 && segmentBefore(moveQueue[j][queueHead[j]].segment, move->segment)) {
+        blocked = true;
+      }
+    }
+    if (blocked) {
+      continue;
+    }
+
+    steppers[i]->setMaxSpeed(move->speed);
+    steppers[i]->moveTo(move->target);
+    queueRunning[i] = true;
+    runningSegment[i] = move->segment;
+    queueHead[i] = (queueHead[i] + 1) % QUEUE_LENGTH;
+    queueCount[i] --;
+  }
+}
+
+// QUEUE q1:<queued> q2:<queued> q3:<queued>
+void sendQueueStatus() {
+  Serial.print("QUEUE q1:");
+  Serial.print(queueCount[0]);
+  Serial.print(" q2:");
+  Serial.print(queueCount[1]);
+  Serial.print(" q3:");
+  Serial.println(queueCount[2]);
+}
+
+//=============
+// Reads a WAVE command for the channels in motors. t sets the slot duration in ms, n the number of slots
+// of the table, i the slot the following plain numbers (steps per slot) are written to. r starts the
+// waveforms of all channels together for the given number of periods, 0 repeats them until STOP.
+void parseWave(char * motors, char * specs) {
+  boolean selected[3] = {false, false, false};
+  int index = 0;
+
+  if (specs == NULL) {
+    return;
+  }
+  for (int i = 0; i < 3; i += 1) {
+    selected[i] = strchr(motors, '1' + i) != NULL;
+  }
+
+  for (char * token = strtok(specs, " "); token != NULL; token = strtok(NULL, " ")) {
+    if (token[0] == '-' || isdigit(token[0])) {
+      for (int i = 0; i < 3; i += 1) {
+        if (selected[i] && index < WAVE_LENGTH) {
+          waveSteps[i][index] = atoi(token);
+        }
+      }
+      index ++;
+      continue;
+    }
+
+    long number = atol(token + 1);
+    for (int i = 0; i < 3; i += 1) {
+      if (!selected[i]) {
+        continue;
+      }
+      switch (token[0]) {
+        case 't':
+          waveSlotMillis[i] = number;
+          break;
+        case 'n':
+          waveCount[i] = min(number, WAVE_LENGTH);
+          break;
+        case 'r':
+          startWave(i, number);
+          break;
+      }
+    }
+    if (token[0] == 'i') {
+      index = number;
+    }
+  }
+
+  // All started channels share the start of their first slot
+  for (int i = 0; i < 3; i += 1) {
+    if (selected[i] && waveActive[i]) {
+      waveSlotStart[i] = curMillis;
+    }
+  }
+}
+
+void startWave(int channel, unsigned long cycles) {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+  if (waveCount[channel] == 0 || waveSlotMillis[channel] == 0) {
+    return;
+  }
+
+  // setSpeed() is limited by the max speed, allow the fastest slot of the table
+  int fastest = 0;
+  for (int j = 0; j < waveCount[channel]; j += 1) {
+    fastest = max(fastest, abs(waveSteps[channel][j]));
+  }
+  steppers[channel]->setMaxSpeed(max(1.0, fastest * 1000.0 / waveSlotMillis[channel]));
+
+  clearQueue(channel);
+  releaseLock();
+  waveCycles[channel] = cycles;
+  waveIndex[channel] = 0;
+  waveTarget[channel] = steppers[channel]->currentPosition();
+  waveActive[channel] = true;
+  startWaveSlot(channel);
+}
+
+void startWaveSlot(int channel) {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+  int steps = waveSteps[channel][waveIndex[channel]];
+
+  waveTarget[channel] += steps;
+  steppers[channel]->moveTo(waveTarget[channel]);
+  // moveTo() recalculates the speed, set the constant slot speed afterwards
+  steppers[channel]->setSpeed(steps * 1000.0 / waveSlotMillis[channel]);
+}
+
+// Advances every active waveform to its next slot once the current one is over
+void serviceWaves() {
+  for (int i = 0; i < 3; i += 1) {
+    if (!waveActive[i] || curMillis - waveSlotStart[i] < waveSlotMillis[i]) {
+      continue;
+    }
+    waveSlotStart[i] += waveSlotMillis[i];
+    waveIndex[i] ++;
+    if (waveIndex[i] == waveCount[i]) {
+      waveIndex[i] = 0;
+      if (waveCycles[i] > 0 && -- waveCycles[i] == 0) {
+        waveActive[i] = false;
+        continue;
+      }
+    }
+    startWaveSlot(i);
+  }
+}
+
+// A pause holds the waveforms, the interrupted slot gets its full duration again once they are resumed
+void resumeWaves() {
+  for (int i = 0; i < 3; i += 1) {
+    waveSlotStart[i] = millis();
+  }
 }
 
 //=============
@@ -556,25 +1188,21 @@ void runFew() {
 
 
 void stopAll() {
+  AccelStepper *steppers[3] = {&stepper1, &stepper2, &stepper3};
+
   for (int i = 0; i < 3; i += 1) {
-    steppers[i].stop();
+    clearQueue(i);
+    waveActive[i] = false;
+    steppers[i]->stop();
   }
 }
 
 void pauseRun() {
-  for (int i = 0; i < 3; i += 1) {
-    distances_to_go[i] = steppers[i].distanceToGo();
-    targets_position[i] = steppers[i].targetPosition();
-    distances_left[i] = distances_to_go[i] - distances_left[i];
-    steppers[i].move(p1_distance_to_go);
-  }
-  while (strcmp(mode, "RESUME") != 0) {
-    // do nothing
-    getDataFromPC();
-  }
-  for (int i = 0; i < 3; i += 1) {
-    distances[i] = distances_left[i];
-  }
+  // loop() stops stepping until RESUME, telemetry and commands keep being served meanwhile
+  paused = true;
+}
 
-  return runFew();
+void resumeRun() {
+  paused = false;
+  resumeWaves();
 }
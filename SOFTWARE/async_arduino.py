@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    asyncio connection to the Arduino board, without Qt and without threads.
+
+    The serial port is watched with loop.add_reader() and every command is a coroutine which returns
+    once the board acknowledged it, so a single event loop can drive a whole rack of boards:
+
+        async def main():
+            async with AsyncArduino('/dev/ttyACM0') as pump_a, AsyncArduino('/dev/ttyACM1') as pump_b:
+                await asyncio.gather(pump_a.jog(1, 6400, 1000), pump_b.jog(2, -3200, 500))
+                async for message in pump_a.positions(rate=5):
+                    print(message.positions)
+
+    add_reader() needs a selector event loop and a file descriptor for the port, this works on Linux
+    and macOS. On Windows use Arduino instead.
+
+    Usage:
+        python async_arduino.py <port> [<port> ...] [--baudrate BAUDRATE]
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from collections import deque
+
+import serial
+
+from serial_commands import (format_command, move_commands, format_speed_update, AcknowledgementException,
+                             PendingCommand, PositionSubscription)
+from serial_messages import (MessageFramer, PositionMessage, AckMessage, SequenceAckMessage, ProtocolMessage,
+                             QueueStatusMessage, QueueFullMessage, BannerMessage, DebugMessage)
+
+
+class SerialTransport:
+    """ Non-blocking serial port registered with the event loop
+
+    Parameters
+    ----------
+    port : str
+        Serial port of the board
+    baudrate : int
+        Baudrate of the connection
+    on_message : function
+        Called from the event loop with every message parsed from the board output
+    """
+
+    def __init__(self, port, baudrate, on_message):
+        self.port = port
+        self.baudrate = baudrate
+        self.on_message = on_message
+        self.serial = None
+        self.loop = None
+        self.framer = MessageFramer()
+
+    def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.serial = serial.Serial(self.port, self.baudrate, timeout=0)
+        self.loop.add_reader(self.serial.fileno(), self.read_ready)
+
+    def close(self):
+        if self.serial is None:
+            return
+        self.loop.remove_reader(self.serial.fileno())
+        self.serial.close()
+        self.serial = None
+
+    @property
+    def is_open(self):
+        return self.serial is not None
+
+    def read_ready(self):
+        try:
+            messages = self.framer.read_from(self.serial)
+        except serial.SerialException as exc:
+            print(f"AsyncArduino> Reading from {self.port} failed: {exc}")
+            self.close()
+            return
+        for message in messages:
+            self.on_message(message)
+
+    def write(self, data):
+        # Writes are limited to the 64 byte input buffer of the board, they never fill the OS buffer
+        self.serial.write(data)
+
+
+class AsyncArduino:
+    """ Coroutine API of a single board, the counterpart of Arduino for asyncio
+
+    Commands are always sent in ASCII, the binary protocol is not negotiated.
+
+    Parameters
+    ----------
+    port : str
+        Serial port of the board
+    baudrate : int
+        Baudrate of the connection, has to match BAUD_RATE of the firmware
+    """
+
+    def __init__(self, port, baudrate=230400):
+        self.port = port
+        self.transport = SerialTransport(port, baudrate, self.handle_message)
+        self.connected = False
+
+        # Acceleration of every channel in steps/s^2, the firmware starts with X_ACCEL
+        self.default_acceleration = 5000.0
+        self.channel_accelerations = [self.default_acceleration] * 3
+
+        # Same flow control as Arduino: unacknowledged bytes are kept below the firmware input buffer
+        self.rx_buffer_size = 64
+        self.ack_timeout = 2.0
+        self.pending_acks = deque()
+        self.bytes_in_flight = 0
+        self.ack_latencies = deque(maxlen=1000)
+
+        # Created in connect(), they belong to the running event loop
+        self.command_queue = None
+        self.credit = None
+        self.writer_task = None
+        self.ready = None
+        self.command_sequence = itertools.count()
+
+        # Position telemetry, the board reports every telemetry_interval ms
+        self.default_telemetry_interval = 200
+        self.telemetry_interval = self.default_telemetry_interval
+        self.telemetry_on_change = False
+        self.position_subscriptions = []
+        self.last_position = None
+
+        # Commanded target per channel, see Arduino.expect_target()
+        self.channel_targets = [None, None, None]
+        self.channel_aborted = [False, False, False]
+        self.channel_idle = []
+
+        self.message_handlers = {
+            PositionMessage: self.handle_position,
+            AckMessage: self.acknowledge,
+            SequenceAckMessage: self.handle_ignored,
+            ProtocolMessage: self.handle_ignored,
+            QueueStatusMessage: self.handle_ignored,
+            QueueFullMessage: self.handle_ignored,
+            BannerMessage: self.handle_banner,
+            DebugMessage: self.handle_ignored,
+        }
+
+    async def connect(self, boot_timeout=3.0):
+        """ Opens the port and waits for the board to be ready
+
+        Opening the port resets most boards, they are ready once they printed their banner. Boards
+        which do not reset are assumed to be ready after boot_timeout seconds.
+        """
+        self.command_queue = asyncio.PriorityQueue()
+        self.credit = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.channel_idle = [asyncio.Event(), asyncio.Event(), asyncio.Event()]
+        for event in self.channel_idle:
+            event.set()
+        self.channel_accelerations = [self.default_acceleration] * 3
+
+        self.transport.open()
+        print(f"AsyncArduino> Connect to port: {self.port}")
+        try:
+            await asyncio.wait_for(self.ready.wait(), boot_timeout)
+        except asyncio.TimeoutError:
+            print(f"AsyncArduino> No banner from {self.port}, assuming the board is ready")
+
+        self.writer_task = asyncio.ensure_future(self.command_writer())
+        self.connected = True
+        await self.enable_motors()
+        self.update_telemetry()
+
+    async def disconnect(self):
+        if not self.connected:
+            return
+        try:
+            await asyncio.wait_for(self.disable_motors(), self.ack_timeout)
+        except (asyncio.TimeoutError, AcknowledgementException):
+            print(f"AsyncArduino> {self.port} did not acknowledge disabling the motors")
+
+        self.writer_task.cancel()
+        self.cancel_queued_commands()
+        for pending in self.pending_acks:
+            pending.future.cancel()
+        self.pending_acks.clear()
+        self.transport.close()
+        self.connected = False
+        print(f"AsyncArduino> {self.port} has been disconnected")
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
+
+    # ########
+    # Commands
+    # ########
+    def send_commands(self, commands, priority=None):
+        """ Queues commands for the writer task, see Arduino.send_commands()
+
+        Returns
+        -------
+        list of asyncio.Future
+            One future per command, resolving with its PendingCommand once acknowledged
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for command in commands:
+            pending = PendingCommand(command, priority, loop.create_future())
+            if pending.mode == 'STOP':
+                self.cancel_queued_commands()
+            self.command_queue.put_nowait((pending.priority, next(self.command_sequence), pending))
+            futures.append(pending.future)
+        return futures
+
+    async def send(self, command):
+        """ Sends a single command and returns once the board acknowledged it """
+        return await self.send_commands([command])[0]
+
+    def cancel_queued_commands(self):
+        while not self.command_queue.empty():
+            _, _, pending = self.command_queue.get_nowait()
+            pending.future.cancel()
+
+    async def command_writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, pending = await self.command_queue.get()
+            if pending.future.cancelled():
+                continue
+
+            while self.bytes_in_flight > 0 and self.bytes_in_flight + pending.size > self.rx_buffer_size:
+                # Set by every acknowledgement
+                self.credit.clear()
+                try:
+                    await asyncio.wait_for(self.credit.wait(), self.ack_timeout)
+                except asyncio.TimeoutError:
+                    self.expire_pending_acks()
+
+            pending.sent_at = time.perf_counter()
+            self.pending_acks.append(pending)
+            self.bytes_in_flight += pending.size
+            self.transport.write(pending.data)
+            # A lost acknowledgement must not hang the command when nothing else is waiting for credit
+            loop.call_later(self.ack_timeout, self.expire_ack, pending)
+
+    def acknowledge(self, message):
+        """ Matches a <mode: ... ,setting: ... > echo to the oldest pending command, see Arduino.acknowledge() """
+        for index, pending in enumerate(self.pending_acks):
+            if pending.matches(message.mode, message.setting):
+                break
+        else:
+            print(f"AsyncArduino> Unexpected acknowledgement: {message.mode},{message.setting}")
+            return
+
+        for _ in range(index):
+            self.fail(self.pending_acks.popleft(), 'No acknowledgement for:')
+
+        pending = self.pending_acks.popleft()
+        self.bytes_in_flight -= pending.size
+        pending.acked_at = time.perf_counter()
+        self.ack_latencies.append(pending.latency())
+        if not pending.future.done():
+            pending.future.set_result(pending)
+        self.credit.set()
+
+    def expire_pending_acks(self):
+        """ Gives up on commands whose acknowledgement did not arrive in time """
+        now = time.perf_counter()
+        while self.pending_acks and now - self.pending_acks[0].sent_at > self.ack_timeout:
+            self.fail(self.pending_acks.popleft(), 'Acknowledgement timed out for:')
+
+    def expire_ack(self, pending):
+        """ Gives up on a sent command if it is still waiting for its acknowledgement """
+        if pending in self.pending_acks:
+            self.pending_acks.remove(pending)
+            self.fail(pending, 'Acknowledgement timed out for:')
+            self.credit.set()
+
+    def fail(self, pending, reason):
+        self.bytes_in_flight -= pending.size
+        print(f"AsyncArduino> {reason} {pending.command}")
+        if not pending.future.done():
+            pending.future.set_exception(AcknowledgementException(f"{reason} {pending.command}"))
+
+    # ########
+    # Messages
+    # ########
+    def handle_message(self, message):
+        self.message_handlers[type(message)](message)
+
+    def handle_position(self, message):
+        self.last_position = message
+        for index, target in enumerate(self.channel_targets):
+            if target is not None and message.positions[index] == target and message.remaining[index] == 0:
+                self.channel_targets[index] = None
+                self.channel_idle[index].set()
+
+        for subscription in self.position_subscriptions:
+            subscription.offer(message)
+
+    def handle_banner(self, message):
+        print(f"AsyncArduino> {self.port} is ready")
+        self.ready.set()
+
+    def handle_ignored(self, message):
+        pass
+
+    # #########
+    # Telemetry
+    # #########
+    def subscribe_positions(self, rate, callback, on_change=False):
+        """ Subscribes a callback to position telemetry, see Arduino.subscribe_positions() """
+        subscription = PositionSubscription(self, rate, callback, on_change)
+        self.position_subscriptions.append(subscription)
+        self.update_telemetry()
+        return subscription
+
+    def unsubscribe_positions(self, subscription):
+        if subscription in self.position_subscriptions:
+            self.position_subscriptions.remove(subscription)
+            self.update_telemetry()
+
+    def update_telemetry(self):
+        """ Sets the board telemetry to the fastest subscribed rate """
+        if self.position_subscriptions:
+            interval = min(subscription.interval for subscription in self.position_subscriptions)
+            on_change = all(subscription.on_change for subscription in self.position_subscriptions)
+        else:
+            interval = self.default_telemetry_interval
+            on_change = False
+
+        if (interval, on_change) == (self.telemetry_interval, self.telemetry_on_change):
+            return
+        self.telemetry_interval = interval
+        self.telemetry_on_change = on_change
+
+        if self.connected:
+            self.send_commands([format_command('TELEMETRY', 'RATE', 0, interval, 'F', [int(on_change), 0, 0])])
+
+    async def positions(self, rate=5, on_change=False, backlog=16):
+        """ Async iterator over the position reports of the board
+
+        Parameters
+        ----------
+        rate : float
+            Reports per second
+        on_change : bool
+            Only yield reports which differ from the previous one
+        backlog : int
+            Reports kept for a slow consumer, older ones are dropped
+        """
+        reports = asyncio.Queue(backlog)
+
+        def deliver(message):
+            if reports.full():
+                reports.get_nowait()
+            reports.put_nowait(message)
+
+        subscription = self.subscribe_positions(rate, deliver, on_change)
+        try:
+            while True:
+                yield await reports.get()
+        finally:
+            subscription.cancel()
+
+    # #########################################################
+    # Hardware Abstraction Functions
+    #
+    # Same as Arduino, the coroutines return once the board acknowledged the commands
+    # #########################################################
+    def expect_target(self, motor_channel, position_in_steps):
+        index = motor_channel - 1
+        self.channel_targets[index] = position_in_steps
+        self.channel_aborted[index] = False
+        self.channel_idle[index].clear()
+        if self.last_position is not None:
+            self.handle_position(self.last_position)
+
+    async def wait_for_channel(self, motor_channel, timeout=None):
+        """ Waits until the channel reached its commanded target. Returns False on timeout or if it was stopped """
+        index = motor_channel - 1
+        try:
+            await asyncio.wait_for(self.channel_idle[index].wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return not self.channel_aborted[index]
+
+    async def jog(self, motor_channel, position_in_steps, speed_in_steps_per_s, acceleration_in_steps_per_s2=None):
+        """ Moves a channel to an absolute position in steps with the given speed in steps/s """
+        accelerations = None
+        if acceleration_in_steps_per_s2 is not None:
+            accelerations = {motor_channel: acceleration_in_steps_per_s2}
+        await self.run_channels({motor_channel: position_in_steps}, {motor_channel: speed_in_steps_per_s},
+                                accelerations)
+
+    async def run_channels(self, targets, speeds, accelerations=None, locked=False):
+        """ Moves several channels at once with a single MOVE command, see Arduino.run_channels() """
+        targets = {motor_channel: int(round(position)) for motor_channel, position in targets.items()}
+        changed = {motor_channel: acceleration for motor_channel, acceleration in (accelerations or {}).items()
+                   if acceleration != self.channel_accelerations[motor_channel - 1]}
+        # Raises ValueError for invalid speeds, before any channel is marked as moving
+        commands = move_commands(targets, speeds, changed, self.rx_buffer_size, locked)
+
+        for motor_channel, acceleration in changed.items():
+            self.channel_accelerations[motor_channel - 1] = acceleration
+        for motor_channel, position_in_steps in targets.items():
+            self.expect_target(motor_channel, position_in_steps)
+        await asyncio.gather(*self.send_commands(commands))
+
+    async def update_speed(self, motor_channel, speed_in_steps_per_s):
+        """ Changes the speed of a channel in place, see Arduino.update_speed() """
+        if speed_in_steps_per_s <= 0:
+            raise ValueError('The speed has to be positive, use stop_movement() to stop a channel')
+        await self.send(format_speed_update({motor_channel: speed_in_steps_per_s}))
+
+    async def enable_motors(self):
+        await self.send(format_command('SETTING', 'ENABLE', 1, 1, 'F', [0.0, 0.0, 0.0]))
+
+    async def disable_motors(self):
+        await self.send(format_command('SETTING', 'ENABLE', 1, 0, 'F', [0.0, 0.0, 0.0]))
+
+    async def stop_movement(self):
+        for index, target in enumerate(self.channel_targets):
+            if target is not None:
+                self.channel_targets[index] = None
+                self.channel_aborted[index] = True
+                self.channel_idle[index].set()
+        await self.send(format_command('STOP', '0', '0', '0', 'F', [0, 0, 0]))
+
+    async def pause_movement(self):
+        await self.send(format_command('PAUSE', '0', '0', '0', 'F', [0, 0, 0]))
+
+    async def resume_movement(self):
+        await self.send(format_command('RESUME', '0', '0', '0', 'F', [0, 0, 0]))
+
+    async def zero(self):
+        await self.send(format_command('ZERO', '0', '0', '0', 'F', [0, 0, 0]))
+
+
+async def monitor(ports, baudrate):
+    """ Prints the positions of all boards until interrupted """
+    boards = [AsyncArduino(port, baudrate) for port in ports]
+    await asyncio.gather(*[board.connect() for board in boards])
+
+    async def print_positions(board):
+        async for message in board.positions(rate=2):
+            print(f"{board.port}> {message.positions} remaining {message.remaining}")
+
+    try:
+        await asyncio.gather(*[print_positions(board) for board in boards])
+    finally:
+        await asyncio.gather(*[board.disconnect() for board in boards])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitor Poseidon boards from a single event loop')
+    parser.add_argument('ports', nargs='+')
+    parser.add_argument('--baudrate', type=int, default=230400)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(monitor(args.ports, args.baudrate))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,885 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for the host side of the Poseidon serial connection.
+
+    Without --port the benchmarks run against the firmware emulator, whose link can be degraded
+    with --latency and --drop-rate.
+
+    Usage:
+        python benchmarks.py <benchmark> [--port PORT] [--baudrate BAUDRATE] [--count COUNT]
+"""
+import argparse
+import asyncio
+import configparser
+import io
+import json
+import math
+import os
+import re
+import statistics
+import threading
+import time
+import timeit
+from concurrent.futures import wait
+
+import numpy as np
+
+from arduino_connection import Arduino
+from serial_commands import binary_frame_from_command, format_command, format_move
+from arduino_emulator import ArduinoEmulator
+from async_arduino import AsyncArduino
+from serial_messages import MessageFramer, PositionMessage
+from syringe_channel import SyringeChannel, ratio_locked_profile
+from pump_pool import PumpPool
+from motion_model import MotionModel
+from sequence_scheduler import move_duration
+from poseidon_daemon import PoseidonDaemon
+from protocol_compiler import ProtocolCompiler, PlanExecutor, PlanMove, CommandPlan
+from sequence_simulator import SequenceSimulator
+from gradient_program import GradientProgram
+from pulsatile_flow import PulsatileExecutor, SineWave, SquareWave, compile_waveform, measure_waveform
+
+
+def connect_arduino(port, baudrate):
+    config = {
+        'connection': {
+            'com-port': port,
+            'baudrate': baudrate,
+        }
+    }
+    arduino = Arduino(config, None)
+    arduino.connect()
+    return arduino
+
+
+def start_emulator(args):
+    """ Starts an emulated board unless a real one was given with --port """
+    if args.port is not None:
+        return None
+    emulator = ArduinoEmulator(args.baudrate, args.latency, args.drop_rate, boot_delay=0.1)
+    args.port = emulator.start()
+    print(f"Benchmark> Using emulated board on {args.port}")
+    return emulator
+
+
+def stop_emulator(emulator):
+    if emulator is not None:
+        print(f"Benchmark> Emulator statistics: {emulator.statistics()}")
+        emulator.stop()
+
+
+def report(name, values, unit):
+    values = sorted(values)
+    print(f"{name}: n={len(values)} "
+          f"min={values[0]:.3f}{unit} "
+          f"mean={statistics.mean(values):.3f}{unit} "
+          f"p50={values[len(values) // 2]:.3f}{unit} "
+          f"p99={values[min(len(values) - 1, math.ceil(0.99 * len(values)) - 1)]:.3f}{unit} "
+          f"max={values[-1]:.3f}{unit}")
+
+
+# ####################
+# Benchmark : Pipeline
+# ####################
+def benchmark_pipeline(args):
+    """ Measures commands/s and per-command round-trip latency of the ack-based sender """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+    arduino.ack_latencies.clear()
+
+    commands = [arduino.return_manual_arduino_command('SETTING', 'SPEED', 1, 1000 + i % 100, 'F', [0, 0, 0])
+                for i in range(args.count)]
+
+    start = time.perf_counter()
+    wait(arduino.send_commands(commands), args.count)
+    duration = time.perf_counter() - start
+
+    print(f"pipeline: {args.count} commands in {duration:.3f}s = {args.count / duration:.1f} commands/s "
+          f"(fixed 100 ms sleep: 10.0 commands/s)")
+    report('round-trip latency', [latency * 1000 for latency in arduino.ack_latencies], 'ms')
+
+    arduino.disconnect()
+
+
+# ################
+# Benchmark : Move
+# ################
+def benchmark_move(args):
+    """ Compares moves sent as SETTING,SPEED + RUN,DIST pairs with single MOVE commands """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+    emulator = args.emulator
+
+    legacy = []
+    combined = []
+    for i in range(args.count):
+        target = 100 * (i % 2)
+        legacy.append([format_command('SETTING', 'SPEED', 1, 1000 + i % 100, 'F', [0, 0, 0]),
+                       format_command('RUN', 'DIST', 1, 1, 'F', [target, 0, 0])])
+        combined.append([format_move({1: target}, {1: 1000 + i % 100}, {1: 5000})])
+
+    for name, moves in (('SPEED + RUN', legacy), ('MOVE', combined)):
+        before = emulator.statistics() if emulator is not None else None
+        start = time.perf_counter()
+        wait(arduino.send_commands([command for commands in moves for command in commands]), args.count)
+        duration = time.perf_counter() - start
+
+        line = f"move: {name}: {args.count} moves in {duration:.3f}s = {args.count / duration:.1f} moves/s"
+        if emulator is not None:
+            after = emulator.statistics()
+            line += (f", {(after['bytes-received'] - before['bytes-received']) / args.count:.0f} bytes to "
+                     f"and {(after['bytes-sent'] - before['bytes-sent']) / args.count:.0f} bytes from the board per move")
+        print(line)
+
+    arduino.disconnect()
+
+
+# ################
+# Benchmark : Stop
+# ################
+def benchmark_stop(args):
+    """ Measures how long a STOP takes to be acknowledged while a backlog of moves is queued """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+
+    moves = [arduino.return_manual_arduino_command('SETTING', 'SPEED', 1, 1000 + i % 100, 'F', [0, 0, 0])
+             for i in range(args.count)]
+    move_futures = arduino.send_commands(moves)
+
+    start = time.perf_counter()
+    arduino.stop_movement().result(5)
+    duration = time.perf_counter() - start
+
+    cancelled = sum(future.cancelled() for future in move_futures)
+    print(f"stop: acknowledged after {duration * 1000:.1f}ms with {args.count} moves queued, "
+          f"{cancelled} queued moves cancelled")
+
+    arduino.disconnect()
+
+
+# #################
+# Benchmark : Speed
+# #################
+def measure_speed_change(arduino, samples, change, old_speed, new_speed, acceleration):
+    """ Runs channel 1 at old_speed, calls change(target) and measures how the flow follows in the telemetry
+
+    Returns the acknowledgement latency and the time until the new speed was reached in s, the lowest
+    speed in between and how many steps the channel fell behind an instant change of the speed
+    """
+    target = arduino.last_position.positions[0] + 100000
+    arduino.jog(1, target, old_speed, acceleration)
+    time.sleep(1.0)
+    del samples[:]
+    time.sleep(0.2)
+
+    start = time.monotonic()
+    change(target).result(5)
+    acknowledged = time.monotonic() - start
+    time.sleep(1.5)
+    arduino.stop_movement().result(5)
+    time.sleep(0.5)
+
+    # Speed over the last 50 ms of every report
+    times, positions = np.array(samples[:], dtype=float).T
+    speeds = (positions - np.interp(times - 0.05, times, positions)) / 0.05
+    after = times >= start
+    reached = np.flatnonzero(after & (speeds >= 0.95 * new_speed))
+    reach = times[reached[0]] - start if len(reached) else float('nan')
+    dip = speeds[after & (times <= start + reach)].min(initial=new_speed)
+    behind = np.interp(start, times, positions) + new_speed - np.interp(start + 1.0, times, positions)
+    return acknowledged, reach, dip, behind
+
+
+def benchmark_speed(args):
+    """ Compares changing the speed of a running channel in place with a STOP followed by a new move """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+    ml_per_step = example_syringes()[0].steps_to_ml(1.0)
+    old_speed, new_speed, acceleration = 300.0, 600.0, 2000.0
+
+    samples = []
+    subscription = arduino.subscribe_positions(100, lambda report: samples.append((time.monotonic(),
+                                                                                   report.positions[0])))
+    time.sleep(0.2)
+
+    def restart(target):
+        arduino.stop_movement().result(5)
+        return arduino.jog(1, target, new_speed)[-1]
+
+    modes = {
+        'update_speed': lambda target: arduino.update_speed(1, new_speed),
+        'stop + move': restart,
+    }
+    for name, change in modes.items():
+        results = np.array([measure_speed_change(arduino, samples, change, old_speed, new_speed, acceleration)
+                            for _ in range(max(1, args.count // 100))])
+        acknowledged, reach, dip, behind = results.mean(axis=0)
+        print(f"{name}: {old_speed:.0f} -> {new_speed:.0f} steps/s, acknowledged after {acknowledged * 1000:.1f}ms, "
+              f"new speed after {reach * 1000:.0f}ms, lowest speed {dip:.0f} steps/s, "
+              f"{behind:.0f} steps ({behind * ml_per_step * 1000:.0f} uL) behind an instant change")
+
+    subscription.cancel()
+    arduino.disconnect()
+
+
+# ###############
+# Benchmark : Jog
+# ###############
+def benchmark_jog(args):
+    """ Clicks the jog button five times in a row, with jogs from the reported position and with jog_by() """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+    distance, speed, clicks = 200, 1000.0, 5
+
+    def reported(motor_channel):
+        return arduino.jog(motor_channel, arduino.last_position.positions[motor_channel - 1] + distance, speed)[-1]
+
+    def commanded(motor_channel):
+        return arduino.jog_by(motor_channel, distance, speed)
+
+    for interval in (0.0, 0.02, 0.1, 0.2):
+        for name, click in (('reported position', reported), ('jog_by', commanded)):
+            arduino.wait_for_acks(5)
+            time.sleep(0.3)
+            start = arduino.last_position.positions[0]
+            acknowledged = len(arduino.ack_latencies)
+            for _ in range(clicks):
+                click(1)
+                time.sleep(interval)
+            arduino.wait_for_channel(1, 10)
+            arduino.wait_for_acks(5)
+            frames = len(arduino.ack_latencies) - acknowledged
+            arduino.wait_for_channel(1, 10)
+            time.sleep(0.3)
+            moved = arduino.last_position.positions[0] - start
+            print(f"{name}, clicks {interval * 1000:.0f}ms apart: {frames} moves sent, "
+                  f"moved {moved} of {clicks * distance} steps")
+
+    arduino.disconnect()
+
+
+# ####################
+# Benchmark : Protocol
+# ####################
+def firmware_parse_time(messages, binary, repeat=5):
+    """ Seconds per message for the firmware parser of the emulator, fed byte by byte like loop() does """
+    best = math.inf
+    for _ in range(repeat):
+        emulator = ArduinoEmulator()
+        emulator.binary_mode = binary
+        start = time.perf_counter()
+        for message in messages:
+            for byte in message:
+                emulator.read_byte(byte)
+        best = min(best, time.perf_counter() - start)
+    return best / len(messages)
+
+
+def benchmark_protocol(args):
+    """ Compares bytes per command, parse time and command rate of the ASCII and the binary protocol """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+
+    commands = []
+    for i in range(args.count // 2):
+        commands.append(arduino.return_manual_arduino_command('SETTING', 'SPEED', 1 + i % 3, 123.5, 'F', [0, 0, 0]))
+        commands.append(arduino.return_manual_arduino_command('RUN', 'DIST', 1 + i % 3, 1, 'F',
+                                                              [12800.0 * i, 6400.0 * i, 3200.0 * i]))
+    frames = [binary_frame_from_command(command, i) for i, command in enumerate(commands)]
+
+    ascii_bytes = sum(len(command) for command in commands) / len(commands)
+    binary_bytes = sum(len(frame) for frame in frames) / len(frames)
+    print(f"bytes per command (PC to board): ascii={ascii_bytes:.1f} binary={binary_bytes:.1f}")
+
+    # The parser runs in the emulator, the ratio carries over to the board rather than the absolute times
+    ascii_parse = firmware_parse_time([command.encode('ascii') for command in commands], False)
+    binary_parse = firmware_parse_time(frames, True)
+    print(f"parse time per command (emulated firmware): ascii={ascii_parse * 1e6:.1f} us "
+          f"binary={binary_parse * 1e6:.1f} us ({ascii_parse / binary_parse:.1f}x)")
+
+    for name in ('ascii', 'binary'):
+        if name == 'binary' and not arduino.enable_binary_protocol():
+            break
+        arduino.wait_for_acks(5)
+        received = args.emulator.statistics()['bytes-sent'] if args.emulator else None
+
+        start = time.perf_counter()
+        wait(arduino.send_commands(commands), args.count)
+        duration = time.perf_counter() - start
+
+        print(f"{name}: {len(commands) / duration:.1f} commands/s")
+        if received is not None:
+            # Telemetry is included in the bytes sent by the board
+            reply_bytes = (args.emulator.statistics()['bytes-sent'] - received) / len(commands)
+            print(f"{name}: {reply_bytes:.1f} bytes per command (board to PC)")
+
+    arduino.disconnect()
+
+
+# ##################
+# Benchmark : Parser
+# ##################
+class StreamSerial:
+    """ Serves a byte stream through the part of the serial.Serial interface the listeners use """
+
+    def __init__(self, data, chunk_size):
+        self.stream = io.BytesIO(data)
+        self.chunk_size = chunk_size
+        self.in_waiting = chunk_size
+
+    def readline(self):
+        return self.stream.readline()
+
+    def readinto(self, buffer):
+        return self.stream.readinto(buffer)
+
+
+def legacy_parse(serial):
+    """ The serial listener before the message framer, without the thread loop """
+    positions = 0
+    while True:
+        line = serial.readline()
+        if len(line) == 0:
+            return positions
+        line = line.decode('ascii').replace('\r\n', '')
+        line_split = re.split(' |:', line)
+        if line_split[0] == 'POS':
+            pos1 = int(line_split[2])
+            rem1 = int(line_split[4])
+            pos2 = int(line_split[6])
+            rem2 = int(line_split[8])
+            pos3 = int(line_split[10])
+            rem3 = int(line_split[12])
+            positions += 1
+
+
+def framer_parse(serial):
+    positions = 0
+    framer = MessageFramer()
+    while True:
+        messages = framer.read_from(serial)
+        if not messages and serial.stream.tell() == len(serial.stream.getbuffer()):
+            return positions
+        for message in messages:
+            if type(message) is PositionMessage:
+                positions += 1
+
+
+def benchmark_parser(args):
+    """ Compares lines/s of the legacy readline/re.split listener and the message framer """
+    lines = []
+    for i in range(args.count * 100):
+        if i % 10 < 7:
+            lines.append(f"POS p1:{i * 3} r1:{-i} p2:{i * 2} r2:{i} p3:{i} r3:{100000 - i}")
+        elif i % 10 < 9:
+            lines.append("Status Distances" if i % 2 else "123.00")
+        else:
+            lines.append("<mode: RUN ,setting: DIST ,motorID: 1 ,value: 1.00 ,direction: F ,p1 optional: 6400.00 "
+                         ",p2 optional: 0.00 ,p3 optional: 0.00 ,Time 12>")
+    data = ''.join(line + '\r\n' for line in lines).encode('ascii')
+
+    for name, parse in (('legacy', legacy_parse), ('framer', framer_parse)):
+        serial = StreamSerial(data, 512)
+        start = time.perf_counter()
+        positions = parse(serial)
+        duration = time.perf_counter() - start
+        print(f"{name}: {len(lines) / duration:,.0f} lines/s ({positions} POS lines)")
+
+
+# ####################
+# Benchmark : Compiler
+# ####################
+def example_syringes():
+    config = configparser.ConfigParser()
+    config.read('config.ini.example')
+    syringes = []
+    for channel in (1, 2, 3):
+        syringe = SyringeChannel(None, channel, config)
+        syringe.set_syringe(config[f"syringe-channel-{channel}"]['size'])
+        syringes.append(syringe)
+    return syringes
+
+
+def example_protocol(count):
+    """ Protocol with count * 50 steps, half of them withdrawing again """
+    body = [
+        {'run': {'channel': 1, 'volume': 0.5, 'rate': 60}},
+        {'parallel': [{'run': {'channel': 2, 'volume': 0.2, 'rate': 30}},
+                      {'run': {'channel': 3, 'volume': 200, 'volume-unit': 'uL', 'rate': 50, 'rate-unit': 'uL/min'}}]},
+        {'wait': 1},
+        {'run': {'channel': 1, 'volume': -0.5, 'rate': 60}},
+        {'run': {'channel': 2, 'volume': -0.2, 'rate': 30}},
+    ]
+    return {'steps': [{'loop': {'count': count * 10, 'steps': body}}]}, count * 10 * len(body)
+
+
+def benchmark_compiler(args):
+    """ Measures how long compiling a protocol with count * 50 steps takes """
+    syringes = example_syringes()
+    protocol, steps = example_protocol(args.count)
+
+    start = time.perf_counter()
+    plan = ProtocolCompiler(syringes).compile(protocol)
+    duration = time.perf_counter() - start
+    print(f"compiler: {steps} steps into {len(plan.items)} items and {plan.command_count()} commands "
+          f"in {duration * 1000:.1f}ms, predicted duration {plan.duration():.0f}s")
+
+
+# #######################
+# Benchmark : Conversions
+# #######################
+def parsed_steps_to_ml(syringe, steps):
+    """ SyringeChannel.steps_to_ml() before the conversion factors were cached """
+    mm_per_rotation = float(syringe.config['misc']['mm-per-rotation'])
+    steps_per_rotation = float(syringe.config['misc']['steps-per-rotation'])
+    microsteps_per_step = float(syringe.config['misc']['microsteps'])
+
+    return syringe.mm_to_ml(steps / microsteps_per_step / steps_per_rotation * mm_per_rotation)
+
+
+def benchmark_conversions(args):
+    """ Compares parsing the config per conversion with the cached factors and the array conversion """
+    syringe = example_syringes()[0]
+    steps = np.arange(args.count * 50, dtype=float)
+    values = steps.tolist()
+    repeat = 5
+
+    results = {
+        'parsed per call': lambda: [parsed_steps_to_ml(syringe, value) for value in values],
+        'cached per call': lambda: [syringe.steps_to_ml(value) for value in values],
+        'convert() array': lambda: syringe.convert(steps, 'steps', 'mL'),
+    }
+    reference = np.array(results['parsed per call']())
+    for name, convert in results.items():
+        duration = min(timeit.repeat(convert, number=1, repeat=repeat))
+        error = np.max(np.abs(np.asarray(convert()) - reference))
+        print(f"{name}: {duration / len(values) * 1e9:.1f}ns per conversion, max deviation {error:.2e} mL")
+
+    # The GUI converts position and remaining volume of every channel for each POS line
+    duration = min(timeit.repeat(lambda: [(syringe.steps_to_mm(value), syringe.steps_to_ml(value))
+                                          for value in values[:3]], number=10000, repeat=repeat)) / 10000
+    print(f"position display: {duration * 1e6:.2f}us per POS line")
+    flow_rates = syringe.convert(steps, 'steps/s', 'mL/h')
+    print(f"flow rates: {len(flow_rates)} step rates converted to mL/h, {flow_rates[-1]:.1f} mL/h at "
+          f"{steps[-1]:.0f} steps/s")
+
+
+# ###################
+# Benchmark : Dry run
+# ###################
+def benchmark_dryrun(args):
+    """ Measures how long the dry run of a compiled protocol with count * 50 steps takes """
+    syringes = example_syringes()
+    protocol, steps = example_protocol(args.count)
+    plan = ProtocolCompiler(syringes).compile(protocol)
+
+    start = time.perf_counter()
+    dry_run = SequenceSimulator(syringes).simulate_plan(plan)
+    duration = time.perf_counter() - start
+    print(f"dryrun: {len(dry_run.timeline)} moves of {len(plan.items)} items in {duration * 1000:.1f}ms, "
+          f"duration {dry_run.duration:.0f}s, {'feasible' if dry_run.feasible else f'{len(dry_run.issues)} issues'}")
+
+
+# ####################
+# Benchmark : Gradient
+# ####################
+def benchmark_gradient(args):
+    """ Compiles crossing flow-rate gradients with count breakpoints per channel and checks their volume error """
+    syringes = example_syringes()
+    times = np.linspace(0, 3600, args.count)
+    gradients = {
+        1: np.column_stack((times, np.linspace(0, 600, args.count))),
+        2: np.column_stack((times, np.linspace(600, 0, args.count))),
+        3: np.column_stack((times, 300 + 300 * np.sin(times / 600))),
+    }
+
+    for tolerance in (0.1, 0.01, 0.001):
+        program = GradientProgram(syringes, tolerance)
+        start = time.perf_counter()
+        plan = program.compile(gradients, {1: 0, 2: 0, 3: 0})
+        duration = time.perf_counter() - start
+
+        # Delivered volume sampled between the segment ends against the exact integral of the gradient
+        errors = []
+        for channel, breakpoints in gradients.items():
+            profile = plan.profiles[channel]
+            t = np.linspace(0, 3600, 200001)
+            exact = np.concatenate(([0.0], np.cumsum(np.diff(t) * np.interp((t[1:] + t[:-1]) / 2, *breakpoints.T))))
+            delivered = np.interp(t, np.concatenate(([0.0], profile.ends)),
+                                  np.concatenate(([0.0], profile.targets))) / program.steps_per_ml[channel]
+            errors.append(np.max(np.abs(delivered - exact / 3600)))
+        print(f"tolerance {tolerance} mL: compiled in {duration * 1000:.1f}ms, max error {max(errors) * 1000:.2f} uL")
+        print(plan.summary())
+
+
+# #####################
+# Benchmark : Pulsatile
+# #####################
+def replay_waveform(arduino, emulator, table, cycles, streamed):
+    """ Replays the table on channel 1, returns its fidelity from the telemetry and the bytes the board received """
+    reports = []
+    subscription = arduino.subscribe_positions(50, reports.append)
+    arduino.wait_for_acks(5)
+    time.sleep(0.2)
+    start_position = arduino.last_position.positions[0]
+    received = emulator.statistics()['bytes-received'] if emulator is not None else 0
+
+    executor = PulsatileExecutor(arduino, {1: table})
+    if streamed:
+        executor.run_streamed(cycles)
+    else:
+        executor.run(cycles)
+    time.sleep(0.2)
+    received = emulator.statistics()['bytes-received'] - received if emulator is not None else 0
+    subscription.cancel()
+
+    # Reports from the first movement until the end of the last period
+    timestamps = np.array([report.timestamp for report in reports], dtype=float)
+    positions = np.array([report.positions[0] for report in reports], dtype=float)
+    first = max(np.flatnonzero(positions != start_position)[0] - 1, 0)
+    last = np.searchsorted(timestamps, timestamps[first] + cycles * table.period * 1000)
+    return measure_waveform(table, timestamps[first:last], positions[first:last], start_position), received
+
+
+def benchmark_pulsatile(args):
+    """ Replays sine and square waves from the board table and streamed move by move, compares their fidelity """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+    syringe = example_syringes()[0]
+    cycles = max(1, args.count // 40)
+
+    waveforms = {
+        'sine': SineWave(mean=12000, amplitude=10000, period=2.0),
+        'square': SquareWave(high=20000, low=4000, period=2.0, duty=0.3),
+    }
+    for name, waveform in waveforms.items():
+        table = compile_waveform(syringe, waveform)
+        print(f"{name}: {len(table.steps)} slots of {table.slot_ms} ms, predicted {table.fidelity()}")
+        for mode in ('table', 'streamed'):
+            fidelity, received = replay_waveform(arduino, args.emulator, table, cycles, mode == 'streamed')
+            print(f"{name} {mode}: {cycles} periods, measured {fidelity}, {received / cycles:.0f} bytes per period")
+
+    arduino.disconnect()
+
+
+# #################
+# Benchmark : Ratio
+# #################
+def benchmark_ratio(args):
+    """ Runs channels 1 and 2 at a 3:1 ratio with independent, scaled and ratio-locked profiles
+
+    The ratio error is how far channel 2 is off the position the ratio gives for channel 1, it is
+    largest while the channels accelerate and decelerate.
+    """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+    ml_per_step = example_syringes()[0].steps_to_ml(1.0)
+    distances = {1: 3000, 2: 1000}
+    speeds = {1: 750.0, 2: 250.0}
+    accelerations = {1: 500.0, 2: 500.0}
+
+    reports = []
+    subscription = arduino.subscribe_positions(100, reports.append)
+    for mode in ('independent', 'scaled', 'locked'):
+        mode_speeds, mode_accelerations = speeds, accelerations
+        if mode != 'independent':
+            mode_speeds, mode_accelerations = ratio_locked_profile(distances, speeds, accelerations)
+
+        arduino.wait_for_acks(5)
+        time.sleep(0.2)
+        start = list(arduino.last_position.positions[:2])
+        del reports[:]
+        arduino.run_channels({channel: start[channel - 1] + distance for channel, distance in distances.items()},
+                             mode_speeds, mode_accelerations, locked=mode == 'locked')
+        for channel in distances:
+            arduino.wait_for_channel(channel)
+        time.sleep(0.2)
+
+        positions = np.array([report.positions[:2] for report in reports], dtype=float) - start
+        errors = np.abs(positions[:, 1] - positions[:, 0] * distances[2] / distances[1])
+        print(f"{mode}: {len(positions)} samples, max ratio error {errors.max():.0f} steps "
+              f"({errors.max() * ml_per_step * 1000:.1f} uL), mean {errors.mean():.1f} steps")
+
+    subscription.cancel()
+    arduino.disconnect()
+
+
+# #################
+# Benchmark : Queue
+# #################
+def benchmark_queue(args):
+    """ Compares a plan of short back-to-back moves sent move by move and preloaded into the board queue """
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+
+    items = []
+    for i in range(args.count // 10):
+        items.append(PlanMove({1: 200 * (i % 2 + 1), 2: -200 * (i % 2 + 1)}, {1: 2000.0, 2: 2000.0}, 0.0))
+        items.append(PlanMove({3: 100 * (i % 2 + 1)}, {3: 2000.0}, 0.0))
+    plan = CommandPlan(items, None)
+
+    for name in ('stepwise', 'queued'):
+        executor = PlanExecutor(arduino, plan)
+        run = executor.run_stepwise if name == 'stepwise' else executor.run
+        start = time.perf_counter()
+        run()
+        duration = time.perf_counter() - start
+        print(f"{name}: {len(items)} moves in {duration:.3f}s = {duration / len(items) * 1000:.1f}ms per move")
+
+    arduino.disconnect()
+
+
+# #################
+# Benchmark : Model
+# #################
+def benchmark_model(args):
+    """ Compares the predictions of the motion model with the moves of the board, and times batch predictions """
+    model = MotionModel(example_syringes())
+    arduino = connect_arduino(args.port, args.baudrate)
+    arduino.wait_for_acks(5)
+
+    rate = 20
+    period = 1.0 / rate
+    reports = []
+    subscription = arduino.subscribe_positions(rate, lambda message: reports.append((time.perf_counter(), message)))
+    time.sleep(0.5)
+
+    moves = [
+        ({1: 6400}, {1: 2000.0}, {1: 5000.0}),                      # trapezoid
+        ({1: 6000}, {1: 4000.0}, {1: 2000.0}),                      # triangle
+        ({1: 0, 2: -3000, 3: 1500}, {1: 3000.0, 2: 1500.0, 3: 800.0}, {1: 8000.0, 2: 3000.0, 3: 20000.0}),
+        ({2: 0, 3: 0}, {2: 500.0, 3: 2500.0}, {2: 1000.0, 3: 4000.0}),
+    ]
+    completion_errors = []
+    position_errors = []
+    for targets, speeds, accelerations in moves:
+        channels = sorted(targets)
+        starts = [arduino.last_position.positions[channel - 1] for channel in channels]
+        prediction = model.predict(channels, starts, [targets[channel] for channel in channels],
+                                   [speeds[channel] for channel in channels],
+                                   [accelerations[channel] for channel in channels])
+
+        del reports[:]
+        arduino.run_channels(targets, speeds, accelerations)[-1].result(5)
+        for channel in channels:
+            arduino.wait_for_channel(channel, prediction.completion_time() + 5)
+        time.sleep(2 * period)
+
+        # The move started before the first sample which shows motion, by the time the model needs for
+        # the steps already moved. Serial latency delays the start and the arrival alike.
+        samples = [(received, np.array([message.positions[channel - 1] for channel in channels], dtype=float),
+                    any(message.remaining)) for received, message in reports]
+        first = next(index for index, (_, positions, _) in enumerate(samples)
+                     if np.any(positions != prediction.starts))
+        received, positions, _ = samples[first]
+        moved = np.abs(positions - prediction.starts)
+        fastest = int(np.argmax(moved / np.maximum(np.abs(prediction.distances), 1)))
+        grid = np.linspace(0.0, prediction.completion_time(), 4000)
+        course = np.abs(prediction.position(grid)[:, fastest] - prediction.starts[fastest])
+        started = received - float(np.interp(moved[fastest], course, grid))
+
+        arrived = None
+        moving = started
+        for received, positions, remaining in samples[first:]:
+            if np.array_equal(positions, prediction.targets) and not remaining:
+                # The move finished between the last sample in motion and this one
+                arrived = (moving + received) / 2 - started
+                break
+            moving = received
+            # Position error expressed as the time the channel needs at its speed to catch up, positive
+            # while the board is ahead of the model
+            error = (positions - prediction.position(received - started)) * np.sign(prediction.distances) \
+                / prediction.speeds
+            position_errors.append(error[np.argmax(np.abs(error))] * 1000)
+        completion_errors.append((arrived - prediction.completion_time()) * 1000)
+        print(f"model: channels {channels}: predicted {prediction.completion_time():.3f}s, arrived {arrived:.3f}s")
+
+    subscription.cancel()
+    arduino.disconnect()
+
+    report('completion error (arrival - predicted)', completion_errors, 'ms')
+    report('position error (board ahead of the model)', position_errors, 'ms')
+    worst = max(completion_errors + position_errors, key=abs)
+    if abs(worst) > period * 1000:
+        raise SystemExit(f"model: predictions do NOT agree within one telemetry period ({period * 1000:.0f}ms), "
+                         f"worst error {worst:+.1f}ms")
+    print(f"model: predictions agree within one telemetry period ({period * 1000:.0f}ms), "
+          f"worst error {worst:+.1f}ms")
+
+    count = args.count * 500
+    rng = np.random.default_rng(0)
+    channels = rng.integers(1, 4, count)
+    distances = rng.integers(-20000, 20000, count)
+    speeds = rng.uniform(100, 3000, count)
+    start = time.perf_counter()
+    prediction = model.predict(channels, np.zeros(count), distances, speeds, np.full(count, 5000.0))
+    duration = time.perf_counter() - start
+    scalar = timeit.timeit(lambda: [move_duration(*move) for move in zip(distances, speeds, [5000.0] * count)],
+                           number=1)
+    print(f"model: {count} moves predicted in {duration * 1000:.1f}ms "
+          f"(scalar move_duration: {scalar * 1000:.1f}ms), longest {prediction.completion_time():.1f}s")
+
+
+# #################
+# Benchmark : Async
+# #################
+async def drive_boards(ports, count):
+    boards = [AsyncArduino(port) for port in ports]
+    await asyncio.gather(*[board.connect() for board in boards])
+    host_threads = threading.active_count()
+
+    commands = [format_command('SETTING', 'SPEED', 1, 1000 + i % 100, 'F', [0, 0, 0]) for i in range(count)]
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    await asyncio.gather(*[asyncio.gather(*board.send_commands(commands)) for board in boards])
+    cpu = time.thread_time() - cpu_start
+    duration = time.perf_counter() - start
+
+    await asyncio.gather(*[board.disconnect() for board in boards])
+    return duration, cpu, host_threads
+
+
+def benchmark_async(args):
+    """ Drives several emulated boards from one event loop, measures throughput and CPU time of the loop """
+    emulators = [ArduinoEmulator(args.baudrate, args.latency, args.drop_rate, boot_delay=0.1)
+                 for _ in range(args.boards)]
+    ports = [emulator.start() for emulator in emulators]
+    try:
+        duration, cpu, host_threads = asyncio.run(drive_boards(ports, args.count))
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+    total = args.count * args.boards
+    print(f"async: {args.boards} boards, {total} commands in {duration:.3f}s = {total / duration:.1f} commands/s, "
+          f"event loop cpu {cpu * 1000:.1f}ms = {cpu / total * 1e6:.0f}us per command")
+    print(f"async: {host_threads - args.boards - 1} host threads besides the event loop")
+
+
+# ################
+# Benchmark : Pool
+# ################
+def benchmark_pool(args):
+    """ Moves all channels of several emulated boards at once, measures how far apart the boards start """
+    emulators = [ArduinoEmulator(args.baudrate, args.latency, args.drop_rate, boot_delay=0.1)
+                 for _ in range(args.boards)]
+    ports = [emulator.start() for emulator in emulators]
+    pool = PumpPool.from_ports(ports, {'connection': {'baudrate': args.baudrate}})
+    try:
+        pool.connect()
+        reports = []
+        subscription = pool.subscribe_positions(10, reports.append)
+
+        channels = sorted(pool.channels)
+        write_skews = []
+        ack_skews = []
+        for i in range(args.count // 20):
+            targets = {channel: (i + 1) * 100 * channel for channel in channels}
+            futures = pool.run_channels(targets, {channel: 2000.0 for channel in channels})
+            runs = [future.result(5) for future in futures]
+            write_skews.append((max(run.sent_at for run in runs) - min(run.sent_at for run in runs)) * 1000)
+            ack_skews.append((max(run.acked_at for run in runs) - min(run.acked_at for run in runs)) * 1000)
+            for channel in channels:
+                pool.wait_for_channel(channel, 30)
+
+        subscription.cancel()
+        print(f"pool: {args.boards} boards, {len(channels)} channels, {len(reports)} merged position reports")
+        report('MOVE write skew between boards', write_skews, 'ms')
+        report('MOVE ack skew between boards', ack_skews, 'ms')
+        pool.disconnect()
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+
+# ##################
+# Benchmark : Daemon
+# ##################
+async def daemon_client(path, method, count, latencies):
+    reader, writer = await asyncio.open_unix_connection(path)
+    for request_id in range(count):
+        start = time.perf_counter()
+        writer.write(json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method}).encode() + b'\n')
+        response = json.loads(await reader.readline())
+        latencies.append((time.perf_counter() - start) * 1000)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+    writer.close()
+
+
+async def daemon_load(path, clients, count):
+    results = {}
+    for method in ('status', 'enable'):
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*[daemon_client(path, method, count, latencies) for _ in range(clients)])
+        results[method] = (time.perf_counter() - start, latencies)
+    return results
+
+
+def benchmark_daemon(args):
+    """ Load test of the JSON-RPC daemon: several clients calling a method without and with a board round trip """
+    path = f"/tmp/poseidon-benchmark-{os.getpid()}.sock"
+    loop = asyncio.new_event_loop()
+    daemon = PoseidonDaemon(AsyncArduino(args.port, args.baudrate))
+    daemon_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    daemon_thread.start()
+    try:
+        asyncio.run_coroutine_threadsafe(daemon.start(path=path), loop).result(10)
+        results = asyncio.run(daemon_load(path, args.boards, args.count))
+        for method, (duration, latencies) in results.items():
+            print(f"daemon: {args.boards} clients calling {method}: "
+                  f"{len(latencies) / duration:.0f} requests/s")
+            report(f"{method} latency", latencies, 'ms')
+        asyncio.run_coroutine_threadsafe(daemon.stop(), loop).result(10)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        daemon_thread.join()
+
+
+BENCHMARKS = {
+    'pipeline': benchmark_pipeline,
+    'stop': benchmark_stop,
+    'speed': benchmark_speed,
+    'jog': benchmark_jog,
+    'protocol': benchmark_protocol,
+    'parser': benchmark_parser,
+    'compiler': benchmark_compiler,
+    'conversions': benchmark_conversions,
+    'dryrun': benchmark_dryrun,
+    'gradient': benchmark_gradient,
+    'pulsatile': benchmark_pulsatile,
+    'ratio': benchmark_ratio,
+    'queue': benchmark_queue,
+    'async': benchmark_async,
+    'pool': benchmark_pool,
+    'move': benchmark_move,
+    'model': benchmark_model,
+    'daemon': benchmark_daemon,
+}
+
+# Benchmarks which don't use the board given with --port or the default emulator
+OFFLINE_BENCHMARKS = ('parser', 'compiler', 'conversions', 'dryrun', 'gradient', 'async', 'pool')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Poseidon host side benchmarks')
+    parser.add_argument('benchmark', choices=BENCHMARKS.keys())
+    parser.add_argument('--port', help='Serial port of the board, the emulator is used if not given')
+    parser.add_argument('--baudrate', type=int, default=230400)
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='One way latency of the emulated link')
+    parser.add_argument('--boards', type=int, default=4, help='Emulated boards of the async and pool benchmarks, clients of the daemon benchmark')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Byte loss probability of the emulated link')
+    args = parser.parse_args()
+
+    args.emulator = start_emulator(args) if args.benchmark not in OFFLINE_BENCHMARKS else None
+    try:
+        BENCHMARKS[args.benchmark](args)
+    finally:
+        stop_emulator(args.emulator)
+
+
+if __name__ == "__main__":
+    main()
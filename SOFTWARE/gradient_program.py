@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Flow-rate gradients: piecewise-linear flow rates over time, compiled into constant-speed moves.
+
+    Every channel gets a list of (time in s, flow rate in mL/h) breakpoints, the flow rate changes
+    linearly in between. Negative flow rates withdraw, a channel is idle before its first breakpoint
+    and after its last one:
+
+        program = GradientProgram(syringes, tolerance=0.01)
+        plan = program.compile({1: [(0, 0), (600, 120)],
+                                2: [(0, 120), (600, 0)]})
+        GradientExecutor(arduino, plan).run()
+
+    The firmware only runs constant speeds, so the gradient is split into segments running at their
+    mean flow rate. The volume delivered then matches the gradient at every segment end, and in between
+    it deviates by at most slope * length^2 / 8. Segments are short where the flow rate changes quickly
+    and span several breakpoints where it hardly changes, just short enough to stay within the tolerance.
+    Targets are rounded to whole steps on the cumulative volume, so the rounding does not add up and
+    adds at most the volume of half a step. Tolerances below that only cost segments.
+
+    The segments of all channels starting at the same time are sent as one MOVE command at that time.
+
+    Usage:
+        python gradient_program.py <gradient file> [--config CONFIG] [--tolerance TOLERANCE]
+"""
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+
+from serial_commands import format_move
+
+
+class GradientError(Exception):
+    pass
+
+
+class GradientProfile:
+    """ The compiled segments of one channel
+
+    Attributes
+    ----------
+    channel : int
+    starts, ends : ndarray
+        Start and end of every segment in s since the start of the program
+    targets : ndarray
+        Absolute position in steps at the end of every segment
+    speeds : ndarray
+        Speed of every segment in steps/s
+    max_error : float
+        Largest deviation in mL of the delivered volume from the gradient due to the segments
+    rounding_error : float
+        Largest deviation in mL due to the targets being whole steps, on top of max_error
+    """
+
+    def __init__(self, channel, starts, ends, targets, speeds, max_error, rounding_error):
+        self.channel = channel
+        self.starts = starts
+        self.ends = ends
+        self.targets = targets
+        self.speeds = speeds
+        self.max_error = max_error
+        self.rounding_error = rounding_error
+
+    @property
+    def segment_count(self):
+        return len(self.starts)
+
+    def command_bytes(self):
+        """ Bytes of the MOVE commands if the channel ran its gradient on its own """
+        return sum(len(format_move({self.channel: target}, {self.channel: speed}))
+                   for target, speed in zip(self.targets.tolist(), self.speeds.tolist()) if speed > 0)
+
+
+class GradientPlan:
+    """ Compiled gradient program
+
+    Attributes
+    ----------
+    profiles : dict
+        GradientProfile per channel
+    moves : list of tuple
+        (time in s, targets, speeds) of every MOVE command, targets and speeds are dicts per channel
+    """
+
+    def __init__(self, profiles, moves):
+        self.profiles = profiles
+        self.moves = moves
+
+    def duration(self):
+        return max((float(profile.ends[-1]) for profile in self.profiles.values() if profile.segment_count),
+                   default=0.0)
+
+    def command_count(self):
+        return len(self.moves)
+
+    def command_bytes(self):
+        return sum(len(format_move(targets, speeds)) for _, targets, speeds in self.moves)
+
+    def summary(self):
+        lines = []
+        for channel, profile in sorted(self.profiles.items()):
+            lines.append(f"  channel {channel}: {profile.segment_count} segments, {profile.command_bytes()} bytes, "
+                         f"max error {profile.max_error * 1000:.2f} uL + {profile.rounding_error * 1000:.2f} uL rounding")
+        lines.append(f"  {self.command_count()} MOVE commands, {self.command_bytes()} bytes, "
+                     f"duration {self.duration():.1f}s")
+        return '\n'.join(lines)
+
+
+class GradientProgram:
+    """ Compiles gradients for the given syringe channels
+
+    Parameters
+    ----------
+    syringes : list of SyringeChannel
+        The channels, their syringe area and the step settings give the steps per mL
+    tolerance : float
+        Largest deviation in mL of the delivered volume from the gradient
+    """
+
+    def __init__(self, syringes, tolerance=0.01):
+        if tolerance <= 0:
+            raise GradientError('the tolerance has to be positive')
+        self.syringes = {syringe.channel_number: syringe for syringe in syringes}
+        self.tolerance = tolerance
+        self.steps_per_ml = {channel: syringe.ml_to_steps(1.0) for channel, syringe in self.syringes.items()}
+
+    def compile(self, gradients, start_positions=None):
+        """ Compiles the gradients of all channels into one plan
+
+        Parameters
+        ----------
+        gradients : dict
+            List of (time in s, flow rate in mL/h) breakpoints per channel, the times increasing
+        start_positions : dict
+            Absolute position in steps per channel, the current positions of the syringes if not given
+
+        raises GradientError
+            If a channel is unknown or its breakpoints are invalid
+        """
+        profiles = {}
+        for channel, breakpoints in gradients.items():
+            if channel not in self.syringes:
+                raise GradientError(f"unknown channel {channel}")
+            start_position = self.syringes[channel].absolute_position if start_positions is None \
+                else start_positions[channel]
+            profiles[channel] = self.compile_profile(channel, breakpoints, start_position)
+        return GradientPlan(profiles, self.merge(profiles))
+
+    def compile_profile(self, channel, breakpoints, start_position=0):
+        """ Compiles the breakpoints of one channel into a GradientProfile """
+        breakpoints = np.asarray(breakpoints, dtype=float)
+        if breakpoints.ndim != 2 or breakpoints.shape[1] != 2 or len(breakpoints) < 2:
+            raise GradientError(f"channel {channel}: needs at least two (time, flow rate) breakpoints")
+        times = breakpoints[:, 0]
+        rates = breakpoints[:, 1] / 3600
+        if not np.all(np.isfinite(breakpoints)) or times[0] < 0 or np.any(np.diff(times) <= 0):
+            raise GradientError(f"channel {channel}: breakpoint times have to increase from 0 on")
+
+        # The chord error of a segment is at most |slope| * length^2 / 8, so a segment may span
+        # integral sqrt(|slope| / (8 * tolerance)) dt = 1. Spread the boundaries evenly over that integral.
+        lengths = np.diff(times)
+        slopes = np.diff(rates) / lengths
+        density = np.concatenate(([0.0], np.cumsum(np.sqrt(np.abs(slopes) / (8 * self.tolerance)) * lengths)))
+        count = max(1, int(np.ceil(density[-1])))
+        ends = np.interp(np.arange(1, count + 1) * density[-1] / count, density, times)
+        ends[-1] = times[-1]
+        starts = np.concatenate(([times[0]], ends[:-1]))
+
+        # Segments spanning a flat and a steep piece can still exceed the tolerance, split them up with the
+        # steepest slope they contain
+        first = np.searchsorted(times, starts, 'right') - 1
+        last = np.maximum(first, np.searchsorted(times, ends, 'left') - 1)
+        bounds = np.ravel(np.column_stack((first, last + 1)))
+        steepest = np.maximum.reduceat(np.abs(np.concatenate((slopes, [0.0]))), bounds)[::2]
+        splits = np.maximum(1, np.ceil((ends - starts) * np.sqrt(steepest / (8 * self.tolerance)))).astype(int)
+        segment = np.repeat(np.arange(len(starts)), splits)
+        part = np.arange(len(segment)) - (np.cumsum(splits) - splits)[segment] + 1
+        ends = starts[segment] + part * ((ends - starts) / splits)[segment]
+        ends[-1] = times[-1]
+        starts = np.concatenate(([times[0]], ends[:-1]))
+        max_error = float(np.max(steepest[segment] * (ends - starts) ** 2 / 8))
+
+        # Exact volume of the gradient at the segment ends
+        piece = np.clip(np.searchsorted(times, ends, 'right') - 1, 0, len(lengths) - 1)
+        offsets = ends - times[piece]
+        piece_volumes = np.concatenate(([0.0], np.cumsum((rates[:-1] + rates[1:]) / 2 * lengths)))
+        volumes = piece_volumes[piece] + rates[piece] * offsets + slopes[piece] * offsets ** 2 / 2
+
+        targets = start_position + np.round(volumes * self.steps_per_ml[channel])
+        speeds = np.abs(np.diff(np.concatenate(([start_position], targets)))) / (ends - starts)
+        return GradientProfile(channel, starts, ends, targets, speeds, max_error, 0.5 / self.steps_per_ml[channel])
+
+    @staticmethod
+    def merge(profiles):
+        """ Groups the segments of all channels by their start into MOVE commands """
+        moves = {}
+        for channel, profile in profiles.items():
+            for start, target, speed in zip(profile.starts.tolist(), profile.targets.tolist(), profile.speeds.tolist()):
+                # Nothing to move, the channel is idle for the segment
+                if speed == 0:
+                    continue
+                targets, speeds = moves.setdefault(round(start, 6), ({}, {}))
+                targets[channel] = int(target)
+                speeds[channel] = speed
+        return [(start, targets, speeds) for start, (targets, speeds) in sorted(moves.items())]
+
+
+class GradientExecutor:
+    """ Streams a GradientPlan to the board, every MOVE command is sent at the start of its segments
+
+    A new target replaces the one of the running move, so a channel continues without stopping if its
+    previous segment is not quite done yet.
+    """
+
+    def __init__(self, arduino, plan):
+        self.arduino = arduino
+        self.plan = plan
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.arduino.stop_movement()
+
+    def run(self):
+        """ Executes the plan, blocks until done. Returns False if it was stopped """
+        start = time.monotonic()
+        for index, (offset, targets, speeds) in enumerate(self.plan.moves):
+            if self.stopped.wait(max(0.0, start + offset - time.monotonic())):
+                print(f"Executor> Gradient stopped at move {index}")
+                return False
+            self.arduino.run_channels(targets, speeds)
+
+        for channel in self.plan.profiles:
+            if not self.arduino.wait_for_channel(channel) or self.stopped.is_set():
+                print("Executor> Gradient stopped")
+                return False
+        return True
+
+
+def load_gradients(path):
+    """ Reads {"<channel>": [[time, flow rate], ...]} from a JSON file """
+    with open(path) as gradient_file:
+        return {int(channel): breakpoints for channel, breakpoints in json.load(gradient_file).items()}
+
+
+def main():
+    import configparser
+    from syringe_channel import SyringeChannel
+
+    parser = argparse.ArgumentParser(description='Compile a Poseidon flow-rate gradient')
+    parser.add_argument('gradients')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='Volume tolerance in mL')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    syringes = []
+    for channel in (1, 2, 3):
+        syringe = SyringeChannel(None, channel, config)
+        syringe.set_syringe(config[f"syringe-channel-{channel}"]['size'])
+        syringes.append(syringe)
+
+    start = time.perf_counter()
+    plan = GradientProgram(syringes, args.tolerance).compile(load_gradients(args.gradients))
+    duration = time.perf_counter() - start
+
+    print(f"Compiled in {duration * 1000:.1f}ms")
+    print(plan.summary())
+
+
+if __name__ == "__main__":
+    main()
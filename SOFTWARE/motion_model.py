@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Kinematic model of the moves the firmware runs with AccelStepper, vectorized with NumPy.
+
+    A move from standstill to standstill accelerates with the channel acceleration up to its speed,
+    cruises and decelerates again. Moves too short to reach their speed have a triangular profile.
+    All functions take scalars or arrays and broadcast them, so a whole batch of moves is predicted
+    at once:
+
+        model = MotionModel(syringes)
+        prediction = model.predict([1, 2], starts=[0, 0], targets=[6400, -3200], speeds=[1000, 500],
+                                   accelerations=[5000, 5000])
+        prediction.completion_time()         # s until the last channel arrived
+        prediction.position(0.5)             # positions in steps after 0.5 s
+        prediction.flow_rate(0.5)            # mL/h of every channel after 0.5 s
+
+    AccelStepper does not start from zero speed but with its first step interval of 0.676 * sqrt(2 / a),
+    and the last step of a deceleration takes as long. The profiles start and end at that speed, so
+    the predictions agree with the emulator within one telemetry period, see "python benchmarks.py model".
+"""
+import numpy as np
+
+# AccelStepper::computeNewSpeed() starts with the step interval 0.676 * sqrt(2 / acceleration)
+FIRST_STEP_FACTOR = 1 / (0.676 * 2 ** 0.5)
+
+
+def first_step_speed(speed, acceleration):
+    """ Speed in steps/s of the first and the last step of a move, at most the maximum speed """
+    return np.minimum(np.asarray(speed, dtype=float),
+                      FIRST_STEP_FACTOR * np.sqrt(np.asarray(acceleration, dtype=float)))
+
+
+def trapezoid(distance, speed, acceleration):
+    """ Profile of moves from standstill to standstill
+
+    The moves start and end with the speed of their first step, see first_step_speed().
+
+    Parameters
+    ----------
+    distance : array_like
+        Distance in steps, the sign is ignored
+    speed : array_like
+        Maximum speed in steps/s
+    acceleration : array_like
+        Acceleration and deceleration in steps/s^2
+
+    Returns
+    -------
+    tuple of ndarray
+        (peak speed in steps/s, duration of the acceleration in s, duration of the cruise in s, duration in s)
+    """
+    distance = np.abs(np.asarray(distance, dtype=float))
+    speed = np.asarray(speed, dtype=float)
+    acceleration = np.asarray(acceleration, dtype=float)
+    initial = first_step_speed(speed, acceleration)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Too short to reach the maximum speed, the profile is a triangle
+        peak = np.minimum(speed, np.sqrt(distance * acceleration + initial * initial))
+        ramp = (peak - initial) / acceleration
+        cruise = np.where(peak > 0, (distance - (peak + initial) * ramp) / peak, 0.0)
+        duration = np.where(distance == 0, 0.0, np.where(speed > 0, 2 * ramp + cruise, np.inf))
+    return peak, np.where(distance == 0, 0.0, ramp), np.where(distance == 0, 0.0, cruise), duration
+
+
+def move_durations(distance, speed, acceleration):
+    """ Duration in s of moves from standstill to standstill, the vectorized sequence_scheduler.move_duration() """
+    return trapezoid(distance, speed, acceleration)[3]
+
+
+def displacement(t, distance, speed, acceleration):
+    """ Steps moved t seconds after the start of the moves, with the sign of the distance """
+    t = np.asarray(t, dtype=float)
+    distance = np.asarray(distance, dtype=float)
+    acceleration = np.asarray(acceleration, dtype=float)
+    peak, ramp, cruise, duration = trapezoid(distance, speed, acceleration)
+    initial = first_step_speed(speed, acceleration)
+
+    t = np.clip(t, 0.0, duration)
+    left = duration - t
+    moved = np.where(
+        t < ramp, initial * t + 0.5 * acceleration * t * t,
+        np.where(t < ramp + cruise, 0.5 * (peak + initial) * ramp + peak * (t - ramp),
+                 np.abs(distance) - initial * left - 0.5 * acceleration * left * left))
+    return np.sign(distance) * np.where(np.isfinite(duration), moved, 0.0)
+
+
+def velocity(t, distance, speed, acceleration):
+    """ Speed in steps/s t seconds after the start of the moves, with the sign of the distance """
+    t = np.asarray(t, dtype=float)
+    distance = np.asarray(distance, dtype=float)
+    acceleration = np.asarray(acceleration, dtype=float)
+    peak, ramp, cruise, duration = trapezoid(distance, speed, acceleration)
+    initial = first_step_speed(speed, acceleration)
+
+    current = np.where(
+        t < 0, 0.0,
+        np.where(t < ramp, initial + acceleration * t,
+                 np.where(t < ramp + cruise, peak,
+                          np.where(t < duration, initial + acceleration * (duration - t), 0.0))))
+    return np.sign(distance) * np.where(np.isfinite(duration), current, 0.0)
+
+
+class MovePrediction:
+    """ Predicted course of a batch of moves which start at the same time
+
+    Times are given in s since the start of the moves. Methods taking a time broadcast it against the
+    moves, an array of m times returns m rows with one column per move.
+    """
+
+    def __init__(self, channels, starts, targets, speeds, accelerations, ml_per_step):
+        self.channels = np.asarray(channels)
+        self.starts = np.asarray(starts, dtype=float)
+        self.targets = np.asarray(targets, dtype=float)
+        self.speeds = np.asarray(speeds, dtype=float)
+        self.accelerations = np.asarray(accelerations, dtype=float)
+        self.distances = self.targets - self.starts
+        self.ml_per_step = np.asarray(ml_per_step, dtype=float)
+        self.durations = move_durations(self.distances, self.speeds, self.accelerations)
+
+    def completion_time(self):
+        """ s until the last move finished """
+        return float(self.durations.max()) if self.durations.size else 0.0
+
+    def position(self, t):
+        """ Absolute positions in steps """
+        return self.starts + displacement(np.asarray(t, dtype=float)[..., None], self.distances, self.speeds,
+                                          self.accelerations)
+
+    def remaining(self, t):
+        """ Steps still to go, like the r1..r3 telemetry """
+        return self.targets - self.position(t)
+
+    def velocity(self, t):
+        """ Speeds in steps/s """
+        return velocity(np.asarray(t, dtype=float)[..., None], self.distances, self.speeds, self.accelerations)
+
+    def flow_rate(self, t):
+        """ Flow rates in mL/h, positive while the syringe dispenses """
+        return self.velocity(t) * self.ml_per_step * 3600
+
+    def eta(self, elapsed):
+        """ s until every move finished, elapsed s after the start """
+        return max(0.0, self.completion_time() - elapsed)
+
+
+class MotionModel:
+    """ Predicts the moves of the syringe channels from their SyringeChannel parameters
+
+    Parameters
+    ----------
+    syringes : list of SyringeChannel
+        The channels, their syringe area and the step settings give the volume per step
+    """
+
+    def __init__(self, syringes):
+        self.syringes = {syringe.channel_number: syringe for syringe in syringes}
+        self.ml_per_step = {channel: syringe.steps_to_ml(1.0) for channel, syringe in self.syringes.items()}
+
+    def predict(self, channels, starts, targets, speeds, accelerations=None):
+        """ Predicts moves which start together
+
+        Parameters
+        ----------
+        channels : array_like
+            Channel (1..3) of every move, a channel may appear several times to compare alternatives
+        starts, targets : array_like
+            Absolute positions in steps
+        speeds : array_like
+            Maximum speeds in steps/s
+        accelerations : array_like
+            Accelerations in steps/s^2, the configured ones of the channels if not given
+        """
+        channels = np.atleast_1d(channels)
+        if accelerations is None:
+            accelerations = [self.syringes[channel].get_acceleration() for channel in channels]
+        ml_per_step = [self.ml_per_step[channel] for channel in channels]
+        return MovePrediction(channels, starts, targets, speeds, accelerations, ml_per_step)
+
+    def predict_run(self, channels=None):
+        """ Predicts the runs of the channels with their current run settings, see SyringeChannel.get_run_parameters() """
+        channels = sorted(self.syringes) if channels is None else list(channels)
+        starts, targets, speeds = [], [], []
+        for channel in channels:
+            syringe = self.syringes[channel]
+            target, speed = syringe.get_run_parameters()
+            starts.append(syringe.absolute_position)
+            targets.append(target)
+            speeds.append(speed)
+        return self.predict(channels, starts, targets, speeds)
+
+    def completion_times(self, start_positions, moves):
+        """ Times in s at which each move of a sequence finished
+
+        Every move starts once all channels of the previous one arrived, like PlanExecutor.run_stepwise().
+
+        Parameters
+        ----------
+        start_positions : dict
+            Absolute position in steps per channel before the first move
+        moves : list of tuple
+            (targets, speeds) or (targets, speeds, accelerations), dicts per channel like Arduino.run_channels()
+
+        Returns
+        -------
+        ndarray
+            Cumulative completion time of every move
+        """
+        if not moves:
+            return np.zeros(0)
+
+        positions = dict(start_positions)
+        distances, speeds, accelerations, owners = [], [], [], []
+        for index, move in enumerate(moves):
+            targets, move_speeds = move[0], move[1]
+            move_accelerations = move[2] if len(move) > 2 and move[2] else {}
+            for channel, target in targets.items():
+                distances.append(target - positions.get(channel, 0))
+                speeds.append(move_speeds[channel])
+                accelerations.append(move_accelerations.get(channel, self.syringes[channel].get_acceleration()))
+                owners.append(index)
+                positions[channel] = target
+
+        durations = move_durations(distances, speeds, accelerations)
+        # Every move takes as long as its slowest channel, moves without channels take no time
+        move_times = np.zeros(len(moves))
+        np.maximum.at(move_times, owners, durations)
+        return np.cumsum(move_times)
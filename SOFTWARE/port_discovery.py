@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Discovery of the serial ports an Arduino running the Poseidon firmware could be connected to.
+
+    Ports are listed with serial.tools.list_ports, which reads the USB metadata from the system
+    instead of opening every possible device. Known Arduino and USB serial adapter VID:PIDs are
+    ranked first. Ports without known metadata are probed in parallel with short timeouts, and
+    optionally every port is checked for the <Arduino Board is ready> banner. Probe results are
+    cached until they expire, the port disappears or the cache is invalidated.
+
+    Usage:
+        python port_discovery.py [--handshake] [--baudrate BAUDRATE]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+from serial.tools import list_ports
+
+from serial_messages import BANNER
+
+# Rank of a port by its USB vendor and product id, lower is better. None matches any product id.
+RANK_BOARD = 0
+RANK_ADAPTER = 1
+RANK_USB = 2
+RANK_UNKNOWN = 3
+
+KNOWN_DEVICES = {
+    (0x2341, None): RANK_BOARD,     # Arduino
+    (0x2A03, None): RANK_BOARD,     # Arduino.org
+    (0x1A86, 0x7523): RANK_BOARD,   # CH340, most Arduino clones
+    (0x1A86, 0x5523): RANK_BOARD,   # CH341
+    (0x0403, 0x6001): RANK_ADAPTER,  # FTDI FT232R
+    (0x10C4, 0xEA60): RANK_ADAPTER,  # Silicon Labs CP210x
+}
+
+
+class PortCandidate:
+    """ A serial port which could be a Poseidon board
+
+    verified is None as long as the port was not checked for the banner, True if the banner was
+    received and False if not.
+    """
+
+    def __init__(self, device, description='', vid=None, pid=None, serial_number=None):
+        self.device = device
+        self.description = description
+        self.vid = vid
+        self.pid = pid
+        self.serial_number = serial_number
+        self.rank = rank_device(vid, pid)
+        self.verified = None
+
+    def key(self):
+        """ Identifies the device behind the port, a different board on the same port gets a new key """
+        return self.device, self.vid, self.pid, self.serial_number
+
+    def __repr__(self):
+        return f"PortCandidate({self.device!r}, {self.description!r}, rank={self.rank}, verified={self.verified})"
+
+
+def rank_device(vid, pid):
+    if vid is None:
+        return RANK_UNKNOWN
+    return KNOWN_DEVICES.get((vid, pid), KNOWN_DEVICES.get((vid, None), RANK_USB))
+
+
+class PortDiscovery:
+    """ Lists, ranks and probes serial ports, caching the probe results
+
+    Parameters
+    ----------
+    probe_timeout : float
+        Seconds a port without known metadata may take to open
+    handshake_timeout : float
+        Seconds to wait for the banner, the board resets when the port is opened and needs about 1s to boot
+    cache_ttl : float
+        Seconds a probe result is reused
+    workers : int
+        Ports probed at the same time
+    """
+
+    def __init__(self, probe_timeout=0.5, handshake_timeout=2.5, cache_ttl=30.0, workers=16):
+        self.probe_timeout = probe_timeout
+        self.handshake_timeout = handshake_timeout
+        self.cache_ttl = cache_ttl
+        self.workers = workers
+
+        # key -> (time of the probe, usable, verified)
+        self.cache = {}
+
+    def invalidate(self):
+        self.cache.clear()
+
+    def list_candidates(self):
+        return [PortCandidate(port.device, port.description or '', port.vid, port.pid, port.serial_number)
+                for port in list_ports.comports()]
+
+    def discover(self, handshake=False, baudrate=230400, exclude=()):
+        """ Returns the usable ports, best candidates first
+
+        Parameters
+        ----------
+        handshake : bool
+            Open every port and only keep those which print the banner. This resets the boards.
+        baudrate : int
+            Baudrate of the handshake
+        exclude : list of str
+            Ports which must not be opened, e.g. the one currently connected. They are kept as they are.
+
+        Returns
+        -------
+        list of PortCandidate
+        """
+        candidates = self.list_candidates()
+        now = time.monotonic()
+
+        # Forget probes of ports which are gone or expired
+        keys = {candidate.key() for candidate in candidates}
+        for key, (probed_at, _, _) in list(self.cache.items()):
+            if key not in keys or now - probed_at > self.cache_ttl:
+                del self.cache[key]
+
+        usable = []
+        to_probe = []
+        for candidate in candidates:
+            cached = self.cache.get(candidate.key())
+            if candidate.device in exclude:
+                usable.append(candidate)
+            elif cached is not None and (not handshake or cached[2] is not None):
+                if cached[1]:
+                    candidate.verified = cached[2]
+                    usable.append(candidate)
+            elif handshake or candidate.rank >= RANK_USB:
+                to_probe.append(candidate)
+            else:
+                # Known boards and adapters are not opened, that would reset the board
+                usable.append(candidate)
+
+        if to_probe:
+            with ThreadPoolExecutor(min(self.workers, len(to_probe))) as pool:
+                results = list(pool.map(lambda candidate: self.probe(candidate, handshake, baudrate), to_probe))
+            for candidate, (is_usable, verified) in zip(to_probe, results):
+                self.cache[candidate.key()] = (now, is_usable, verified)
+                if is_usable and verified is not False:
+                    candidate.verified = verified
+                    usable.append(candidate)
+
+        usable.sort(key=lambda candidate: (candidate.verified is not True, candidate.rank, candidate.device))
+        return usable
+
+    def probe(self, candidate, handshake, baudrate):
+        """ Opens the port, with handshake waits for the banner. Returns (usable, verified) """
+        try:
+            port = serial.Serial(candidate.device, baudrate, timeout=self.probe_timeout,
+                                 write_timeout=self.probe_timeout)
+        except (OSError, ValueError, serial.SerialException):
+            return False, None
+
+        try:
+            if not handshake:
+                return True, None
+
+            deadline = time.monotonic() + self.handshake_timeout
+            port.timeout = 0.1
+            received = bytearray()
+            while time.monotonic() < deadline:
+                received += port.read(max(1, port.in_waiting))
+                if BANNER in received:
+                    return True, True
+                # Only the tail can contain the start of the banner
+                del received[:-len(BANNER)]
+            return True, False
+        except (OSError, serial.SerialException):
+            return False, None
+        finally:
+            port.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the serial ports a Poseidon board could be connected to')
+    parser.add_argument('--handshake', action='store_true', help='Open the ports and wait for the board banner')
+    parser.add_argument('--baudrate', type=int, default=230400)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    candidates = PortDiscovery().discover(args.handshake, args.baudrate)
+    duration = time.perf_counter() - start
+
+    for candidate in candidates:
+        print(candidate)
+    print(f"Discovery> {len(candidates)} ports in {duration * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,9 @@ class PoseidonConfig:
         config['connection'] = {
             'com-port': '',
             'baudrate': 230400,
-            'auto-connect': False
+            'auto-connect': False,
+            'connect-timeout': 5,
+            'binary-protocol': False
         }
 
         config['misc'] = {
@@ -21,7 +23,8 @@ class PoseidonConfig:
             'jog-speed': 10,
             'mm-per-rotation': 2,
             'steps-per-rotation': 200,
-            'microsteps': 32
+            'microsteps': 32,
+            'ratio-lock': False
         }
 
         config['syringe-channel-1'] = {
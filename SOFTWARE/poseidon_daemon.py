@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Headless daemon which owns the connection to one board and shares it with several clients.
+
+    Clients connect to a Unix or TCP socket and send JSON-RPC 2.0 requests, one JSON document per
+    line. A line may also hold a batch, a list of requests. The requests of a batch are started in
+    order, so their commands reach the board in order, and the responses are sent back as one list.
+
+        {"jsonrpc": "2.0", "id": 1, "method": "jog", "params": {"channel": 1, "position": 6400, "speed": 1000}}
+
+    Methods
+        status()                                     Positions, remaining steps and channel owners
+        acquire(channels) / release(channels)        Reserve channels for this client
+        jog(channel, position, speed, acceleration)  Move one channel to an absolute position in steps
+        run(targets, speeds, accelerations)          Move several channels, {"channel": steps} and {"channel": steps/s}
+        wait(channel, timeout)                       Wait until the channel reached its target
+        stop(), pause(), resume(), zero(), enable(), disable()
+        subscribe(rate, on_change) / unsubscribe(subscription)
+
+    Moving a channel needs it to be free or acquired by the calling client. pause, resume, zero,
+    enable and disable affect all channels and are refused while another client holds any of them.
+    stop is always accepted. The channels of a client are released when it disconnects.
+
+    Subscribed clients receive "positions" notifications. They are dropped for clients which do not
+    read their socket, so a stuck notebook cannot stall the daemon.
+
+    Usage:
+        python poseidon_daemon.py <port> [--socket PATH | --tcp HOST:PORT] [--baudrate BAUDRATE]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+
+from async_arduino import AsyncArduino
+from serial_commands import AcknowledgementException
+
+# JSON-RPC 2.0 error codes, the ones above -32100 are defined by the daemon
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+CHANNEL_LOCKED = -32000
+BOARD_ERROR = -32001
+
+DEFAULT_SOCKET = '/tmp/poseidon.sock'
+
+
+class RpcException(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class ClientSession:
+    """ A connected client, its reserved channels and position subscriptions """
+
+    def __init__(self, client_id, writer):
+        self.client_id = client_id
+        self.writer = writer
+        self.subscriptions = {}
+        # Requests in progress, referenced so they are not garbage collected
+        self.tasks = set()
+
+    def send(self, document):
+        self.writer.write(json.dumps(document).encode() + b'\n')
+
+
+class PoseidonDaemon:
+    """ Serves the API of one board to any number of socket clients
+
+    Parameters
+    ----------
+    board : AsyncArduino
+        The board, connected by start()
+    notification_buffer : int
+        Bytes a client may leave unread before its position notifications are dropped
+    """
+
+    def __init__(self, board, notification_buffer=65536):
+        self.board = board
+        self.notification_buffer = notification_buffer
+        self.server = None
+        self.sessions = set()
+        self.client_ids = itertools.count(1)
+        self.subscription_ids = itertools.count(1)
+        self.motors_enabled = False
+
+        # Channel (1..3) -> ClientSession which acquired it
+        self.owners = {}
+
+        self.methods = {
+            'status': self.rpc_status,
+            'acquire': self.rpc_acquire,
+            'release': self.rpc_release,
+            'jog': self.rpc_jog,
+            'run': self.rpc_run,
+            'wait': self.rpc_wait,
+            'stop': self.rpc_stop,
+            'pause': self.rpc_pause,
+            'resume': self.rpc_resume,
+            'zero': self.rpc_zero,
+            'enable': self.rpc_enable,
+            'disable': self.rpc_disable,
+            'subscribe': self.rpc_subscribe,
+            'unsubscribe': self.rpc_unsubscribe,
+        }
+
+    async def start(self, path=None, host=None, port=None):
+        """ Connects the board and listens on the Unix socket path, or on host:port if no path is given """
+        await self.board.connect()
+        self.motors_enabled = True
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(self.serve_client, path)
+            print(f"Daemon> Listening on {path}")
+        else:
+            self.server = await asyncio.start_server(self.serve_client, host, port)
+            print(f"Daemon> Listening on {host}:{port}")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for session in list(self.sessions):
+            session.writer.close()
+        await self.board.disconnect()
+
+    # ########
+    # Sessions
+    # ########
+    async def serve_client(self, reader, writer):
+        session = ClientSession(next(self.client_ids), writer)
+        self.sessions.add(session)
+        print(f"Daemon> Client {session.client_id} connected")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    # Handled concurrently, a client waiting for a channel can still stop it
+                    task = asyncio.ensure_future(self.handle_line(session, line))
+                    session.tasks.add(task)
+                    task.add_done_callback(session.tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            self.close_session(session)
+
+    def close_session(self, session):
+        self.sessions.discard(session)
+        for subscription in session.subscriptions.values():
+            subscription.cancel()
+        session.subscriptions.clear()
+        for channel, owner in list(self.owners.items()):
+            if owner is session:
+                del self.owners[channel]
+        session.writer.close()
+        print(f"Daemon> Client {session.client_id} disconnected")
+
+    async def handle_line(self, session, line):
+        try:
+            document = json.loads(line)
+        except ValueError:
+            response = error_response(None, PARSE_ERROR, 'Parse error')
+        else:
+            if isinstance(document, list):
+                if not document:
+                    response = error_response(None, INVALID_REQUEST, 'Empty batch')
+                else:
+                    responses = await asyncio.gather(*[self.handle_request(session, request) for request in document])
+                    response = [response for response in responses if response is not None] or None
+            else:
+                response = await self.handle_request(session, document)
+
+        if response is not None and not session.writer.is_closing():
+            session.send(response)
+
+    async def handle_request(self, session, request):
+        """ Executes a single request, returns its response or None for notifications """
+        if not isinstance(request, dict) or request.get('jsonrpc') != '2.0' or not isinstance(request.get('method'), str):
+            return error_response(None, INVALID_REQUEST, 'Invalid request')
+
+        request_id = request.get('id')
+        method = self.methods.get(request['method'])
+        params = request.get('params', {})
+        try:
+            if method is None:
+                raise RpcException(METHOD_NOT_FOUND, f"Unknown method {request['method']}")
+            if not isinstance(params, dict):
+                raise RpcException(INVALID_PARAMS, 'Params have to be given by name')
+            try:
+                result = await method(session, **params)
+            except (TypeError, ValueError) as error:
+                raise RpcException(INVALID_PARAMS, str(error))
+            except AcknowledgementException as error:
+                raise RpcException(BOARD_ERROR, str(error))
+            except asyncio.CancelledError:
+                raise RpcException(BOARD_ERROR, 'Command was cancelled by a stop')
+        except RpcException as error:
+            if 'id' not in request:
+                return None
+            return error_response(request_id, error.code, str(error))
+
+        if 'id' not in request:
+            return None
+        return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+    # ###########
+    # Arbitration
+    # ###########
+    def check_channels(self, session, channels):
+        """ Raises RpcException unless all channels are free or held by the session """
+        for channel in channels:
+            owner = self.owners.get(channel)
+            if owner is not None and owner is not session:
+                raise RpcException(CHANNEL_LOCKED, f"Channel {channel} is held by client {owner.client_id}")
+
+    # ###########
+    # RPC Methods
+    # ###########
+    async def rpc_status(self, session):
+        message = self.board.last_position
+        return {
+            'client': session.client_id,
+            'connected': self.board.connected,
+            'enabled': self.motors_enabled,
+            'positions': list(message.positions) if message is not None else None,
+            'remaining': list(message.remaining) if message is not None else None,
+            'timestamp': message.timestamp if message is not None else None,
+            'owners': {str(channel): owner.client_id for channel, owner in self.owners.items()},
+        }
+
+    async def rpc_acquire(self, session, channels):
+        channels = [parse_channel(channel) for channel in channels]
+        self.check_channels(session, channels)
+        for channel in channels:
+            self.owners[channel] = session
+        return sorted(channel for channel, owner in self.owners.items() if owner is session)
+
+    async def rpc_release(self, session, channels=None):
+        channels = [1, 2, 3] if channels is None else [parse_channel(channel) for channel in channels]
+        for channel in channels:
+            if self.owners.get(channel) is session:
+                del self.owners[channel]
+        return sorted(channel for channel, owner in self.owners.items() if owner is session)
+
+    async def rpc_jog(self, session, channel, position, speed, acceleration=None):
+        channel = parse_channel(channel)
+        self.check_channels(session, [channel])
+        await self.board.jog(channel, float(position), float(speed),
+                             float(acceleration) if acceleration is not None else None)
+
+    async def rpc_run(self, session, targets, speeds, accelerations=None):
+        targets = {parse_channel(channel): float(position) for channel, position in targets.items()}
+        speeds = {parse_channel(channel): float(speed) for channel, speed in speeds.items()}
+        accelerations = {parse_channel(channel): float(acceleration)
+                         for channel, acceleration in (accelerations or {}).items()}
+        if set(targets) != set(speeds) or not set(accelerations) <= set(targets):
+            raise ValueError('speeds and accelerations need the channels of the targets')
+        self.check_channels(session, targets)
+        await self.board.run_channels(targets, speeds, accelerations)
+
+    async def rpc_wait(self, session, channel, timeout=None):
+        return await self.board.wait_for_channel(parse_channel(channel), timeout)
+
+    async def rpc_stop(self, session):
+        await self.board.stop_movement()
+
+    async def rpc_pause(self, session):
+        self.check_channels(session, [1, 2, 3])
+        await self.board.pause_movement()
+
+    async def rpc_resume(self, session):
+        self.check_channels(session, [1, 2, 3])
+        await self.board.resume_movement()
+
+    async def rpc_zero(self, session):
+        self.check_channels(session, [1, 2, 3])
+        await self.board.zero()
+
+    async def rpc_enable(self, session):
+        self.check_channels(session, [1, 2, 3])
+        await self.board.enable_motors()
+        self.motors_enabled = True
+
+    async def rpc_disable(self, session):
+        self.check_channels(session, [1, 2, 3])
+        await self.board.disable_motors()
+        self.motors_enabled = False
+
+    async def rpc_subscribe(self, session, rate, on_change=False):
+        rate = float(rate)
+        if rate <= 0:
+            raise ValueError('rate has to be positive')
+        subscription_id = next(self.subscription_ids)
+
+        def notify(message):
+            transport = session.writer.transport
+            if transport.is_closing() or transport.get_write_buffer_size() > self.notification_buffer:
+                return
+            session.send({'jsonrpc': '2.0', 'method': 'positions', 'params': {
+                'subscription': subscription_id,
+                'positions': list(message.positions),
+                'remaining': list(message.remaining),
+                'timestamp': message.timestamp,
+            }})
+
+        session.subscriptions[subscription_id] = self.board.subscribe_positions(rate, notify, bool(on_change))
+        return subscription_id
+
+    async def rpc_unsubscribe(self, session, subscription):
+        subscription = session.subscriptions.pop(subscription, None)
+        if subscription is None:
+            return False
+        subscription.cancel()
+        return True
+
+
+def parse_channel(channel):
+    channel = int(channel)
+    if channel not in (1, 2, 3):
+        raise ValueError(f"Invalid channel {channel}")
+    return channel
+
+
+def error_response(request_id, code, message):
+    return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': code, 'message': message}}
+
+
+class PoseidonClient:
+    """ Blocking client of the daemon for scripts and notebooks
+
+        client = PoseidonClient('/tmp/poseidon.sock')
+        client.call('jog', channel=1, position=6400, speed=1000)
+        client.call('wait', channel=1, timeout=30)
+
+    Position notifications received while waiting for a response are kept in notifications.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, host=None, port=None):
+        if host is not None:
+            self.socket = socket.create_connection((host, port))
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(path)
+        self.stream = self.socket.makefile('rb')
+        self.request_ids = itertools.count(1)
+        self.notifications = []
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def call(self, method, **params):
+        """ Calls a method and returns its result, raises RpcException if it failed """
+        request_id = next(self.request_ids)
+        self.send({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params})
+        return result_of(self.receive())
+
+    def batch(self, calls):
+        """ Sends [(method, params), ...] as one batch and returns the results in the same order
+
+        A failed call is returned as its RpcException instead of raising it.
+        """
+        requests = [{'jsonrpc': '2.0', 'id': next(self.request_ids), 'method': method, 'params': params}
+                    for method, params in calls]
+        self.send(requests)
+        responses = {response['id']: response for response in self.receive()}
+        results = []
+        for request in requests:
+            try:
+                results.append(result_of(responses[request['id']]))
+            except RpcException as error:
+                results.append(error)
+        return results
+
+    def send(self, document):
+        self.socket.sendall(json.dumps(document).encode() + b'\n')
+
+    def receive(self):
+        """ Returns the next response, notifications in between are stored """
+        while True:
+            line = self.stream.readline()
+            if not line:
+                raise ConnectionError('Daemon closed the connection')
+            document = json.loads(line)
+            if isinstance(document, dict) and 'id' not in document:
+                self.notifications.append(document)
+            else:
+                return document
+
+
+def result_of(response):
+    if 'error' in response:
+        raise RpcException(response['error']['code'], response['error']['message'])
+    return response['result']
+
+
+async def serve(args):
+    daemon = PoseidonDaemon(AsyncArduino(args.port, args.baudrate))
+    if args.tcp is not None:
+        host, port = args.tcp.rsplit(':', 1)
+        await daemon.start(host=host, port=int(port))
+    else:
+        await daemon.start(path=args.socket)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await daemon.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share one Poseidon board with several clients over JSON-RPC')
+    parser.add_argument('port', help='Serial port of the board')
+    parser.add_argument('--baudrate', type=int, default=230400)
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket to listen on')
+    parser.add_argument('--tcp', help='HOST:PORT to listen on instead of the Unix socket, e.g. 127.0.0.1:8765')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
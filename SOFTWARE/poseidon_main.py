@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import time
 from datetime import datetime
 import os
 import serial
@@ -26,6 +25,8 @@ import poseidon_config
 from thread import Thread
 from syringe_channel import *
 from arduino_connection import Arduino, CannotConnectException
+from sequence_scheduler import SequenceScheduler
+from sequence_simulator import SequenceSimulator
 
 # #####################################
 # ERROR HANDLING : CANNOT CONNECT CLASS
@@ -75,10 +76,7 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
         self.ui.channel_3_slider.setValue(0)
 
         for channel_number in [1, 2, 3]:
-            sc = self.syringes[channel_number - 1]
-            sc.syringe_size = self.config[f"syringe-channel-{channel_number}"]['size']
-            sc.syringe_area = self.syringe_options[sc.syringe_size]['area']
-            sc.syringe_total_volume = self.syringe_options[sc.syringe_size]['volume']
+            self.syringes[channel_number - 1].set_syringe(self.config[f"syringe-channel-{channel_number}"]['size'])
 
         # Connect all UI Objects to the necessary functions
         self.connect_all_gui_components()
@@ -121,7 +119,8 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
         # ~~~~~~~~~~~~~~~~~~~~~~~~
 
         self.arduino.motors_changed_callback = self.ui_update_motor_state
-        self.arduino.position_update_callback = self.callback_position_update
+        # The displays don't need more than 20 updates per second, the board reports at most that fast
+        self.position_subscription = self.arduino.subscribe_positions(20, self.callback_position_update)
         self.ui.side_motors_button.clicked.connect(self.ui_toggle_motor_state_clicked)
 
         self.ui.side_num_pad_0_button.clicked.connect(lambda: self.keystroke('0'))
@@ -165,9 +164,16 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
             vol_input.setValue(float(self.config[f"syringe-channel-{sc.channel_number}"]['volume']))
 
             spd_input.setDecimals(syringe_option['speed-decimals'])
-            spd_input.setMaximum(syringe_option['speed-maximum'])
+            # Faster than the firmware can step is not possible with the selected syringe
+            spd_input.setMaximum(min(syringe_option['speed-maximum'], sc.get_flow_envelope().max_flow))
             spd_input.setSingleStep(syringe_option['speed-step'])
             spd_input.setValue(float(self.config[f"syringe-channel-{sc.channel_number}"]['speed']))
+            # Speed changes apply to a running channel once the input rests, not on every keystroke or arrow click
+            timer = QtCore.QTimer(self)
+            timer.setSingleShot(True)
+            timer.setInterval(300)
+            timer.timeout.connect(lambda channel=sc.channel_number: self.update_flow_rate(channel))
+            spd_input.valueChanged.connect(lambda _, timer=timer: timer.start())
 
         self.ui.jog_delta_input.setValue(float(self.config['misc']['jog-distance']))
         self.ui.jog_delta_speed_input.setValue(float(self.config['misc']['jog-speed']))
@@ -228,14 +234,11 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
     # FUNCTIONS : Controller
     # ======================
 
-    def callback_position_update(self, p1, r1, p2, r2, p3, r3):
+    def callback_position_update(self, message):
         # Syringe Channel Feedback
-        self.syringe_channel_1.absolute_position = p1
-        self.syringe_channel_1.remaining_volume = r1
-        self.syringe_channel_2.absolute_position = p2
-        self.syringe_channel_2.remaining_volume = r2
-        self.syringe_channel_3.absolute_position = p3
-        self.syringe_channel_3.remaining_volume = r3
+        for syringe, position, remaining in zip(self.syringes, message.positions, message.remaining):
+            syringe.absolute_position = position
+            syringe.remaining_volume = remaining
 
         self.ui_update_syringe_channel_position_displays()
 
@@ -273,7 +276,18 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
             # time.sleep(0.2)
 
     def run(self, channel):
+        syringe = self.update_run_settings(channel)
 
+        # get run distance in mm from SC Object
+        absolute_position, run_speed = syringe.get_run_parameters()
+        if run_speed <= 0:
+            self.statusBar().showMessage(f"Set a speed for channel {channel} before running it")
+            return
+
+        self.arduino.jog(channel, absolute_position, run_speed, syringe.get_acceleration())
+
+    def update_run_settings(self, channel):
+        """ Stores speed and volume inputs of the channel in the config and displays the resulting speed """
         vol_input, spd_input, syringe = [
             (self.ui.channel_1_volume_input, self.ui.channel_1_speed_input, self.syringe_channel_1),
             (self.ui.channel_2_volume_input, self.ui.channel_2_speed_input, self.syringe_channel_2),
@@ -283,13 +297,22 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
         self.config[f"syringe-channel-{channel}"]['speed'] = str(spd_input.value())
         self.config[f"syringe-channel-{channel}"]['volume'] = str(vol_input.value())
 
-        # get run distance in mm from SC Object
-        absolute_position, run_speed = syringe.get_run_parameters()
+        _, run_speed = syringe.get_run_parameters()
 
         lcds = [self.ui.channel_1_speed_lcd, self.ui.channel_2_speed_lcd, self.ui.channel_3_speed_lcd]
         lcds[channel - 1].display(syringe.steps_to_mm(run_speed))
 
-        self.arduino.jog(channel, absolute_position, run_speed)
+        return syringe
+
+    def update_flow_rate(self, channel):
+        """ Changes the speed of a running channel in place, it keeps its target """
+        syringe = self.update_run_settings(channel)
+        if not self.arduino.connected or not syringe.running:
+            return
+
+        _, run_speed = syringe.get_run_parameters()
+        if run_speed > 0:
+            self.arduino.update_speed(channel, run_speed)
 
     def jog(self, channel, direction):
         print(f"Main> Jog Command. Forward To Arduino Object")
@@ -300,36 +323,50 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
         lcds = [self.ui.channel_1_speed_lcd, self.ui.channel_2_speed_lcd, self.ui.channel_3_speed_lcd]
         lcds[channel - 1].display(self.config['misc']['jog-speed'])
 
-        absolute_position, jog_speed = self.syringes[channel - 1].get_jog_parameters(direction)
+        syringe = self.syringes[channel - 1]
+        jog_distance, jog_speed = syringe.get_jog_parameters(direction)
+        if jog_speed <= 0:
+            self.statusBar().showMessage("Set a jog speed before jogging")
+            return
 
-        self.arduino.jog(channel, absolute_position, jog_speed)
+        # Quick clicks add up on the board, they are not taken from the last reported position
+        self.arduino.jog_by(channel, jog_distance, jog_speed, syringe.get_acceleration())
 
     def run_sequence_thread(self):
         print('Woot')
+        # The inputs are read here on the GUI thread, the worker only plans, checks and runs the sequence
+        for channel in [1, 2, 3]:
+            self.update_run_settings(channel)
+
         self.run_sequence_thread = Thread(self.run_sequence)
+        # The result arrives on the GUI thread
+        self.run_sequence_thread.signals.result.connect(self.ui_sequence_rejected)
         self.run_sequence_thread.start()
 
     def run_sequence(self):
-        # Run Channel 1
-        self.run(1)
-        self.syringe_channel_1.running = True
-        print('Go into Wait Loop')
-        while self.syringe_channel_1.running:
-            time.sleep(1)
-            print('Still Running')
-
-        print('SC1 finished')
-
-        self.run(2)
-        self.syringe_channel_2.running = True
-        while self.syringe_channel_2.running:
-            time.sleep(1)
-
-        self.run(3)
-        self.syringe_channel_3.running = True
-        while self.syringe_channel_3.running:
-            time.sleep(1)
-
+        """ Runs the sequence unless its dry run fails, returns the issues of the dry run """
+        # Channels with the same sequence-position run in parallel
+        scheduler = SequenceScheduler(self.arduino, self.syringes,
+                                      self.config['misc'].get('ratio-lock') in (True, 'True'))
+        plan = scheduler.plan()
+        print(f"Main> Sequence of {len(plan)} groups, predicted duration {scheduler.makespan(plan):.1f}s")
+
+        # Reject sequences which cannot run before any fluid moves
+        dry_run = SequenceSimulator(self.syringes).simulate_sequence(plan)
+        if not dry_run.feasible:
+            for issue in dry_run.issues:
+                print(f"Main> Sequence rejected: {issue}")
+            return dry_run.issues
+
+        scheduler.execute(plan)
+        return []
+
+    def ui_sequence_rejected(self, issues):
+        if not issues:
+            return
+        self.statusBar().showMessage(f"Sequence rejected: {issues[0]}")
+        QtWidgets.QMessageBox.warning(self, "Sequence rejected",
+                                      "The sequence cannot run:\n" + "\n".join(str(issue) for issue in issues))
 
     def ui_side_stop_button_clicked(self):
         self.statusBar().showMessage("All motors halted")
@@ -340,22 +377,39 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
     # ======================
 
     def ui_setup_connect_button_clicked(self):
+        # Connecting waits for the board to boot, keep it off the GUI thread
+        self.ui.setup_connect_button.setEnabled(False)
         if not self.arduino.connected:
-            try:
-                self.arduino.connect()
-            except AttributeError:
-                self.statusBar().showMessage("Please plug in the board and select a proper port, then press connect.")
-            except CannotConnectException:
-                self.statusBar().showMessage("Cannot connect to board. Try again..")
-
-            self.statusBar().showMessage("Successfully connected to board.")
+            self.statusBar().showMessage("Connecting to board..")
+            self.connection_thread = Thread(self.arduino.connect)
+            self.connection_thread.signals.result.connect(self.ui_board_connected)
+            self.connection_thread.signals.error.connect(self.ui_board_connection_failed)
+        else:
+            self.statusBar().showMessage("Disconnecting from board..")
+            self.connection_thread = Thread(self.arduino.disconnect)
+            self.connection_thread.signals.result.connect(self.ui_board_disconnected)
+        self.connection_thread.start()
+
+    def ui_board_connected(self, result=None):
+        metrics = self.arduino.connect_metrics
+        self.statusBar().showMessage(f"Successfully connected to board in {metrics['total']:.1f}s.")
+        self.ui.setup_connect_button.setText('Disconnect')
+        self.ui.setup_connect_button.setEnabled(True)
+        self.ui_disable_components_when_disconnected()
 
-            self.ui.setup_connect_button.setText('Disconnect')
+    def ui_board_connection_failed(self, error):
+        exctype, value, formatted_traceback = error
+        if exctype is CannotConnectException:
+            self.statusBar().showMessage("Cannot connect to board. Try again..")
         else:
-            self.arduino.disconnect()
-            self.ui.setup_connect_button.setText('Connect')
-            self.statusBar().showMessage("Successfully disconnected from board.")
+            self.statusBar().showMessage("Please plug in the board and select a proper port, then press connect.")
+        self.ui.setup_connect_button.setEnabled(True)
+        self.ui_disable_components_when_disconnected()
 
+    def ui_board_disconnected(self, result=None):
+        self.statusBar().showMessage("Successfully disconnected from board.")
+        self.ui.setup_connect_button.setText('Connect')
+        self.ui.setup_connect_button.setEnabled(True)
         self.ui_disable_components_when_disconnected()
 
     def click_disconnect_button(self):
@@ -368,9 +422,17 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
 
     # Refresh the list of ports
     def ui_setup_port_refresh_button_clicked(self):
-        # Get a list of possible ports from the arduino object
-        ports = self.arduino.discover_ports()
-
+        # Probing unknown ports waits for their timeouts, keep it off the GUI thread
+        # Get a list of possible ports from the arduino object, without touching the connected one
+        exclude = [self.config['connection']['com-port']] if self.arduino.connected else []
+        self.ui.setup_refresh_ports_button.setEnabled(False)
+        self.statusBar().showMessage("Searching for ports..")
+        self.port_refresh_thread = Thread(self.arduino.discover_ports, refresh=True, exclude=exclude)
+        self.port_refresh_thread.signals.result.connect(self.ui_ports_discovered)
+        self.port_refresh_thread.signals.error.connect(self.ui_port_discovery_failed)
+        self.port_refresh_thread.start()
+
+    def ui_ports_discovered(self, ports):
         # Update the UI Object and trigger its changed function
         # TODO: findout if the manual trigger is necessary
         self.ui.setup_port_input.clear()
@@ -380,7 +442,13 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
             self.ui.setup_port_input.setCurrentText(config_port)
         else:
             self.ui.setup_port_input.setCurrentText(ports[0])
+        self.statusBar().showMessage(f"Found {len(ports)} port(s).")
+        self.ui.setup_refresh_ports_button.setEnabled(True)
 
+    def ui_port_discovery_failed(self, error):
+        exctype, value, formatted_traceback = error
+        self.statusBar().showMessage(f"{value}. Please plug in the board, then refresh the ports.")
+        self.ui.setup_refresh_ports_button.setEnabled(True)
 
     def ui_setup_port_input_changed(self):
         # get the port from UI and forward it to the config and arduino objects.
@@ -392,6 +460,16 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
     def ui_setup_microsteps_input_changed(self):
         # get the microsteps setting from UI and forward it to the config and arduino objects.
         self.config['misc']['microsteps'] = self.ui.setup_microstepping_input.currentText()
+        for syringe in self.syringes:
+            syringe.invalidate_conversions()
+        self.update_speed_limits()
+
+    def update_speed_limits(self):
+        """ Limits the speed inputs to the fastest flow rate of the syringe on the current microstepping """
+        spd_inputs = [self.ui.channel_1_speed_input, self.ui.channel_2_speed_input, self.ui.channel_3_speed_input]
+        for spd_input, syringe in zip(spd_inputs, self.syringes):
+            syringe_option = self.syringe_options[syringe.syringe_size]
+            spd_input.setMaximum(min(syringe_option['speed-maximum'], syringe.get_flow_envelope().max_flow))
 
     def ui_setup_load_settings_button_clicked(self):
         return poseidon_config.PoseidonConfig.load_config()
@@ -416,24 +494,12 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
         self.ui.setup_microstepping_input.addItems(microstepping_values)
         self.ui.setup_microstepping_input.setCurrentText('32')
         self.config['misc']['microsteps'] = self.ui.setup_microstepping_input.currentText()
+        for syringe in self.syringes:
+            syringe.invalidate_conversions()
 
     # Populate the list of possible syringes to the dropdown menus
     def populate_syringe_sizes(self):
-        # Volume given in mL
-        # Area given in mm^2
-        # TODO: allow these to be setup in the software and loaded/saved to an .ini file
-        self.syringe_options = {
-            '500 mL': {
-                'volume': '500',
-                'area': 3631.681168,
-                'volume-decimals': 0,
-                'volume-maximum': 550,
-                'volume-step': 1,
-                'speed-decimals': 0,
-                'speed-maximum': 9999,
-                'speed-step': 1
-            }
-        }
+        self.syringe_options = SYRINGE_OPTIONS
 
         # Update the UI Objects and set to the value stored in the config
         self.ui.setup_channel_1_syringe_input.addItems(self.syringe_options.keys())
@@ -476,20 +542,6 @@ class MainWindow(QtWidgets.QMainWindow, poseidon_controller_gui.Ui_MainWindow):
         # self.ungrey_out_components()
 
 
-    '''
-        Syringe Volume (mL)	|		Syringe Area (mm^2)
-    -----------------------------------------------
-        1				|			17.34206347
-        3				|			57.88559215
-        5				|			112.9089185
-        10				|			163.539454
-        20				|			285.022957
-        30				|			366.0961536
-        60				|			554.0462538
-
-    IMPORTANT: These are for BD Plastic syringes ONLY!! Others will vary.
-    '''
-
     def closeEvent(self, event):
         try:
             if self.arduino.connected:
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Declarative protocol files, compiled into flat plans of Arduino commands.
+
+    A protocol is a JSON (or TOML) document with a list of steps:
+
+        {
+            "units": {"volume": "mL", "rate": "mL/h"},
+            "steps": [
+                {"run": {"channel": 1, "volume": 2.5, "rate": 120}},
+                {"parallel": [
+                    {"run": {"channel": 2, "volume": 1, "rate": 60}},
+                    {"run": {"channel": 3, "volume": 500, "volume-unit": "uL", "rate": 10, "rate-unit": "uL/min"}}
+                ]},
+                {"wait": 30},
+                {"loop": {"count": 10, "steps": [
+                    {"run": {"channel": 1, "volume": 0.1, "rate": 60}},
+                    {"run": {"channel": 1, "volume": -0.1, "rate": 60}}
+                ]}}
+            ]
+        }
+
+    Negative volumes withdraw. Waits are given in seconds. Units can be set for the whole protocol
+    and overridden per run step with volume-unit and rate-unit.
+
+    PlanExecutor only sends moves ahead of time into the on-board move queue (QUEUE), which runs the
+    moves between two waits back-to-back. Firmware without the queue cannot hold a second move, there
+    every MOVE is sent once the previous one finished, see PlanExecutor.run_stepwise().
+
+    Usage:
+        python protocol_compiler.py <protocol file>
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from serial_commands import format_move
+from sequence_scheduler import move_duration
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# Factors to mL and mL/s
+VOLUME_UNITS = {
+    'mL': 1.0,
+    'uL': 1e-3,
+    'µL': 1e-3,
+}
+RATE_UNITS = {
+    'mL/s': 1.0,
+    'mL/min': 1 / 60,
+    'mL/h': 1 / 3600,
+    'mL/hr': 1 / 3600,
+    'uL/s': 1e-3,
+    'uL/min': 1e-3 / 60,
+    'uL/h': 1e-3 / 3600,
+    'uL/hr': 1e-3 / 3600,
+    'µL/s': 1e-3,
+    'µL/min': 1e-3 / 60,
+    'µL/h': 1e-3 / 3600,
+    'µL/hr': 1e-3 / 3600,
+}
+# Besides these mm, steps and mm/s, steps/s can be used, they don't depend on the syringe
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def load_protocol(path):
+    """ Reads a protocol from a .json or .toml file """
+    if os.path.splitext(path)[1].lower() == '.toml':
+        if tomllib is None:
+            raise ProtocolError('TOML protocols need Python 3.11 or newer')
+        with open(path, 'rb') as protocol_file:
+            return tomllib.load(protocol_file)
+
+    with open(path) as protocol_file:
+        return json.load(protocol_file)
+
+
+# #########################################################
+# Plan
+# #########################################################
+
+class PlanMove:
+    """ Channels moving together to absolute targets with a single MOVE command
+
+    The accelerations in steps/s^2 per channel are the ones the duration was predicted with, they are
+    sent with the move. The command string is only formatted when the move is sent.
+    """
+    __slots__ = ('targets', 'speeds', 'accelerations', 'duration')
+
+    def __init__(self, targets, speeds, duration, accelerations=None):
+        self.targets = targets
+        self.speeds = speeds
+        self.accelerations = accelerations or {}
+        self.duration = duration
+
+    @property
+    def command(self):
+        return format_move(self.targets, self.speeds, self.accelerations)
+
+
+class PlanWait:
+    __slots__ = ('duration',)
+
+    def __init__(self, duration):
+        self.duration = duration
+
+
+class CommandPlan:
+    def __init__(self, items, final_positions):
+        self.items = items
+        self.final_positions = final_positions
+
+    def duration(self):
+        """ Predicted duration in s """
+        return sum(item.duration for item in self.items)
+
+    def command_count(self):
+        return sum(1 for item in self.items if isinstance(item, PlanMove))
+
+
+# #########################################################
+# Compiler
+# #########################################################
+
+class ProtocolCompiler:
+    """ Compiles protocols into validated CommandPlans for the given syringe channels
+
+    Move durations are predicted with the accelerations the channels are configured with, like
+    SequenceSimulator and MotionModel do.
+    """
+
+    def __init__(self, syringes):
+        self.syringes = {syringe.channel_number: syringe for syringe in syringes}
+        self.accelerations = {channel: syringe.get_acceleration() for channel, syringe in self.syringes.items()}
+
+    def compile(self, protocol, start_positions=None):
+        """ Validates and flattens a protocol
+
+        Parameters
+        ----------
+        protocol : dict
+            The loaded protocol document
+        start_positions : list of int
+            Absolute positions of the channels in steps, the current positions of the syringes if not given
+
+        raises ProtocolError
+            Pointing to the offending step if anything in the protocol is invalid
+        """
+        if not isinstance(protocol, dict) or not isinstance(protocol.get('steps'), list):
+            raise ProtocolError('protocol needs a list of steps')
+
+        units = protocol.get('units', {})
+        self.default_volume_unit = units.get('volume', 'mL')
+        self.default_rate_unit = units.get('rate', 'mL/h')
+
+        if start_positions is None:
+            start_positions = [self.syringes[channel].absolute_position if channel in self.syringes else 0
+                               for channel in (1, 2, 3)]
+        self.positions = [int(round(position)) for position in start_positions]
+
+        # Conversions are linear, look up the syringe and mechanics once per channel
+        self.steps_per_ml = {channel: syringe.ml_to_steps(1.0) for channel, syringe in self.syringes.items()}
+        self.steps_per_mm = {channel: syringe.mm_to_steps(1.0) for channel, syringe in self.syringes.items()}
+
+        items = []
+        self.compile_steps(protocol['steps'], 'steps', items)
+        return CommandPlan(items, list(self.positions))
+
+    def compile_steps(self, steps, path, items):
+        if not isinstance(steps, list):
+            raise ProtocolError(f"{path}: steps have to be a list")
+
+        for index, step in enumerate(steps):
+            step_path = f"{path}[{index}]"
+            if not isinstance(step, dict) or len(step) != 1:
+                raise ProtocolError(f"{step_path}: a step needs exactly one of run, parallel, wait, loop")
+
+            kind, body = next(iter(step.items()))
+            if kind == 'run':
+                items.append(self.compile_moves([body], f"{step_path}.run"))
+            elif kind == 'parallel':
+                if not isinstance(body, list) or not body:
+                    raise ProtocolError(f"{step_path}.parallel: needs a list of run steps")
+                runs = []
+                for run_index, run in enumerate(body):
+                    if not isinstance(run, dict) or list(run) != ['run']:
+                        raise ProtocolError(f"{step_path}.parallel[{run_index}]: only run steps can run in parallel")
+                    runs.append(run['run'])
+                items.append(self.compile_moves(runs, f"{step_path}.parallel"))
+            elif kind == 'wait':
+                seconds = self.number(body, f"{step_path}.wait")
+                if seconds < 0:
+                    raise ProtocolError(f"{step_path}.wait: has to be positive")
+                items.append(PlanWait(seconds))
+            elif kind == 'loop':
+                if not isinstance(body, dict):
+                    raise ProtocolError(f"{step_path}.loop: needs count and steps")
+                count = body.get('count')
+                if not isinstance(count, int) or count < 0:
+                    raise ProtocolError(f"{step_path}.loop.count: has to be a positive integer")
+                for _ in range(count):
+                    self.compile_steps(body.get('steps'), f"{step_path}.loop.steps", items)
+            else:
+                raise ProtocolError(f"{step_path}: unknown step {kind}")
+
+    def compile_moves(self, runs, path):
+        targets = {}
+        speeds = {}
+        duration = 0.0
+
+        for run in runs:
+            if not isinstance(run, dict):
+                raise ProtocolError(f"{path}: run needs channel, volume and rate")
+            channel = run.get('channel')
+            if channel not in self.syringes:
+                raise ProtocolError(f"{path}: unknown channel {channel}")
+            if channel in targets:
+                raise ProtocolError(f"{path}: channel {channel} can only run once per step")
+
+            distance = self.volume_to_steps(channel, self.number(run.get('volume'), f"{path}.volume"),
+                                            run.get('volume-unit', self.default_volume_unit), path)
+            speed = self.rate_to_steps(channel, self.number(run.get('rate'), f"{path}.rate"),
+                                       run.get('rate-unit', self.default_rate_unit), path)
+            if speed <= 0:
+                raise ProtocolError(f"{path}.rate: has to be positive")
+
+            target = self.positions[channel - 1] + int(round(distance))
+            targets[channel] = target
+            speeds[channel] = speed
+            # The board moves whole steps
+            duration = max(duration, move_duration(target - self.positions[channel - 1], speed,
+                                                   self.accelerations[channel]))
+            self.positions[channel - 1] = target
+
+        return PlanMove(targets, speeds, duration, {channel: self.accelerations[channel] for channel in targets})
+
+    @staticmethod
+    def number(value, path):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ProtocolError(f"{path}: has to be a number")
+        return float(value)
+
+    def volume_to_steps(self, channel, volume, unit, path):
+        if unit in VOLUME_UNITS:
+            return volume * VOLUME_UNITS[unit] * self.steps_per_ml[channel]
+        if unit == 'mm':
+            return volume * self.steps_per_mm[channel]
+        if unit == 'steps':
+            return volume
+        raise ProtocolError(f"{path}: unknown volume unit {unit}")
+
+    def rate_to_steps(self, channel, rate, unit, path):
+        if unit in RATE_UNITS:
+            return rate * RATE_UNITS[unit] * self.steps_per_ml[channel]
+        if unit == 'mm/s':
+            return rate * self.steps_per_mm[channel]
+        if unit == 'steps/s':
+            return rate
+        raise ProtocolError(f"{path}: unknown rate unit {unit}")
+
+
+# #########################################################
+# Executor
+# #########################################################
+
+class PlanExecutor:
+    """ Runs a CommandPlan on the board
+
+    If the firmware has the on-board move queue, the moves between two waits are preloaded into it and
+    run back-to-back without the PC. Otherwise every move is sent as a single MOVE command once the
+    previous one finished.
+    """
+
+    def __init__(self, arduino, plan):
+        self.arduino = arduino
+        self.plan = plan
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.arduino.stop_movement()
+
+    def run(self):
+        """ Executes the plan, blocks until done. Returns False if it was stopped """
+        if self.arduino.queue_supported:
+            return self.run_queued()
+        return self.run_stepwise()
+
+    def run_queued(self):
+        batch = []
+        for item in self.plan.items + [None]:
+            if isinstance(item, PlanMove):
+                batch.append(item)
+                continue
+
+            # A wait (or the end of the plan) needs all channels to be done first
+            if self.stopped.is_set():
+                return False
+            # Queued moves run with the acceleration the channel has when they start
+            self.arduino.set_accelerations({channel: acceleration for move in batch
+                                            for channel, acceleration in move.accelerations.items()})
+            self.arduino.enqueue_moves([(move.targets, move.speeds) for move in batch])
+            for channel in set().union(*[move.targets for move in batch]):
+                if not self.arduino.wait_for_channel(channel) or self.stopped.is_set():
+                    print("Executor> Plan stopped")
+                    return False
+            batch = []
+
+            if item is not None and self.stopped.wait(item.duration):
+                return False
+        return True
+
+    def run_stepwise(self):
+        """ Sends every move once the previous one finished, for firmware without the on-board queue """
+        for index, item in enumerate(self.plan.items):
+            if self.stopped.is_set():
+                return False
+
+            if isinstance(item, PlanWait):
+                if self.stopped.wait(item.duration):
+                    return False
+                continue
+
+            self.arduino.run_channels(item.targets, item.speeds, item.accelerations)
+            for channel in item.targets:
+                if not self.arduino.wait_for_channel(channel):
+                    print(f"Executor> Plan stopped at item {index}")
+                    return False
+
+        return True
+
+
+def main():
+    import configparser
+    from syringe_channel import SyringeChannel
+
+    parser = argparse.ArgumentParser(description='Compile a Poseidon protocol file')
+    parser.add_argument('protocol')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--area', type=float, default=3631.681168, help='Syringe area in mm^2')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    syringes = []
+    for channel in (1, 2, 3):
+        syringe = SyringeChannel(None, channel, config)
+        syringe.syringe_area = args.area
+        syringe.invalidate_conversions()
+        syringes.append(syringe)
+
+    start = time.perf_counter()
+    plan = ProtocolCompiler(syringes).compile(load_protocol(args.protocol))
+    duration = time.perf_counter() - start
+
+    print(f"Compiled {len(plan.items)} items, {plan.command_count()} commands in {duration * 1000:.1f}ms")
+    print(f"Predicted duration {plan.duration():.1f}s, final positions {plan.final_positions}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Pulsatile flow: periodic flow-rate waveforms replayed by the board from a precomputed table.
+
+    One period of the waveform is sampled into a table of steps per slot which fits the firmware
+    (WAVE_LENGTH slots of whole ms). The table is uploaded once with WAVE commands and the board
+    replays it at constant speed per slot for as many periods as asked, without any traffic from
+    the PC in between:
+
+        table = compile_waveform(syringe, SineWave(mean=600, amplitude=400, period=2.0))
+        print(table.fidelity())                  # predicted deviation of the sampled waveform
+        executor = PulsatileExecutor(arduino, {1: table})
+        executor.run(cycles=0)                   # runs until executor.stop()
+
+    Flow rates are given in mL/h, positive rates dispense. Steps are rounded on the cumulative
+    volume of the period, so only the volume per period is rounded, once, to whole steps.
+
+    Firmware without the WAVE command can stream the table instead, one MOVE per slot, see
+    PulsatileExecutor.run_streamed().
+
+    Usage:
+        python pulsatile_flow.py sine <mean> <amplitude> <period> [--config CONFIG]
+        python pulsatile_flow.py square <high> <low> <period> [--duty DUTY] [--config CONFIG]
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from syringe_catalog import MAX_STEP_RATE
+
+# Slots of the firmware table, see WAVE_LENGTH in arduino_serialCOM_v0.1.ino
+WAVE_LENGTH = 32
+# Shorter slots are dominated by the ms resolution of the board
+MIN_SLOT_MS = 10
+# Steps of a slot are stored as int on the board
+MAX_SLOT_STEPS = 32767
+
+
+class PulsatileException(Exception):
+    pass
+
+
+# #########################################################
+# Waveforms
+# #########################################################
+
+class SineWave:
+    """ Flow rate mean + amplitude * sin(2 pi t / period) in mL/h """
+
+    def __init__(self, mean, amplitude, period):
+        self.mean = mean
+        self.amplitude = amplitude
+        self.period = period
+
+    def rate(self, t):
+        return self.mean + self.amplitude * np.sin(2 * np.pi * np.asarray(t, dtype=float) / self.period)
+
+    def volume(self, t):
+        """ mL delivered t s after the start """
+        t = np.asarray(t, dtype=float)
+        return (self.mean * t + self.amplitude * self.period / (2 * np.pi) *
+                (1 - np.cos(2 * np.pi * t / self.period))) / 3600
+
+
+class SquareWave:
+    """ Flow rate high for the first duty fraction of every period, low for the rest, in mL/h """
+
+    def __init__(self, high, low, period, duty=0.5):
+        if not 0 < duty < 1:
+            raise PulsatileException('the duty cycle has to be between 0 and 1')
+        self.high = high
+        self.low = low
+        self.period = period
+        self.duty = duty
+
+    def rate(self, t):
+        phase = np.mod(np.asarray(t, dtype=float), self.period)
+        return np.where(phase < self.duty * self.period, self.high, self.low)
+
+    def volume(self, t):
+        """ mL delivered t s after the start """
+        t = np.asarray(t, dtype=float)
+        periods, phase = np.divmod(t, self.period)
+        on = self.duty * self.period
+        per_period = self.high * on + self.low * (self.period - on)
+        return (periods * per_period + self.high * np.minimum(phase, on) + self.low * np.maximum(phase - on, 0)) / 3600
+
+
+# #########################################################
+# Table
+# #########################################################
+
+class WaveformFidelity:
+    """ How closely a replayed waveform follows the requested one
+
+    Attributes
+    ----------
+    rms_error, max_error : float
+        Deviation of the flow rate in mL/h
+    relative_error : float
+        rms_error relative to the rms flow rate of the requested waveform
+    volume_error : float
+        Largest deviation of the delivered volume within a period in mL
+    mean_error : float
+        Relative deviation of the mean flow rate, adds up over the periods
+    """
+
+    def __init__(self, rms_error, max_error, relative_error, volume_error, mean_error):
+        self.rms_error = rms_error
+        self.max_error = max_error
+        self.relative_error = relative_error
+        self.volume_error = volume_error
+        self.mean_error = mean_error
+
+    def __repr__(self):
+        return (f"rate error rms {self.rms_error:.2f} mL/h ({self.relative_error * 100:.2f}%), "
+                f"max {self.max_error:.2f} mL/h, volume error {self.volume_error * 1000:.2f} uL, "
+                f"mean flow error {self.mean_error * 100:.3f}%")
+
+
+class WaveformTable:
+    """ One period of a waveform as steps per slot, the way the firmware replays it
+
+    Attributes
+    ----------
+    waveform : SineWave or SquareWave
+    slot_ms : int
+        Duration of every slot in ms
+    steps : ndarray
+        Steps moved in every slot
+    steps_per_ml : float
+    """
+
+    def __init__(self, waveform, slot_ms, steps, steps_per_ml):
+        self.waveform = waveform
+        self.slot_ms = slot_ms
+        self.steps = steps
+        self.steps_per_ml = steps_per_ml
+
+    @property
+    def period(self):
+        """ Period in s the board replays, slots of whole ms can differ from the requested one """
+        return len(self.steps) * self.slot_ms / 1000
+
+    def step_rates(self):
+        """ Constant speed of every slot in steps/s """
+        return self.steps * 1000 / self.slot_ms
+
+    def rate(self, t):
+        """ Flow rate in mL/h the board runs t s after the start """
+        slot = (np.mod(np.asarray(t, dtype=float), self.period) * 1000 // self.slot_ms).astype(int)
+        return self.step_rates()[np.minimum(slot, len(self.steps) - 1)] / self.steps_per_ml * 3600
+
+    def volume(self, t):
+        """ mL delivered t s after the start """
+        t = np.asarray(t, dtype=float)
+        periods, phase = np.divmod(t, self.period)
+        edges = np.concatenate(([0], np.cumsum(self.steps)))
+        slot_edges = np.arange(len(edges)) * self.slot_ms / 1000
+        return (periods * edges[-1] + np.interp(phase, slot_edges, edges)) / self.steps_per_ml
+
+    def fidelity(self, samples=100):
+        """ Predicted deviation of the replayed table from the waveform over one period, samples per slot """
+        t = (np.arange(len(self.steps) * samples) + 0.5) * self.slot_ms / 1000 / samples
+        return compare(self.rate(t), self.waveform.rate(t), self.volume(t), self.waveform.volume(t))
+
+
+def compare(rates, requested_rates, volumes, requested_volumes):
+    """ WaveformFidelity of flow rates and volumes against the requested ones """
+    errors = rates - requested_rates
+    rms = float(np.sqrt(np.mean(errors ** 2)))
+    requested_rms = float(np.sqrt(np.mean(requested_rates ** 2)))
+    requested_mean = float(np.mean(requested_rates))
+    return WaveformFidelity(rms, float(np.max(np.abs(errors))), rms / requested_rms if requested_rms else 0.0,
+                            float(np.max(np.abs(volumes - requested_volumes))),
+                            float(np.mean(rates) / requested_mean - 1) if requested_mean else 0.0)
+
+
+def slot_layout(period, slots=WAVE_LENGTH, min_slot_ms=MIN_SLOT_MS, period_tolerance=0.001):
+    """ (slots, slot_ms) of whole ms for the period
+
+    The most slots whose period is within the relative tolerance, the closest period if none is.
+    """
+    candidates = np.arange(2, slots + 1)
+    slot_ms = np.maximum(np.round(period * 1000 / candidates), min_slot_ms)
+    errors = np.abs(candidates * slot_ms - period * 1000)
+    within = np.flatnonzero(errors <= period * 1000 * period_tolerance)
+    best = within[-1] if within.size else np.argmin(errors)
+    return int(candidates[best]), int(slot_ms[best])
+
+
+def compile_waveform(syringe, waveform, slots=WAVE_LENGTH, max_step_rate=MAX_STEP_RATE):
+    """ Samples one period of the waveform into a WaveformTable for the channel of the syringe
+
+    raises PulsatileException
+        If a slot is faster than the firmware can run
+    """
+    slot_count, slot_ms = slot_layout(waveform.period, slots)
+    steps_per_ml = syringe.ml_to_steps(1.0)
+
+    # The board replays slot_count * slot_ms, sample the waveform stretched onto that
+    edges = np.arange(slot_count + 1) * waveform.period / slot_count
+    steps = np.diff(np.round(waveform.volume(edges) * steps_per_ml)).astype(int)
+
+    fastest = float(np.max(np.abs(steps))) * 1000 / slot_ms
+    if fastest > max_step_rate or np.max(np.abs(steps)) > MAX_SLOT_STEPS:
+        raise PulsatileException(f"the waveform needs {fastest:.0f} steps/s, the board runs at most "
+                                 f"{max_step_rate:.0f} steps/s")
+    return WaveformTable(waveform, slot_ms, steps, steps_per_ml)
+
+
+def measure_waveform(table, timestamps, positions, start_position):
+    """ Fidelity of a replayed waveform from the position telemetry of its channel
+
+    The flow rate between two reports is compared with the mean requested flow rate over the same
+    interval. The board does not report when the waveform started, it is fitted to the volumes.
+
+    Parameters
+    ----------
+    timestamps : array_like
+        Board timestamps of the reports in ms
+    positions : array_like
+        Positions of the channel in steps
+    start_position : int
+        Position of the channel when the waveform started
+    """
+    t = (np.asarray(timestamps, dtype=float) - timestamps[0]) / 1000
+    volumes = (np.asarray(positions, dtype=float) - start_position) / table.steps_per_ml
+
+    # Time between the start and the first report with the least volume error, searched over one period
+    offsets = np.linspace(0, table.period, 1001)
+    requested = table.waveform.volume(t[None, :] + offsets[:, None])
+    offset = offsets[np.argmin(np.sum((requested - volumes) ** 2, axis=1))]
+
+    requested_volumes = table.waveform.volume(t + offset)
+    durations = np.diff(t)
+    return compare(np.diff(volumes) / durations * 3600, np.diff(requested_volumes) / durations * 3600,
+                   volumes, requested_volumes)
+
+
+# #########################################################
+# Executor
+# #########################################################
+
+class PulsatileExecutor:
+    """ Replays waveform tables on the board
+
+    Parameters
+    ----------
+    arduino : Arduino
+    tables : dict
+        WaveformTable per channel, all channels start together
+    """
+
+    def __init__(self, arduino, tables):
+        self.arduino = arduino
+        self.tables = tables
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.arduino.stop_movement()
+
+    def period(self):
+        return max(table.period for table in self.tables.values())
+
+    def run(self, cycles=0):
+        """ Uploads the tables and replays them for cycles periods, 0 until stop(). Returns False if it was stopped """
+        futures = []
+        for channel, table in sorted(self.tables.items()):
+            futures += self.arduino.upload_waveform(channel, table.slot_ms, table.steps.tolist())
+        for future in futures:
+            future.result()
+
+        self.arduino.start_waveforms(self.tables, cycles)
+        if cycles == 0:
+            self.stopped.wait()
+            return False
+
+        if self.stopped.wait(cycles * self.period()):
+            return False
+        return True
+
+    def run_streamed(self, cycles=0):
+        """ Replays the tables with one MOVE per slot, for firmware without the WAVE command
+
+        Every MOVE accelerates and decelerates, so the waveform is followed less closely than by the board,
+        and the PC has to send every slot.
+        """
+        positions = {channel: self.arduino.last_position.positions[channel - 1] for channel in self.tables}
+        slots = {channel: 0 for channel in self.tables}
+        end_ms = cycles * self.period() * 1000 if cycles else float('inf')
+        start = time.monotonic()
+
+        while True:
+            offset_ms = min(slots[channel] * table.slot_ms for channel, table in self.tables.items())
+            if offset_ms >= end_ms:
+                return True
+            if self.stopped.wait(max(0.0, start + offset_ms / 1000 - time.monotonic())):
+                return False
+
+            targets, speeds = {}, {}
+            for channel, table in self.tables.items():
+                if slots[channel] * table.slot_ms != offset_ms:
+                    continue
+                steps = int(table.steps[slots[channel] % len(table.steps)])
+                slots[channel] += 1
+                positions[channel] += steps
+                if steps:
+                    targets[channel] = positions[channel]
+                    speeds[channel] = abs(steps) * 1000 / table.slot_ms
+            if targets:
+                self.arduino.run_channels(targets, speeds)
+
+
+def main():
+    import configparser
+    from syringe_channel import SyringeChannel
+
+    parser = argparse.ArgumentParser(description='Compile a pulsatile flow waveform table')
+    parser.add_argument('kind', choices=('sine', 'square'))
+    parser.add_argument('values', type=float, nargs=3, help='mean, amplitude, period or high, low, period')
+    parser.add_argument('--duty', type=float, default=0.5)
+    parser.add_argument('--channel', type=int, default=1)
+    parser.add_argument('--config', default='config.ini')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    syringe = SyringeChannel(None, args.channel, config)
+    syringe.set_syringe(config[f"syringe-channel-{args.channel}"]['size'])
+
+    if args.kind == 'sine':
+        waveform = SineWave(*args.values)
+    else:
+        waveform = SquareWave(*args.values, duty=args.duty)
+    table = compile_waveform(syringe, waveform)
+
+    print(f"{len(table.steps)} slots of {table.slot_ms} ms, period {table.period:.3f}s")
+    print(f"Steps: {' '.join(str(step) for step in table.steps)}")
+    print(f"Predicted: {table.fidelity()}")
+
+
+if __name__ == "__main__":
+    main()
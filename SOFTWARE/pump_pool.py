@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Several Poseidon boards driven as one pump with more than three channels.
+
+    Global channel ids are mapped to (board, motor). Multi-channel moves are fanned out to all
+    boards concurrently and started together, the telemetry of the boards is merged into one
+    stream over the global channels.
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from arduino_connection import Arduino
+from serial_messages import PositionMessage
+
+
+class PoolPositions:
+    """ Merges the telemetry of all boards into PositionMessages over the global channels
+
+    Every board report updates its slice of the merged positions, the callback receives the merged
+    state at most at the subscribed rate. The timestamp is the host time in ms, the boards have
+    their own clocks.
+    """
+
+    def __init__(self, pool, rate, callback, on_change=False):
+        self.pool = pool
+        self.interval = 1.0 / rate
+        self.callback = callback
+        self.on_change = on_change
+
+        self.lock = threading.Lock()
+        self.positions = [0] * max(pool.channels)
+        self.remaining = [0] * max(pool.channels)
+        self.last_delivery = None
+        self.last_values = None
+
+        self.subscriptions = [board.subscribe_positions(rate, self.board_callback(index), on_change)
+                              for index, board in enumerate(pool.boards)]
+
+    def board_callback(self, board_index):
+        channels = [(channel, motor) for channel, (index, motor) in self.pool.channels.items() if index == board_index]
+
+        def update(message):
+            with self.lock:
+                for channel, motor in channels:
+                    self.positions[channel - 1] = message.positions[motor - 1]
+                    self.remaining[channel - 1] = message.remaining[motor - 1]
+                self.deliver()
+        return update
+
+    def deliver(self):
+        """ Needs the lock to be held """
+        now = time.perf_counter()
+        values = (tuple(self.positions), tuple(self.remaining))
+        # The boards report out of phase, tolerate some jitter so the rate is kept on average
+        if self.last_delivery is not None and now - self.last_delivery < self.interval * 0.9:
+            return
+        if self.on_change and values == self.last_values:
+            return
+
+        self.last_delivery = now
+        self.last_values = values
+        self.callback(PositionMessage(values[0], values[1], int(now * 1000)))
+
+    def cancel(self):
+        for subscription in self.subscriptions:
+            subscription.cancel()
+
+
+class PumpPool:
+    """ Several boards driven as one set of channels
+
+    Global channel ids run from 1 to 3 * number of boards, channel 4 is motor 1 of the second board
+    unless another mapping is given.
+
+    Parameters
+    ----------
+    boards : list of Arduino
+        The connections of the pool
+    channels : dict
+        Global channel id -> (board index, motor 1..3)
+    """
+
+    def __init__(self, boards, channels=None):
+        self.boards = boards
+        if channels is None:
+            channels = {index * 3 + motor: (index, motor) for index in range(len(boards)) for motor in (1, 2, 3)}
+        self.channels = channels
+
+    @classmethod
+    def from_ports(cls, ports, config):
+        """ Creates a pool with one connection per port, all other connection settings are taken from the config """
+        boards = []
+        for port in ports:
+            connection = dict(config['connection'])
+            connection['com-port'] = port
+            boards.append(Arduino({'connection': connection}, None))
+        return cls(boards)
+
+    def locate(self, channel):
+        """ Returns the (Arduino, motor) of a global channel id """
+        if channel not in self.channels:
+            raise ValueError(f"Unknown channel {channel}")
+        index, motor = self.channels[channel]
+        return self.boards[index], motor
+
+    def group_by_board(self, values):
+        """ Splits {global channel: value} into {board index: {motor: value}} """
+        groups = {}
+        for channel, value in values.items():
+            index, motor = self.channels[channel]
+            groups.setdefault(index, {})[motor] = value
+        return groups
+
+    def fan_out(self, function):
+        """ Calls function(board) for all boards concurrently and returns the results in board order """
+        with ThreadPoolExecutor(len(self.boards)) as pool:
+            return list(pool.map(function, self.boards))
+
+    def connect(self):
+        """ Connects all boards at the same time, raises CannotConnectException if any board fails """
+        self.fan_out(lambda board: board.connect())
+
+    def disconnect(self):
+        self.fan_out(lambda board: board.disconnect() if board.connected else None)
+
+    # #########################################################
+    # Hardware Abstraction Functions
+    #
+    # Same as Arduino, but addressed with global channel ids
+    # #########################################################
+
+    def run_channels(self, targets, speeds, accelerations=None):
+        """ Moves channels on any number of boards, they start together
+
+        Every board gets a single MOVE command carrying all its channels. They are queued to all
+        boards at once, so the boards only start apart by their writer threads waking up.
+
+        Parameters
+        ----------
+        targets : dict
+            Absolute target position in steps per global channel
+        speeds : dict
+            Speed in steps/s per global channel
+        accelerations : dict
+            Acceleration in steps/s^2 per global channel, optional
+
+        Returns
+        -------
+        list of Future
+            The futures of the commands starting the moves, one per board
+        """
+        speed_groups = self.group_by_board(speeds)
+        acceleration_groups = self.group_by_board(accelerations or {})
+
+        futures = []
+        for index, motor_targets in self.group_by_board(targets).items():
+            board_futures = self.boards[index].run_channels(motor_targets, speed_groups[index],
+                                                            acceleration_groups.get(index))
+            futures.append(board_futures[-1])
+        return futures
+
+    def jog(self, channel, position_in_steps, speed_in_steps_per_s, acceleration_in_steps_per_s2=None):
+        board, motor = self.locate(channel)
+        return board.jog(motor, position_in_steps, speed_in_steps_per_s, acceleration_in_steps_per_s2)
+
+    def wait_for_channel(self, channel, timeout=None):
+        board, motor = self.locate(channel)
+        return board.wait_for_channel(motor, timeout)
+
+    def subscribe_positions(self, rate, callback, on_change=False):
+        """ Subscribes a callback to the merged telemetry of all boards, see Arduino.subscribe_positions()
+
+        Returns
+        -------
+        PoolPositions
+            Cancel it to unsubscribe
+        """
+        return PoolPositions(self, rate, callback, on_change)
+
+    def enable_motors(self):
+        return [board.enable_motors() for board in self.boards]
+
+    def disable_motors(self):
+        return [board.disable_motors() for board in self.boards]
+
+    def stop_movement(self):
+        return [board.stop_movement() for board in self.boards]
+
+    def pause_movement(self):
+        return [board.pause_movement() for board in self.boards]
+
+    def resume_movement(self):
+        return [board.resume_movement() for board in self.boards]
+
+    def zero(self):
+        return [board.zero() for board in self.boards]
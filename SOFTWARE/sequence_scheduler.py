@@ -0,0 +1,119 @@
+import math
+
+from motion_model import FIRST_STEP_FACTOR
+from syringe_channel import ratio_locked_profile
+
+
+def move_duration(distance, speed, acceleration):
+    """ Duration in s of a trapezoidal move from standstill to standstill
+
+    Like AccelStepper the move starts and ends with the speed of its first step, see
+    motion_model.first_step_speed().
+
+    Parameters
+    ----------
+    distance : float
+        Distance in steps, the sign is ignored
+    speed : float
+        Maximum speed in steps/s
+    acceleration : float
+        Acceleration and deceleration in steps/s^2
+    """
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    if speed <= 0:
+        return math.inf
+
+    initial = min(speed, FIRST_STEP_FACTOR * math.sqrt(acceleration))
+    # Too short to reach the maximum speed, the profile is a triangle
+    peak = min(speed, math.sqrt(distance * acceleration + initial * initial))
+    ramp = (peak - initial) / acceleration
+    return 2 * ramp + (distance - (peak + initial) * ramp) / peak
+
+
+class SequenceStep:
+    """ Run of a single channel within a sequence group """
+
+    def __init__(self, channel, target, speed, acceleration, duration):
+        self.channel = channel
+        self.target = target
+        self.speed = speed
+        self.acceleration = acceleration
+        self.duration = duration
+
+
+class SequenceScheduler:
+    """ Runs the syringe channels grouped by their sequence-position
+
+    Channels sharing a sequence-position start together with a single multi-motor MOVE command,
+    the next group starts once every channel of the current group reached its target.
+
+    With ratio_locked the channels of a group share one normalized motion profile, so the ratio of
+    their volumes holds while they accelerate and decelerate too, see ratio_locked_profile().
+    """
+
+    def __init__(self, arduino, syringes, ratio_locked=False):
+        self.arduino = arduino
+        self.syringes = syringes
+        self.ratio_locked = ratio_locked
+
+    def plan(self):
+        """ Calculates the steps of all groups from the current run settings of the channels
+
+        Returns
+        -------
+        list of list of SequenceStep
+            The groups in order of their sequence-position. Channels without anything to run are left out.
+        """
+        groups = {}
+        for syringe in self.syringes:
+            target, speed = syringe.get_run_parameters()
+            target = int(round(target))
+            distance = target - syringe.absolute_position
+            if distance == 0:
+                continue
+
+            acceleration = syringe.get_acceleration()
+            step = SequenceStep(syringe.channel_number, target, speed, acceleration,
+                                move_duration(distance, speed, acceleration))
+            groups.setdefault(syringe.get_sequence_position(), []).append(step)
+
+        plan = [groups[position] for position in sorted(groups)]
+        if self.ratio_locked:
+            for group in plan:
+                self.lock_ratios(group)
+        return plan
+
+    def lock_ratios(self, group):
+        """ Scales the speeds and accelerations of the group to a shared profile """
+        positions = {syringe.channel_number: syringe.absolute_position for syringe in self.syringes}
+        speeds, accelerations = ratio_locked_profile(
+            {step.channel: step.target - positions[step.channel] for step in group},
+            {step.channel: step.speed for step in group},
+            {step.channel: step.acceleration for step in group})
+        for step in group:
+            step.speed = speeds[step.channel]
+            step.acceleration = accelerations[step.channel]
+            step.duration = move_duration(step.target - positions[step.channel], step.speed, step.acceleration)
+
+    @staticmethod
+    def makespan(plan):
+        """ Predicted duration in s of the whole plan, each group takes as long as its slowest channel """
+        return sum(max(step.duration for step in group) for group in plan)
+
+    def execute(self, plan):
+        """ Runs the plan group by group. Blocks until done, returns False if a move was stopped """
+        for group in plan:
+            self.arduino.run_channels({step.channel: step.target for step in group},
+                                      {step.channel: step.speed for step in group},
+                                      {step.channel: step.acceleration for step in group},
+                                      locked=self.ratio_locked and len(group) > 1)
+
+            for step in group:
+                if not self.arduino.wait_for_channel(step.channel):
+                    print(f"Scheduler> Sequence aborted at channel {step.channel}")
+                    return False
+
+            print(f"Scheduler> Group {[step.channel for step in group]} finished")
+        return True
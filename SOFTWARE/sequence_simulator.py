@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Dry run of sequences and protocol plans without a board.
+
+    The moves are laid out on a timeline with the motion model, which takes milliseconds even for
+    runs of many hours. The dry run reports the duration, the volume every channel dispenses and
+    flags everything the run would fail on:
+
+     - speed: a step rate the firmware cannot reach, above MAX_STEP_RATE, or no speed at all
+     - travel: a move which pushes the syringe past empty or pulls it past its total volume
+
+    Positions are absolute steps of the channel, 0 being a full syringe. Dispensing moves the position
+    up, a syringe of syringe_total_volume mL is empty at ml_to_steps(syringe_total_volume).
+
+    Usage:
+        python sequence_simulator.py <protocol> [--config CONFIG]
+"""
+import argparse
+
+import numpy as np
+
+from motion_model import move_durations
+from protocol_compiler import PlanMove, PlanWait
+from syringe_catalog import MAX_STEP_RATE
+
+
+class DryRunIssue:
+    """ Something the run would fail on, stage is the index of the group or plan item """
+    __slots__ = ('stage', 'channel', 'kind', 'message')
+
+    def __init__(self, stage, channel, kind, message):
+        self.stage = stage
+        self.channel = channel
+        self.kind = kind
+        self.message = message
+
+    def __repr__(self):
+        return f"stage {self.stage}, channel {self.channel}: {self.message}"
+
+
+class TimelineEntry:
+    """ A single channel moving, times in s from the start of the run """
+    __slots__ = ('stage', 'channel', 'start', 'end', 'start_position', 'target', 'speed', 'volume')
+
+    def __init__(self, stage, channel, start, end, start_position, target, speed, volume):
+        self.stage = stage
+        self.channel = channel
+        self.start = start
+        self.end = end
+        self.start_position = start_position
+        self.target = target
+        self.speed = speed
+        self.volume = volume
+
+
+class DryRun:
+    """ Result of a dry run
+
+    Attributes
+    ----------
+    timeline : list of TimelineEntry
+        Every move in order of its start
+    duration : float
+        Predicted duration of the whole run in s
+    volumes : dict
+        Net volume in mL every channel dispenses, negative if it withdraws
+    budgets : dict
+        Volume in mL every syringe holds at the start, None if its size is unknown
+    issues : list of DryRunIssue
+    """
+
+    def __init__(self, timeline, duration, volumes, budgets, issues):
+        self.timeline = timeline
+        self.duration = duration
+        self.volumes = volumes
+        self.budgets = budgets
+        self.issues = issues
+
+    @property
+    def feasible(self):
+        return not self.issues
+
+    def channel_timeline(self, channel):
+        return [entry for entry in self.timeline if entry.channel == channel]
+
+    def summary(self):
+        lines = [f"Dry run: {len(self.timeline)} moves, duration {self.duration:.1f}s"]
+        for channel in sorted(self.volumes):
+            budget = self.budgets.get(channel)
+            budget_text = f" of {budget:.3f} mL in the syringe" if budget is not None else ''
+            lines.append(f"  channel {channel}: dispenses {self.volumes[channel]:.3f} mL{budget_text}")
+        lines += [f"  {issue}" for issue in self.issues]
+        lines.append('Feasible' if self.feasible else f"Not feasible, {len(self.issues)} issues")
+        return '\n'.join(lines)
+
+
+class SequenceSimulator:
+    """ Simulates the stages of a run on the given syringe channels
+
+    Parameters
+    ----------
+    syringes : list of SyringeChannel
+        The channels with their syringe selected, see SyringeChannel.set_syringe()
+    max_step_rate : float
+        Fastest step rate the firmware runs a channel at, in steps/s
+    """
+
+    def __init__(self, syringes, max_step_rate=MAX_STEP_RATE):
+        self.syringes = {syringe.channel_number: syringe for syringe in syringes}
+        self.max_step_rate = max_step_rate
+        self.ml_per_step = {channel: syringe.steps_to_ml(1.0) for channel, syringe in self.syringes.items()}
+        self.travel = {channel: self.syringe_travel(syringe) for channel, syringe in self.syringes.items()}
+
+    @staticmethod
+    def syringe_travel(syringe):
+        """ Position in steps of the empty syringe, None if its size is unknown """
+        if not syringe.syringe_total_volume or not syringe.syringe_area:
+            return None
+        return syringe.ml_to_steps(float(syringe.syringe_total_volume))
+
+    def simulate_sequence(self, groups, start_positions=None):
+        """ Dry run of SequenceScheduler.plan(), the groups run one after another """
+        stages = [{step.channel: (step.target, step.speed, step.acceleration) for step in group} for group in groups]
+        return self.simulate(stages, start_positions)
+
+    def simulate_plan(self, plan, start_positions=None):
+        """ Dry run of a compiled CommandPlan, moves without acceleration use the configured one of the channel """
+        accelerations = {channel: syringe.get_acceleration() for channel, syringe in self.syringes.items()}
+        stages = []
+        for item in plan.items:
+            if isinstance(item, PlanWait):
+                stages.append(item.duration)
+            elif isinstance(item, PlanMove):
+                stages.append({channel: (target, item.speeds[channel],
+                                         item.accelerations.get(channel, accelerations[channel]))
+                               for channel, target in item.targets.items()})
+        return self.simulate(stages, start_positions)
+
+    def simulate(self, stages, start_positions=None):
+        """ Lays the stages out on a timeline and checks them
+
+        Parameters
+        ----------
+        stages : list
+            Either a wait in s or {channel: (target in steps, speed in steps/s, acceleration in steps/s^2)}
+            of channels which start together. A stage starts once the previous one finished.
+        start_positions : dict
+            Absolute position in steps per channel, the current positions of the syringes if not given
+        """
+        if start_positions is None:
+            start_positions = {channel: syringe.absolute_position for channel, syringe in self.syringes.items()}
+        positions = dict(start_positions)
+
+        # Flatten the moves, their durations and checks are calculated at once
+        moves = []
+        waits = np.zeros(len(stages))
+        for index, stage in enumerate(stages):
+            if not isinstance(stage, dict):
+                waits[index] = stage
+                continue
+            for channel, (target, speed, acceleration) in sorted(stage.items()):
+                moves.append((index, channel, positions[channel], target, speed, acceleration))
+                positions[channel] = target
+
+        columns = np.array(moves, dtype=float).reshape(-1, 6).T
+        indices = columns[0].astype(int)
+        channels = columns[1].astype(int)
+        starts, targets, speeds, accelerations = columns[2:]
+        durations = move_durations(targets - starts, speeds, accelerations)
+        ml_per_step = np.array([self.ml_per_step[channel] for channel in channels])
+        travel = np.array([np.inf if self.travel[channel] is None else self.travel[channel] for channel in channels])
+
+        # Every stage takes as long as its slowest channel
+        stage_durations = waits.copy()
+        np.maximum.at(stage_durations, indices, durations)
+        stage_starts = np.concatenate(([0.0], np.cumsum(stage_durations)[:-1]))[indices]
+
+        timeline = [TimelineEntry(*entry) for entry in zip(
+            indices.tolist(), channels.tolist(), stage_starts.tolist(), (stage_starts + durations).tolist(),
+            starts.tolist(), targets.tolist(), speeds.tolist(), ((targets - starts) * ml_per_step).tolist())]
+
+        issues = []
+        for move in np.flatnonzero(speeds <= 0):
+            issues.append(DryRunIssue(indices[move], channels[move], 'speed', 'has no speed and never finishes'))
+        for move in np.flatnonzero(speeds > self.max_step_rate):
+            issues.append(DryRunIssue(indices[move], channels[move], 'speed',
+                                      f"{speeds[move]:.0f} steps/s exceeds the firmware limit of "
+                                      f"{self.max_step_rate:.0f} steps/s"))
+        for move in np.flatnonzero(targets > travel):
+            issues.append(DryRunIssue(indices[move], channels[move], 'travel',
+                                      f"dispenses {(targets[move] - travel[move]) * ml_per_step[move]:.3f} mL "
+                                      f"more than the syringe holds"))
+        for move in np.flatnonzero(targets < 0):
+            issues.append(DryRunIssue(indices[move], channels[move], 'travel',
+                                      f"withdraws {-targets[move] * ml_per_step[move]:.3f} mL past the syringe volume"))
+        issues.sort(key=lambda issue: (issue.stage, issue.channel))
+
+        volumes = {channel: (positions[channel] - start_positions[channel]) * self.ml_per_step[channel]
+                   for channel in self.syringes}
+        budgets = {channel: None if self.travel[channel] is None
+                   else (self.travel[channel] - start_positions[channel]) * self.ml_per_step[channel]
+                   for channel in self.syringes}
+        return DryRun(timeline, float(stage_durations.sum()), volumes, budgets, issues)
+
+
+def main():
+    import configparser
+    import time
+    from protocol_compiler import ProtocolCompiler, load_protocol
+    from syringe_channel import SyringeChannel
+
+    parser = argparse.ArgumentParser(description='Dry run of a Poseidon protocol file')
+    parser.add_argument('protocol')
+    parser.add_argument('--config', default='config.ini')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    syringes = []
+    for channel in (1, 2, 3):
+        syringe = SyringeChannel(None, channel, config)
+        syringe.set_syringe(config[f"syringe-channel-{channel}"]['size'])
+        syringes.append(syringe)
+
+    start = time.perf_counter()
+    plan = ProtocolCompiler(syringes).compile(load_protocol(args.protocol))
+    dry_run = SequenceSimulator(syringes).simulate_plan(plan)
+    duration = time.perf_counter() - start
+
+    print(dry_run.summary())
+    print(f"Compiled and simulated in {duration * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+import time
+import struct
+import binascii
+from concurrent.futures import Future
+
+from syringe_catalog import MIN_STEP_RATE
+
+# Commands are written in order of priority, urgent commands skip ahead of queued moves
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+URGENT_MODES = ('STOP', 'PAUSE')
+
+
+def format_command(operation, operation_type, motors, value, direction, steps):
+    """ Formats an ASCII <MODE,SETTING,MOTORS,VALUE,DIRECTION,P1,P2,P3> command """
+    return f"<{operation},{operation_type},{motors},{value},{direction},{steps[0]},{steps[1]},{steps[2]}>"
+
+
+def format_number(value):
+    """ Shortest form of a value with at most two decimals, the firmware parses it with atof() """
+    return f"{float(value):.2f}".rstrip('0').rstrip('.')
+
+
+def format_speed(value):
+    """ Speed in steps/s as sent to the firmware, at least MIN_STEP_RATE
+
+    Slower speeds would be formatted as 0, which the firmware ignores and keeps the previous speed.
+
+    raises ValueError
+        If the speed is not positive
+    """
+    if not value > 0:
+        raise ValueError(f"Speed has to be positive, got {value}")
+    return format_number(max(float(value), MIN_STEP_RATE))
+
+
+def format_move(targets, speeds, accelerations=None, locked=False):
+    """ Formats a <MOVE,MOTORS,c<CHANNEL> p<TARGET> s<SPEED> a<ACCEL> ...> command
+
+    All channels of the command start together. Channels without acceleration keep the one they have.
+    Locked commands (<MOVE,MOTORS,l c<CHANNEL> ...>) slave all channels to the one with the longest move.
+
+    Parameters
+    ----------
+    targets : dict
+        Absolute target position in steps per channel (1..3)
+    speeds : dict
+        Speed in steps/s per channel, see format_speed()
+    accelerations : dict
+        Acceleration in steps/s^2 per channel, optional
+    locked : bool
+        Hold the ratios of the distances through acceleration, deceleration and stops
+    """
+    accelerations = accelerations or {}
+    motors = ''.join(str(channel) for channel in sorted(targets))
+    channels = ['l'] if locked else []
+    for channel in sorted(targets):
+        spec = f"c{channel} p{int(round(targets[channel]))} s{format_speed(speeds[channel])}"
+        if channel in accelerations:
+            spec += f" a{format_number(accelerations[channel])}"
+        channels.append(spec)
+    return f"<MOVE,{motors},{' '.join(channels)}>"
+
+
+def format_speed_update(speeds):
+    """ Formats a <MOVE,MOTORS,c<CHANNEL> s<SPEED> ...> command which only changes the max speed
+
+    The channels keep their targets. A running stepper accelerates or decelerates to the new speed
+    with its acceleration, without stopping.
+
+    Parameters
+    ----------
+    speeds : dict
+        Speed in steps/s per channel, see format_speed()
+    """
+    motors = ''.join(str(channel) for channel in sorted(speeds))
+    channels = [f"c{channel} s{format_speed(speeds[channel])}" for channel in sorted(speeds)]
+    return f"<MOVE,{motors},{' '.join(channels)}>"
+
+
+def parse_move(command):
+    """ Returns {channel: [target, speed, acceleration]} of a MOVE command, None for values which are not given
+
+    Relative d<STEPS> distances are not returned, their target depends on the position of the board.
+    """
+    channels = {}
+    current = None
+    for token in command.strip('<>').split(',', 2)[2].split():
+        if token[0] == 'c':
+            current = channels.setdefault(int(token[1:]), [None, None, None])
+        elif current is not None and token[0] in 'psa':
+            current['psa'.index(token[0])] = float(token[1:])
+    return channels
+
+
+def move_commands(targets, speeds, accelerations=None, max_size=64, locked=False):
+    """ The commands moving channels to absolute targets, usually a single MOVE
+
+    A MOVE has to fit into the firmware input buffer. If it does not, the accelerations are sent as
+    SETTING commands ahead of it, and if it still does not fit the speeds as well followed by a RUN,
+    which is never locked.
+    """
+    accelerations = accelerations or {}
+    command = format_move(targets, speeds, accelerations, locked)
+    if len(command) <= max_size:
+        return [command]
+
+    commands = [format_command('SETTING', 'ACCEL', channel, format_number(accelerations[channel]), 'F', [0, 0, 0])
+                for channel in sorted(accelerations)]
+    command = format_move(targets, speeds, locked=locked)
+    if len(command) <= max_size:
+        return commands + [command]
+
+    distances = [0, 0, 0]
+    for channel in sorted(targets):
+        distances[channel - 1] = int(round(targets[channel]))
+        commands.append(format_command('SETTING', 'SPEED', channel, format_speed(speeds[channel]), 'F', [0, 0, 0]))
+    motors = ''.join(str(channel) for channel in sorted(targets))
+    return commands + [format_command('RUN', 'DIST', motors, 1, 'F', distances)]
+
+
+def wave_commands(channel, slot_ms, steps, max_size=64):
+    """ The <WAVE,<CHANNEL>,t<SLOT MS> n<SLOTS> i<INDEX> <STEPS> <STEPS> ...> commands uploading a waveform table
+
+    The table is split over as many commands as the firmware input buffer needs, each continuing at its index.
+
+    Parameters
+    ----------
+    channel : int
+        The channel (1..3) the table belongs to
+    slot_ms : int
+        Duration of every slot in ms
+    steps : list of int
+        Steps the channel moves in each slot of one period
+    """
+    prefix = f"<WAVE,{channel},"
+    commands = []
+    index = 0
+    while index < len(steps) or not commands:
+        tokens = [f"t{slot_ms} n{len(steps)}"] if not commands else []
+        tokens.append(f"i{index}")
+        size = len(prefix) + len(' '.join(tokens)) + 1
+        while index < len(steps) and size + len(str(steps[index])) + 1 <= max_size:
+            tokens.append(str(steps[index]))
+            size += len(tokens[-1]) + 1
+            index += 1
+        commands.append(f"{prefix}{' '.join(tokens)}>")
+    return commands
+
+
+def format_wave_start(channels, cycles=0):
+    """ Formats a <WAVE,MOTORS,r<CYCLES>> command starting the uploaded waveforms together, 0 cycles repeat forever """
+    motors = ''.join(str(channel) for channel in sorted(channels))
+    return f"<WAVE,{motors},r{int(cycles)}>"
+
+
+# #########################################################
+# Binary Protocol
+#
+# Negotiated with <BINARY,ON,0,1,F,0.0,0.0,0.0>, which the firmware confirms with a
+# "PROTOCOL BINARY 1" line. Afterwards commands can be sent as binary frames (little
+# endian) instead of ASCII strings. A frame only carries the channels it addresses:
+#
+#   offset  type      field
+#   0       uint8     sync byte 0xA5
+#   1       uint8     opcode
+#   2       uint8     sequence number, echoed in the acknowledgement
+#   3       uint8     channel mask, bit 0 = channel 1
+#   4       uint8     payload length n, at most 30
+#   5       n bytes   payload
+#   5 + n   uint16    CRC-16/CCITT-FALSE of bytes 0..4 + n
+#
+# OP_RUN and OP_SETTING carry one 10 byte record per channel of the mask, in channel order:
+#
+#   int32     absolute target in steps, only used by OP_RUN
+#   uint32    max speed in steps/s as Q16.16 fixed point, 0 = unchanged
+#   uint16    acceleration in steps/s^2, 0 = unchanged
+#
+# The payload of the other opcodes is a list of int32 values: 0/1 for OP_ENABLE, interval in ms
+# and 0/1 for on change for OP_TELEMETRY, nothing otherwise. A single channel move takes 17 bytes,
+# STOP 7 bytes.
+#
+# The firmware acknowledges a frame with "#<sequence>" or rejects it with "?<sequence>"
+# if the CRC does not match. It suppresses all debug output for binary frames. ASCII
+# commands are still accepted in binary mode.
+# #########################################################
+BINARY_SYNC = 0xA5
+BINARY_HEADER = struct.Struct('<BBBBB')
+BINARY_CHANNEL = struct.Struct('<iIH')
+BINARY_VALUE = struct.Struct('<i')
+BINARY_MAX_PAYLOAD = 3 * BINARY_CHANNEL.size
+BINARY_FRAME_SIZE = BINARY_HEADER.size + BINARY_MAX_PAYLOAD + 2
+BINARY_SPEED_SCALE = 1 << 16
+
+OP_RUN = 0x01
+OP_SETTING = 0x02
+OP_STOP = 0x03
+OP_PAUSE = 0x04
+OP_RESUME = 0x05
+OP_ZERO = 0x06
+OP_ENABLE = 0x07
+OP_TELEMETRY = 0x08
+OP_ASCII = 0x7F
+
+# Opcodes with a record per channel, the others carry plain values
+CHANNEL_OPCODES = (OP_RUN, OP_SETTING)
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def binary_frame_size(header):
+    """ Size of the whole frame starting with the given header, None if the payload length is invalid """
+    if header[4] > BINARY_MAX_PAYLOAD:
+        return None
+    return BINARY_HEADER.size + header[4] + 2
+
+
+def encode_binary_frame(opcode, sequence, mask, steps=(), speeds=(0.0, 0.0, 0.0), accelerations=(0, 0, 0)):
+    """ Packs a command into a binary frame. Speeds are given in steps/s, accelerations in steps/s^2
+
+    OP_RUN and OP_SETTING take steps, speeds and accelerations of all three channels and pack those
+    of the mask, the other opcodes pack the values given as steps.
+    """
+    try:
+        if opcode in CHANNEL_OPCODES:
+            steps = steps or (0, 0, 0)
+            payload = b''.join(BINARY_CHANNEL.pack(int(round(steps[i])), int(round(speeds[i] * BINARY_SPEED_SCALE)),
+                                                   int(round(accelerations[i])))
+                               for i in range(3) if mask & (1 << i))
+        else:
+            payload = b''.join(BINARY_VALUE.pack(int(round(value))) for value in steps)
+        frame = BINARY_HEADER.pack(BINARY_SYNC, opcode, sequence & 0xFF, mask, len(payload)) + payload
+    except struct.error as exc:
+        raise ValueError(f"Command cannot be encoded as binary frame: {exc}")
+    return frame + struct.pack('<H', crc16(frame))
+
+
+def decode_binary_frame(frame):
+    """ Unpacks a binary frame into (opcode, sequence, mask, steps, speeds, accelerations)
+
+    steps, speeds and accelerations have an entry per channel, 0 for channels the frame does not carry.
+
+    raises ValueError
+        If the frame has the wrong size, sync byte or CRC
+    """
+    if len(frame) < BINARY_HEADER.size + 2 or frame[0] != BINARY_SYNC or binary_frame_size(frame) != len(frame):
+        raise ValueError('Malformed binary frame')
+    if crc16(frame[:-2]) != struct.unpack_from('<H', frame, len(frame) - 2)[0]:
+        raise ValueError('CRC mismatch')
+
+    _, opcode, sequence, mask, length = BINARY_HEADER.unpack_from(frame)
+    steps = [0, 0, 0]
+    speeds = [0.0, 0.0, 0.0]
+    accelerations = [0, 0, 0]
+    offset = BINARY_HEADER.size
+    if opcode in CHANNEL_OPCODES:
+        if length != bin(mask & 0x07).count('1') * BINARY_CHANNEL.size:
+            raise ValueError('Malformed binary frame')
+        for i in range(3):
+            if mask & (1 << i):
+                steps[i], speed, accelerations[i] = BINARY_CHANNEL.unpack_from(frame, offset)
+                speeds[i] = speed / BINARY_SPEED_SCALE
+                offset += BINARY_CHANNEL.size
+    else:
+        for i in range(min(3, length // BINARY_VALUE.size)):
+            steps[i] = BINARY_VALUE.unpack_from(frame, offset + i * BINARY_VALUE.size)[0]
+    return opcode, sequence, mask, tuple(steps), tuple(speeds), tuple(accelerations)
+
+
+def binary_frame_from_command(command, sequence):
+    """ Translates an ASCII <MODE,SETTING,MOTORS,VALUE,DIRECTION,P1,P2,P3> or MOVE command into a binary frame
+
+    raises ValueError
+        If the command has no binary equivalent
+    """
+    if command.startswith('<MOVE,'):
+        if 'l' in command.strip('<>').split(',', 2)[2].split():
+            raise ValueError('Locked moves have no binary equivalent')
+        channels = parse_move(command)
+        steps = [0, 0, 0]
+        speeds = [0.0, 0.0, 0.0]
+        accelerations = [0, 0, 0]
+        for channel, (target, speed, acceleration) in channels.items():
+            if target is None:
+                raise ValueError('Relative and speed-only moves have no binary equivalent')
+            steps[channel - 1] = target
+            speeds[channel - 1] = speed or 0.0
+            accelerations[channel - 1] = acceleration or 0
+        mask = sum(1 << (channel - 1) for channel in channels)
+        return encode_binary_frame(OP_RUN, sequence, mask, steps, speeds, accelerations)
+
+    fields = command.strip('<>').split(',')
+    mode, setting, motors, value, direction = fields[:5]
+    optionals = [float(field) for field in fields[5:8]]
+    mask = sum(1 << i for i in range(3) if str(i + 1) in motors)
+
+    if mode == 'RUN':
+        sign = -1 if direction == 'B' else 1
+        steps = [999999 * sign if setting == 'RUN' else optional * sign for optional in optionals]
+        return encode_binary_frame(OP_RUN, sequence, mask, steps)
+
+    if mode == 'SETTING':
+        if setting == 'ENABLE':
+            return encode_binary_frame(OP_ENABLE, sequence, 0x07, (int(float(value)),))
+
+        channel = int(motors) - 1
+        speeds = [0.0, 0.0, 0.0]
+        accelerations = [0, 0, 0]
+        if setting == 'SPEED':
+            speeds[channel] = float(value)
+        elif setting == 'ACCEL':
+            accelerations[channel] = float(value)
+        else:
+            raise ValueError(f"No binary equivalent for setting {setting}")
+        return encode_binary_frame(OP_SETTING, sequence, 1 << channel, speeds=speeds, accelerations=accelerations)
+
+    opcodes = {'STOP': OP_STOP, 'PAUSE': OP_PAUSE, 'RESUME': OP_RESUME}
+    if mode in opcodes:
+        return encode_binary_frame(opcodes[mode], sequence, 0x07)
+    if mode == 'ZERO':
+        return encode_binary_frame(OP_ZERO, sequence, mask)
+    if mode == 'TELEMETRY':
+        return encode_binary_frame(OP_TELEMETRY, sequence, 0, (int(float(value)), int(optionals[0])))
+    if mode == 'BINARY' and float(value) == 0:
+        return encode_binary_frame(OP_ASCII, sequence, 0)
+
+    raise ValueError(f"No binary equivalent for mode {mode}")
+
+
+class AcknowledgementException(Exception):
+    pass
+
+
+class PendingCommand:
+    """ A command on its way to the board, from the command queue until its acknowledgement
+
+    The future resolves with this object once the firmware acknowledged the command. An asyncio
+    future can be passed in to use the command from an event loop.
+    """
+
+    def __init__(self, command, priority=None, future=None):
+        self.command = command
+        self.data = command.encode()
+        self.size = len(self.data)
+
+        # The firmware echoes mode and setting back in its <mode: ... ,setting: ...> reply
+        fields = command.strip('<>').split(',')
+        self.mode = fields[0]
+        self.setting = fields[1] if len(fields) > 1 else ''
+
+        if priority is None:
+            priority = PRIORITY_URGENT if self.mode in URGENT_MODES else PRIORITY_NORMAL
+        self.priority = priority
+        self.future = future if future is not None else Future()
+
+        # Only set when the command is sent as binary frame
+        self.sequence = None
+
+        self.sent_at = None
+        self.acked_at = None
+
+    def encode_binary(self, sequence):
+        """ Replaces the ASCII data with the equivalent binary frame """
+        self.data = binary_frame_from_command(self.command, sequence)
+        self.size = len(self.data)
+        self.sequence = sequence & 0xFF
+
+    def matches(self, mode, setting):
+        return self.sequence is None and self.mode == mode and self.setting == setting
+
+    def latency(self):
+        return self.acked_at - self.sent_at
+
+
+class PositionSubscription:
+    """ Delivers position telemetry to a callback at a given rate
+
+    The board reports at the rate of the fastest subscription, slower subscriptions skip reports
+    based on the board timestamp. With on_change only reports which differ from the last delivered
+    one are passed on.
+    """
+
+    def __init__(self, arduino, rate, callback, on_change=False):
+        self.arduino = arduino
+        self.interval = max(1, int(round(1000 / rate)))
+        self.callback = callback
+        self.on_change = on_change
+
+        self.last_timestamp = None
+        self.last_values = None
+
+    def offer(self, message):
+        timestamp = message.timestamp if message.timestamp is not None else time.perf_counter() * 1000
+        values = (message.positions, message.remaining)
+
+        # Tolerate half a report interval of jitter, otherwise every second report would be skipped
+        if self.last_timestamp is not None and \
+                timestamp - self.last_timestamp < self.interval - self.arduino.telemetry_interval / 2:
+            return
+        if self.on_change and values == self.last_values:
+            return
+
+        self.last_timestamp = timestamp
+        self.last_values = values
+        self.callback(message)
+
+    def cancel(self):
+        self.arduino.unsubscribe_positions(self)
@@ -0,0 +1,220 @@
+import re
+
+# Bytes read from the serial connection at once
+READ_BUFFER_SIZE = 4096
+
+POS_PATTERN = re.compile(rb'POS p1:(-?\d+) r1:(-?\d+) p2:(-?\d+) r2:(-?\d+) p3:(-?\d+) r3:(-?\d+)'
+                         rb'(?: t:(\d+))?(?: q1:(\d+) q2:(\d+) q3:(\d+))?')
+ACK_PATTERN = re.compile(rb'<mode: ([^ ]*) ,setting: ([^ ]*) ')
+SEQUENCE_PATTERN = re.compile(rb'[#?](\d+)')
+PROTOCOL_PATTERN = re.compile(rb'PROTOCOL ([A-Z]+) (\d+)')
+QUEUE_PATTERN = re.compile(rb'QUEUE q1:(\d+) q2:(\d+) q3:(\d+)')
+QUEUE_FULL_PATTERN = re.compile(rb'QUEUE FULL (\d)')
+BANNER = b'<Arduino Board is ready>'
+
+
+# #########################################################
+# Messages
+#
+# Typed representations of the lines printed by the firmware
+# #########################################################
+
+class PositionMessage:
+    """ POS p1:<pos> r1:<remaining> p2:... t:<millis> q1:<queued> ... telemetry
+
+    Positions and remaining distances are given in steps, the timestamp in ms since the board
+    started, queued is the number of moves waiting in the on-board queue of every channel. Older
+    firmware sends no timestamp or queue depths, they are None then.
+    """
+    __slots__ = ('positions', 'remaining', 'timestamp', 'queued')
+
+    def __init__(self, positions, remaining, timestamp=None, queued=None):
+        self.positions = positions
+        self.remaining = remaining
+        self.timestamp = timestamp
+        self.queued = queued
+
+
+class AckMessage:
+    """ <mode: ... ,setting: ... > echo of an ASCII command """
+    __slots__ = ('mode', 'setting')
+
+    def __init__(self, mode, setting):
+        self.mode = mode
+        self.setting = setting
+
+
+class SequenceAckMessage:
+    """ #<sequence> acknowledgement or ?<sequence> rejection of a binary frame """
+    __slots__ = ('sequence', 'accepted')
+
+    def __init__(self, sequence, accepted):
+        self.sequence = sequence
+        self.accepted = accepted
+
+
+class ProtocolMessage:
+    """ PROTOCOL <NAME> <0|1> confirmation of a protocol switch """
+    __slots__ = ('name', 'enabled')
+
+    def __init__(self, name, enabled):
+        self.name = name
+        self.enabled = enabled
+
+
+class QueueStatusMessage:
+    """ QUEUE q1:<queued> q2:<queued> q3:<queued> reply to the STATUS command """
+    __slots__ = ('queued',)
+
+    def __init__(self, queued):
+        self.queued = queued
+
+
+class QueueFullMessage:
+    """ QUEUE FULL <channel>, a QUEUE command was dropped """
+    __slots__ = ('channel',)
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class BannerMessage:
+    """ <Arduino Board is ready>, printed once the board (re)started """
+    __slots__ = ()
+
+
+class DebugMessage:
+    """ Any other line, the firmware prints plenty of them """
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @property
+    def text(self):
+        return self.raw.decode('ascii', 'replace')
+
+
+# #########################################################
+# Framer
+# #########################################################
+
+class MessageFramer:
+    """ Splits the byte stream from the board into lines and parses them into messages
+
+    Everything that is waiting on the serial connection is read into one reusable buffer. Lines
+    are parsed in place with precompiled byte patterns, only the message objects themselves are
+    allocated. The parser for a line is picked from a dispatch table by its first byte, lines
+    which cannot be parsed become DebugMessages instead of raising.
+    """
+
+    def __init__(self, size=READ_BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+
+        self.parsers = {
+            ord('P'): self.parse_p,
+            ord('<'): self.parse_angle,
+            ord('#'): self.parse_sequence,
+            ord('?'): self.parse_sequence,
+            ord('Q'): self.parse_queue,
+        }
+
+    def read_from(self, serial):
+        """ Reads what is waiting on the serial connection, blocking up to its timeout for the first byte
+
+        Returns
+        -------
+        list
+            The messages of all lines completed by the read
+        """
+        free = len(self.buffer) - self.length
+        count = serial.readinto(self.view[self.length:self.length + max(1, min(serial.in_waiting, free))])
+        if not count:
+            return []
+        return self.feed_length(count)
+
+    def feed(self, data):
+        """ Appends data to the buffer and returns the messages of all completed lines """
+        messages = []
+        while data:
+            free = len(self.buffer) - self.length
+            chunk = min(free, len(data))
+            self.buffer[self.length:self.length + chunk] = data[:chunk]
+            messages.extend(self.feed_length(chunk))
+            data = data[chunk:]
+        return messages
+
+    def feed_length(self, count):
+        end = self.length + count
+        messages = []
+        buffer = self.buffer
+        start = 0
+
+        newline = buffer.find(b'\n', self.length, end)
+        while newline >= 0:
+            line_end = newline
+            if line_end > start and buffer[line_end - 1] == 13:  # \r
+                line_end -= 1
+            if line_end > start:
+                messages.append(self.parse_line(start, line_end))
+            start = newline + 1
+            newline = buffer.find(b'\n', start, end)
+
+        if start == 0 and end == len(buffer):
+            # A line longer than the buffer can only be garbage
+            messages.append(DebugMessage(bytes(buffer)))
+            start = end
+
+        # Move the incomplete line to the front of the buffer
+        remaining = end - start
+        if remaining and start:
+            self.view[:remaining] = self.view[start:end]
+        self.length = remaining
+        return messages
+
+    def parse_line(self, start, end):
+        parser = self.parsers.get(self.buffer[start])
+        message = parser(start, end) if parser is not None else None
+        if message is None:
+            message = DebugMessage(bytes(self.view[start:end]))
+        return message
+
+    def parse_p(self, start, end):
+        match = POS_PATTERN.match(self.buffer, start, end)
+        if match is not None:
+            p1, r1, p2, r2, p3, r3, timestamp, q1, q2, q3 = match.groups()
+            return PositionMessage((int(p1), int(p2), int(p3)), (int(r1), int(r2), int(r3)),
+                                   int(timestamp) if timestamp is not None else None,
+                                   (int(q1), int(q2), int(q3)) if q1 is not None else None)
+
+        match = PROTOCOL_PATTERN.match(self.buffer, start, end)
+        if match is not None:
+            return ProtocolMessage(match.group(1).decode('ascii'), match.group(2) != b'0')
+        return None
+
+    def parse_angle(self, start, end):
+        match = ACK_PATTERN.match(self.buffer, start, end)
+        if match is not None:
+            return AckMessage(match.group(1).decode('ascii', 'replace'), match.group(2).decode('ascii', 'replace'))
+
+        if self.buffer.startswith(BANNER, start, end):
+            return BannerMessage()
+        return None
+
+    def parse_sequence(self, start, end):
+        match = SEQUENCE_PATTERN.fullmatch(self.buffer, start, end)
+        if match is not None:
+            return SequenceAckMessage(int(match.group(1)), self.buffer[start] == 35)  # #
+        return None
+
+    def parse_queue(self, start, end):
+        match = QUEUE_PATTERN.match(self.buffer, start, end)
+        if match is not None:
+            return QueueStatusMessage(tuple(int(depth) for depth in match.groups()))
+
+        match = QUEUE_FULL_PATTERN.match(self.buffer, start, end)
+        if match is not None:
+            return QueueFullMessage(int(match.group(1)))
+        return None
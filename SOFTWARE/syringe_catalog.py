@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Catalog of the syringes which can be selected per channel, read from syringes.ini.
+
+    Every syringe is known by the size stored in config.ini ('BD 10 mL') and by its manufacturer and
+    volume. Together with the drive (lead screw, motor steps and microstepping) the catalog tells the
+    volume of a single microstep and the flow rates the firmware can run the syringe at:
+
+        catalog = SyringeCatalog()
+        envelope = catalog.envelope('BD 10 mL', mm_per_rotation=8, steps_per_rotation=200, microsteps=16)
+        envelope.max_flow      # mL/h at MAX_STEP_RATE
+
+    The envelopes of all syringes and microstep settings of a drive are calculated at once and kept,
+    looking one up afterwards is a dictionary access.
+
+    Usage:
+        python syringe_catalog.py [--config CONFIG] [--catalog CATALOG]
+"""
+import argparse
+import configparser
+import os
+
+import numpy as np
+
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'syringes.ini')
+
+# Microstep settings of the CNC-Shield, see MainWindow.populate_microstepping()
+MICROSTEPS = (1, 2, 4, 8, 16, 32)
+
+# Fastest step rate of the firmware in steps/s, see X_SPEED in arduino_serialCOM_v0.1.ino
+MAX_STEP_RATE = 1000.0
+# Slowest step rate which can be sent, speeds are formatted with two decimals
+MIN_STEP_RATE = 0.01
+
+
+class SyringeCatalogException(Exception):
+    pass
+
+
+class SyringeSpec:
+    """ A syringe of the catalog
+
+    Attributes
+    ----------
+    name : str
+        The size stored in config.ini
+    manufacturer : str
+    volume : float
+        Nominal volume in mL
+    area : float
+        Inner cross section in mm^2
+    options : dict
+        Setup of the volume and speed inputs of the GUI, see SYRINGE_OPTIONS in syringe_channel.py
+    """
+
+    def __init__(self, name, manufacturer, volume, area, options):
+        self.name = name
+        self.manufacturer = manufacturer
+        self.volume = volume
+        self.area = area
+        self.options = options
+
+    def __repr__(self):
+        return f"{self.name} ({self.manufacturer}, {self.volume:g} mL, {self.area:g} mm^2)"
+
+
+class FlowEnvelope:
+    """ What a syringe can do on one drive configuration
+
+    Attributes
+    ----------
+    name : str
+        The syringe
+    microsteps : int
+    ml_per_step : float
+        Volume of a single microstep in mL
+    min_flow : float
+        Slowest flow rate in mL/h, it is also the resolution flow rates can be set with
+    max_flow : float
+        Fastest flow rate in mL/h, limited by the step rate of the firmware
+    """
+
+    def __init__(self, name, microsteps, ml_per_step, min_flow, max_flow):
+        self.name = name
+        self.microsteps = microsteps
+        self.ml_per_step = ml_per_step
+        self.min_flow = min_flow
+        self.max_flow = max_flow
+
+    def contains(self, flow_rate):
+        """ Whether the flow rate in mL/h can be run, the sign is ignored """
+        return self.min_flow <= abs(flow_rate) <= self.max_flow
+
+    def __repr__(self):
+        return (f"{self.name} at {self.microsteps} microsteps: {self.ml_per_step * 1000:.4g} uL per step, "
+                f"{self.min_flow:.4g} to {self.max_flow:.4g} mL/h")
+
+
+class SyringeCatalog:
+    """ The syringes of a catalog file
+
+    Parameters
+    ----------
+    path : str
+        The catalog file, syringes.ini next to this module if not given
+
+    raises SyringeCatalogException
+        If the file cannot be read or a syringe lacks its volume or area
+    """
+
+    def __init__(self, path=CATALOG_FILE):
+        parser = configparser.ConfigParser()
+        if not parser.read(path):
+            raise SyringeCatalogException(f"Cannot read syringe catalog {path}")
+
+        self.syringes = {}
+        for name in parser.sections():
+            section = parser[name]
+            try:
+                options = {
+                    'volume': section['volume'],
+                    'area': section.getfloat('area'),
+                    'volume-decimals': section.getint('volume-decimals'),
+                    'volume-maximum': section.getfloat('volume-maximum', section.getfloat('volume')),
+                    'volume-step': section.getfloat('volume-step'),
+                    'speed-decimals': section.getint('speed-decimals'),
+                    'speed-maximum': section.getfloat('speed-maximum'),
+                    'speed-step': section.getfloat('speed-step'),
+                }
+                self.syringes[name] = SyringeSpec(name, section.get('manufacturer', ''), section.getfloat('volume'),
+                                                  options['area'], options)
+            except (KeyError, TypeError, ValueError) as error:
+                raise SyringeCatalogException(f"Syringe {name} in {path}: {error}")
+
+        # Envelopes of all syringes and MICROSTEPS per drive, see envelopes()
+        self.tables = {}
+
+    def __getitem__(self, name):
+        return self.syringes[name]
+
+    def __contains__(self, name):
+        return name in self.syringes
+
+    def names(self):
+        return list(self.syringes)
+
+    def manufacturers(self):
+        return sorted({syringe.manufacturer for syringe in self.syringes.values()})
+
+    def find(self, manufacturer, volume):
+        """ The syringe of the manufacturer with the given volume in mL
+
+        raises SyringeCatalogException
+            If the catalog has no such syringe
+        """
+        for syringe in self.syringes.values():
+            if syringe.manufacturer == manufacturer and np.isclose(syringe.volume, volume):
+                return syringe
+        raise SyringeCatalogException(f"No {volume:g} mL syringe of {manufacturer} in the catalog")
+
+    def options(self):
+        """ GUI setup of every syringe by name """
+        return {name: syringe.options for name, syringe in self.syringes.items()}
+
+    def envelopes(self, mm_per_rotation, steps_per_rotation, max_step_rate=MAX_STEP_RATE):
+        """ FlowEnvelope of every syringe at every microstep setting of the drive, by (name, microsteps)
+
+        Calculated on the first call for a drive, the table is kept afterwards.
+        """
+        drive = (float(mm_per_rotation), float(steps_per_rotation), float(max_step_rate))
+        if drive not in self.tables:
+            names = list(self.syringes)
+            areas = np.array([self.syringes[name].area for name in names])
+            microsteps = np.array(MICROSTEPS, dtype=float)
+
+            # mm^2 * mm = uL, rows are syringes and columns microstep settings
+            ml_per_step = np.outer(areas / 1000, drive[0] / (drive[1] * microsteps))
+            min_flows = ml_per_step * MIN_STEP_RATE * 3600
+            max_flows = ml_per_step * drive[2] * 3600
+
+            self.tables[drive] = {
+                (name, step): FlowEnvelope(name, step, float(ml_per_step[row, column]),
+                                           float(min_flows[row, column]), float(max_flows[row, column]))
+                for row, name in enumerate(names) for column, step in enumerate(MICROSTEPS)
+            }
+        return self.tables[drive]
+
+    def envelope(self, name, mm_per_rotation, steps_per_rotation, microsteps, max_step_rate=MAX_STEP_RATE):
+        """ FlowEnvelope of a syringe on the given drive
+
+        raises SyringeCatalogException
+            If the syringe is not in the catalog
+        """
+        if name not in self.syringes:
+            raise SyringeCatalogException(f"Syringe {name} is not in the catalog")
+
+        envelope = self.envelopes(mm_per_rotation, steps_per_rotation, max_step_rate).get((name, int(microsteps)))
+        if envelope is None:
+            # Microstep settings the shield does not offer are not in the table
+            ml_per_step = self.syringes[name].area / 1000 * float(mm_per_rotation) / \
+                (float(steps_per_rotation) * float(microsteps))
+            envelope = FlowEnvelope(name, microsteps, ml_per_step, ml_per_step * MIN_STEP_RATE * 3600,
+                                    ml_per_step * max_step_rate * 3600)
+        return envelope
+
+
+def main():
+    import time
+
+    parser = argparse.ArgumentParser(description='Flow envelopes of the Poseidon syringe catalog')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--catalog', default=CATALOG_FILE)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    mm_per_rotation = float(config['misc']['mm-per-rotation'])
+    steps_per_rotation = float(config['misc']['steps-per-rotation'])
+
+    catalog = SyringeCatalog(args.catalog)
+    start = time.perf_counter()
+    table = catalog.envelopes(mm_per_rotation, steps_per_rotation)
+    duration = time.perf_counter() - start
+
+    print(f"{len(table)} envelopes of {len(catalog.syringes)} syringes calculated in {duration * 1000:.2f}ms "
+          f"for {mm_per_rotation:g} mm per rotation and {steps_per_rotation:g} steps per rotation")
+    for envelope in table.values():
+        print(f"  {envelope}")
+
+
+if __name__ == "__main__":
+    main()
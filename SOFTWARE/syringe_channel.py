@@ -1,6 +1,49 @@
+import numpy as np
+
+from syringe_catalog import SyringeCatalog
+
 FORWARD = 'F'
 BACKWARD = 'B'
 
+# Syringes which can be selected per channel, see syringes.ini
+# Volume given in mL
+# Area given in mm^2
+SYRINGE_CATALOG = SyringeCatalog()
+SYRINGE_OPTIONS = SYRINGE_CATALOG.options()
+
+
+def ratio_locked_profile(distances, speeds, accelerations):
+    """ Speeds and accelerations which move the channels in one normalized profile
+
+    Every channel gets the speed and acceleration of the channel with the longest move scaled by its
+    share of that distance. All channels then accelerate, cruise and decelerate at the same times and
+    the ratios of their volumes hold throughout the move. The shared profile is the fastest one in
+    which no channel exceeds its own speed or acceleration.
+
+    Parameters
+    ----------
+    distances : dict
+        Distance in steps per channel, channels which do not move are left out
+    speeds : dict
+        Speed in steps/s per channel
+    accelerations : dict
+        Acceleration in steps/s^2 per channel
+
+    Returns
+    -------
+    tuple of dict
+        (speeds, accelerations) per moving channel
+    """
+    moving = {channel: abs(distance) for channel, distance in distances.items() if distance}
+    if not moving:
+        return {}, {}
+
+    lead = max(moving, key=moving.get)
+    lead_speed = min(speeds[channel] * moving[lead] / moving[channel] for channel in moving)
+    lead_acceleration = min(accelerations[channel] * moving[lead] / moving[channel] for channel in moving)
+    return ({channel: lead_speed * moving[channel] / moving[lead] for channel in moving},
+            {channel: lead_acceleration * moving[channel] / moving[lead] for channel in moving})
+
 
 class SyringeChannel:
 
@@ -22,46 +65,114 @@ class SyringeChannel:
         self.running = False
         self.acceleration = 5
 
+        # Conversion factors, calculated from the config on first use, see invalidate_conversions()
+        self.steps_per_mm = None
+        self.steps_per_ml = None
+
+    def set_syringe(self, size):
+        """ Selects one of the SYRINGE_OPTIONS """
+        self.syringe_size = size
+        self.syringe_area = SYRINGE_OPTIONS[size]['area']
+        self.syringe_total_volume = SYRINGE_OPTIONS[size]['volume']
+        self.invalidate_conversions()
+
+    def invalidate_conversions(self):
+        """ Drops the conversion factors, call it once the step settings in the config or the syringe area changed """
+        self.steps_per_mm = None
+        self.steps_per_ml = None
+
+    def update_conversions(self):
+        """ Calculates the conversion factors from the step settings in the config and the syringe area
+
+        steps_per_ml is infinite as long as no syringe is selected.
+        """
+        mm_per_rotation = float(self.config['misc']['mm-per-rotation'])
+        steps_per_rotation = float(self.config['misc']['steps-per-rotation'])
+        microsteps_per_step = float(self.config['misc']['microsteps'])
+
+        self.steps_per_mm = steps_per_rotation * microsteps_per_step / mm_per_rotation
+        self.steps_per_ml = self.steps_per_mm / (self.syringe_area / 1000) if self.syringe_area else np.inf
+
     def get_run_parameters(self):
         speed_in_ml_per_h = float(self.config[f"syringe-channel-{self.channel_number}"]['speed'])
         volume_in_ml = float(self.config[f"syringe-channel-{self.channel_number}"]['volume'])
 
-        speed_in_ml_per_s = speed_in_ml_per_h / 3600
-        speed_in_mm_per_s = self.ml_to_mm(speed_in_ml_per_s)
-        distance_in_mm = self.ml_to_mm(volume_in_ml)
+        new_position = self.absolute_position + self.ml_to_steps(volume_in_ml)
 
-        new_position = self.absolute_position + self.mm_to_steps(distance_in_mm)
+        return new_position, self.ml_to_steps(speed_in_ml_per_h / 3600)
 
-        return new_position, self.mm_to_steps(speed_in_mm_per_s)
+    def get_sequence_position(self):
+        return int(self.config[f"syringe-channel-{self.channel_number}"]['sequence-position'])
 
     def get_jog_parameters(self, direction):
+        """ Distance and speed of a jog in steps and steps/s, the distance is relative to the commanded target """
         speed_in_mm_per_s = float(self.config['misc']['jog-speed'])
         distance_in_mm = float(self.config['misc']['jog-distance'])
 
-        new_position = self.absolute_position + self.mm_to_steps(distance_in_mm) * direction
-
-        return new_position, self.mm_to_steps(speed_in_mm_per_s)
+        return self.mm_to_steps(distance_in_mm) * direction, self.mm_to_steps(speed_in_mm_per_s)
+
+    def get_flow_envelope(self):
+        """ Volume per step and the slowest and fastest flow rate of the selected syringe on the configured drive """
+        return SYRINGE_CATALOG.envelope(self.syringe_size, float(self.config['misc']['mm-per-rotation']),
+                                        float(self.config['misc']['steps-per-rotation']),
+                                        float(self.config['misc']['microsteps']))
+
+    def get_acceleration(self):
+        """ Acceleration of the channel in steps/s^2, configured in mm/s^2 """
+        acceleration_in_mm_per_s2 = float(self.config[f"syringe-channel-{self.channel_number}"]['acceleration'])
+        return self.mm_to_steps(acceleration_in_mm_per_s2)
+
+    # Time units of flow rates in s
+    TIME_UNITS = {'s': 1.0, 'min': 60.0, 'h': 3600.0}
+
+    def steps_per_unit(self, unit):
+        """ Steps (or steps/s) per unit, one of steps, mm, mL or a rate of them like mm/s or mL/h """
+        if self.steps_per_mm is None:
+            self.update_conversions()
+        amount, _, time_unit = unit.partition('/')
+        steps = {'steps': 1.0, 'mm': self.steps_per_mm, 'mL': self.steps_per_ml}.get(amount)
+        if steps is None or time_unit and time_unit not in self.TIME_UNITS:
+            raise ValueError(f"Unknown unit {unit}")
+        return steps / self.TIME_UNITS[time_unit] if time_unit else steps
+
+    def convert(self, values, unit, to_unit):
+        """ Converts a whole array at once
+
+        Parameters
+        ----------
+        values : array_like
+            Distances, volumes or flow rates in unit
+        unit, to_unit : str
+            See steps_per_unit(), rates can only be converted into rates
+
+        Returns
+        -------
+        ndarray
+            The values in to_unit
+        """
+        if ('/' in unit) != ('/' in to_unit):
+            raise ValueError(f"Cannot convert {unit} into {to_unit}")
+        return np.asarray(values, dtype=float) * (self.steps_per_unit(unit) / self.steps_per_unit(to_unit))
 
     def mm_to_steps(self, mm):
-        mm_per_rotation = float(self.config['misc']['mm-per-rotation'])
-        steps_per_rotation = float(self.config['misc']['steps-per-rotation'])
-        microsteps_per_step = float(self.config['misc']['microsteps'])
-
-        return mm / mm_per_rotation * steps_per_rotation * microsteps_per_step
+        if self.steps_per_mm is None:
+            self.update_conversions()
+        return mm * self.steps_per_mm
 
     def steps_to_mm(self, steps):
-        mm_per_rotation = float(self.config['misc']['mm-per-rotation'])
-        steps_per_rotation = float(self.config['misc']['steps-per-rotation'])
-        microsteps_per_step = float(self.config['misc']['microsteps'])
-
-        return steps / microsteps_per_step / steps_per_rotation * mm_per_rotation
+        if self.steps_per_mm is None:
+            self.update_conversions()
+        return steps / self.steps_per_mm
 
     def steps_to_ml(self, steps):
-        mm_per_rotation = float(self.config['misc']['mm-per-rotation'])
-        steps_per_rotation = float(self.config['misc']['steps-per-rotation'])
-        microsteps_per_step = float(self.config['misc']['microsteps'])
-
-        return self.mm_to_ml(steps / microsteps_per_step / steps_per_rotation * mm_per_rotation)
+        if self.steps_per_mm is None:
+            self.update_conversions()
+        return steps / self.steps_per_ml
+
+    def ml_to_steps(self, ml):
+        if self.steps_per_mm is None:
+            self.update_conversions()
+        return ml * self.steps_per_ml
 
     def ml_to_mm(self, ml):
         return ml / (self.syringe_area / 1000)